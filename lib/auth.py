@@ -0,0 +1,111 @@
+import datetime
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+# Used when the IAM response doesn't tell when the token expires
+DEFAULT_TOKEN_LIFETIME = 3600.0
+
+
+def parse_expires_at(value: Optional[str]) -> float:
+    """
+    Parse IAM `expiresAt` (RFC 3339, possibly with nanoseconds) into a unix timestamp.
+    """
+    if not value:
+        return time.time() + DEFAULT_TOKEN_LIFETIME
+
+    value = value.replace("Z", "+00:00")
+    if "." in value:
+        # datetime supports at most microseconds
+        head, tail = value.split(".", 1)
+        digits = len(tail) - len(tail.lstrip("0123456789"))
+        value = f"{head}.{tail[:min(digits, 6)]}{tail[digits:]}"
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class IamTokenManager:
+    """
+    Keeps an IAM token fresh.
+
+    `fetch` returns (token, expires_at as unix timestamp). The token is refreshed by a daemon thread
+    `refresh_margin` seconds before it expires (or at half of its lifetime, if it is shorter),
+    so `token` is normally a plain attribute read.
+    Refreshes are single-flight: concurrent callers that find the token expired wait for one fetch.
+    """
+
+    def __init__(
+            self,
+            fetch: Callable[[], Tuple[str, float]],
+            refresh_margin: float = 300.0,
+            retry_interval: float = 5.0,
+            min_refresh_interval: float = 1.0,
+            background: bool = True
+    ) -> None:
+        self._fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.min_refresh_interval = min_refresh_interval
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self.refresh_count = 0
+
+        self._refresh()
+
+        self._thread: Optional[threading.Thread] = None
+        if background:
+            self._thread = threading.Thread(target=self._refresh_loop, name="iam-token-refresh", daemon=True)
+            self._thread.start()
+
+    @property
+    def expires_at(self) -> float:
+        return self._expires_at
+
+    @property
+    def token(self) -> str:
+        if time.time() < self._expires_at:
+            return self._token
+        return self._refresh_if_stale(self._token)
+
+    def invalidate(self, token: str) -> str:
+        """
+        Called when `token` was rejected (HTTP 401). Returns a token to retry with,
+        fetching a new one only if nobody has replaced `token` yet.
+        """
+        return self._refresh_if_stale(token, force=True)
+
+    def _refresh_if_stale(self, seen_token: Optional[str], force: bool = False) -> str:
+        with self._lock:
+            if self._token != seen_token:
+                return self._token
+            if force or time.time() >= self._expires_at:
+                self._refresh_locked()
+            return self._token
+
+    def _refresh(self) -> None:
+        with self._lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self) -> None:
+        token, expires_at = self._fetch()
+        self._token, self._expires_at = token, expires_at
+        self.refresh_count += 1
+
+    def _refresh_loop(self) -> None:
+        while True:
+            now = time.time()
+            # short-lived tokens are refreshed at half of their remaining lifetime
+            refresh_at = max(self._expires_at - self.refresh_margin, now + (self._expires_at - now) / 2)
+            if self._stop.wait(max(refresh_at - now, self.min_refresh_interval)):
+                return
+            try:
+                self._refresh()
+            except Exception:
+                # the current token may still be valid, try again later
+                if self._stop.wait(self.retry_interval):
+                    return
+
+    def close(self) -> None:
+        self._stop.set()
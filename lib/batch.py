@@ -0,0 +1,256 @@
+import asyncio
+import contextlib
+import dataclasses
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Iterable, Iterator, Sequence, Callable, Tuple
+
+from lib import metrics
+from lib.dedup import DedupIndex
+from lib.journal import JobJournal
+from lib.parser import NotebookCell, ParsedNotebook
+from lib.results import ReviewResult
+
+
+@dataclasses.dataclass
+class ReviewJob:
+    notebook_path: str
+    task_index: int
+    cells: List[NotebookCell]
+    maximum_possible_score: Optional[int] = None
+    prompt: Optional[str] = None
+    # the notebook couldn't be parsed, the job fails with this error without a review
+    error: Optional[BaseException] = None
+
+
+@dataclasses.dataclass
+class JobResult:
+    job: ReviewJob
+    review: Optional[ReviewResult] = None
+    error: Optional[BaseException] = None
+    # the review was taken from the journal of a previous run
+    resumed: bool = False
+    # (notebook path, task index) of the duplicate submission whose review was reused
+    duplicate_of: Optional[Tuple[str, int]] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def build_jobs(
+        notebook_paths: Sequence[str],
+        parsed_notebooks: Sequence[List[List[NotebookCell]]],
+        marks: Sequence[List[Optional[int]]],
+        task_indices: Optional[Iterable[int]] = None
+) -> List[ReviewJob]:
+    """
+    Build (notebook, task) review jobs from `parsing_pipeline` outputs.
+    If `task_indices` is None, every task of every notebook is reviewed.
+    """
+    jobs = []
+    for path, tasks, notebook_marks in zip(notebook_paths, parsed_notebooks, marks):
+        indices = range(len(tasks)) if task_indices is None else task_indices
+        for j in indices:
+            jobs.append(ReviewJob(path, j, tasks[j], notebook_marks[j]))
+    return jobs
+
+
+def jobs_from_parsed(
+        parsed_notebooks: Iterable[ParsedNotebook],
+        task_indices: Optional[Iterable[int]] = None,
+        tasks_count: Optional[int] = None
+) -> Iterator[ReviewJob]:
+    """
+    Lazily build review jobs from `parse_notebooks` results. A notebook that failed to parse gets a job
+    with the parsing error for every requested task (all `tasks_count` tasks by default), so it is reported as failed.
+    """
+    task_indices = None if task_indices is None else list(task_indices)
+    for parsed in parsed_notebooks:
+        if parsed.error is not None:
+            indices = task_indices if task_indices is not None else range(tasks_count or 1)
+            for j in indices:
+                yield ReviewJob(parsed.path, j, [], error=parsed.error)
+            continue
+        yield from build_jobs([parsed.path], [parsed.tasks], [parsed.marks], task_indices)
+
+
+class BatchGrader:
+    """
+    Runs review jobs concurrently while keeping results in the order of the jobs.
+    Jobs may come from a lazy iterator (e.g. `jobs_from_parsed`), they start as soon as they are produced,
+    at most 2 * `max_concurrency` of them are taken from the iterator ahead of finished ones.
+
+    `max_concurrency` bounds the number of jobs in flight, `provider_limits` additionally
+    bounds jobs per provider (see `BaseClient.provider`), e.g. {"yandex": 4, "openai": 8}.
+    A job holds a slot of every provider used by the reviewer.
+
+    With a `journal` every finished job is recorded, jobs completed by a previous run are not reviewed again,
+    failed and missing ones are.
+
+    With a `dedup` index only one job of each group of duplicate submissions (see `DedupIndex`) is reviewed,
+    the other jobs of the group get its result.
+    """
+
+    def __init__(
+            self,
+            reviewer,
+            max_concurrency: int = 8,
+            provider_limits: Optional[Dict[str, int]] = None,
+            journal: Optional[JobJournal] = None,
+            dedup: Optional[DedupIndex] = None
+    ) -> None:
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be positive, got {max_concurrency}")
+
+        self.reviewer = reviewer
+        self.max_concurrency = max_concurrency
+        self.provider_limits = provider_limits or {}
+        self.journal = journal
+        self.dedup = dedup
+
+    def _reviewer_providers(self) -> List[str]:
+        providers = {client.provider for client in self.reviewer.clients}
+        # sorted order of acquisition prevents deadlocks between jobs
+        return sorted(providers & self.provider_limits.keys())
+
+    async def _schedule(self, jobs: Iterable[ReviewJob], on_result: Callable[[int, JobResult], None]) -> int:
+        """
+        Run the jobs, calling `on_result(job_number, result)` as soon as each one is done.
+        Returns the number of jobs.
+        """
+        loop = asyncio.get_running_loop()
+
+        global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        provider_semaphores = {
+            provider: asyncio.Semaphore(limit) for provider, limit in self.provider_limits.items()
+        }
+        providers = self._reviewer_providers()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            async def run_job(job: ReviewJob) -> JobResult:
+                if job.error is not None:
+                    return JobResult(job, error=job.error)
+
+                key = None
+                if self.journal is not None:
+                    # hashing the notebook reads the file
+                    key = await loop.run_in_executor(executor, self.journal.job_key, job, self.reviewer)
+                    review = self.journal.completed(key)
+                    if review is not None:
+                        return JobResult(job, review=review, resumed=True)
+
+                async with global_semaphore, contextlib.AsyncExitStack() as stack:
+                    for provider in providers:
+                        await stack.enter_async_context(provider_semaphores[provider])
+                    try:
+                        review = await loop.run_in_executor(
+                            executor,
+                            self.reviewer.review,
+                            job.cells,
+                            job.maximum_possible_score,
+                            job.prompt
+                        )
+                    except Exception as e:
+                        if key is not None:
+                            self.journal.record_failed(key, job, e)
+                        return JobResult(job, error=e)
+
+                if key is not None:
+                    self.journal.record_done(key, job, review)
+                return JobResult(job, review=review)
+
+            representatives: Dict[Tuple[str, int], "asyncio.Future[JobResult]"] = {}
+
+            def report(number: int, result: JobResult) -> None:
+                if not result.ok:
+                    status = "failed"
+                elif result.duplicate_of is not None:
+                    status = "duplicate"
+                else:
+                    status = "resumed" if result.resumed else "reviewed"
+                metrics.inc("batch_jobs_total", status=status)
+                on_result(number, result)
+
+            async def run_and_report(number: int, job: ReviewJob) -> None:
+                if self.dedup is None or job.error is not None:
+                    report(number, await run_job(job))
+                    return
+
+                # jobs start in the order they were produced, so a representative is always indexed first
+                key = (job.notebook_path, job.task_index)
+                # a review depends on the task, its maximum score and the prompt besides the answer
+                scope = (job.task_index, job.maximum_possible_score, job.prompt)
+                representative = self.dedup.add(key, job.cells, scope)
+                if representative != key:
+                    result = await representatives[representative]
+                    report(number, dataclasses.replace(
+                        result, job=job, resumed=False, duplicate_of=representative
+                    ))
+                    return
+
+                representatives[key] = future = loop.create_future()
+                result = await run_job(job)
+                future.set_result(result)
+                report(number, result)
+
+            if isinstance(jobs, Sequence):
+                pending = [asyncio.ensure_future(run_and_report(i, job)) for i, job in enumerate(jobs)]
+                count = len(pending)
+            else:
+                # finished jobs are released right away and only a few jobs are produced ahead of the running ones,
+                # so a long stream of jobs (and the cells they hold) doesn't pile up
+                pending = set()
+                ahead = asyncio.Semaphore(2 * self.max_concurrency)
+                iterator = iter(jobs)
+                count = 0
+                while True:
+                    await ahead.acquire()
+                    # producing the next job may block, e.g. on parsing
+                    job = await loop.run_in_executor(None, next, iterator, None)
+                    if job is None:
+                        break
+                    task = asyncio.ensure_future(run_and_report(count, job))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    task.add_done_callback(lambda _: ahead.release())
+                    count += 1
+
+            await asyncio.gather(*pending)
+            return count
+
+    async def arun(self, jobs: Iterable[ReviewJob]) -> List[JobResult]:
+        results: Dict[int, JobResult] = {}
+        count = await self._schedule(jobs, results.__setitem__)
+        return [results[i] for i in range(count)]
+
+    def run(self, jobs: Iterable[ReviewJob]) -> List[JobResult]:
+        return asyncio.run(self.arun(jobs))
+
+    def iter_results(self, jobs: Iterable[ReviewJob]) -> Iterator[JobResult]:
+        """
+        Yields results in the order of completion, as soon as they are ready, without keeping them.
+        The jobs run in a background thread, which finishes them all even if the iteration is abandoned.
+        """
+        results: "queue.Queue[object]" = queue.Queue()
+        end = object()
+
+        def produce() -> None:
+            try:
+                asyncio.run(self._schedule(jobs, lambda _, result: results.put(result)))
+            except BaseException as e:
+                results.put(e)
+            finally:
+                results.put(end)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        while True:
+            item = results.get()
+            if item is end:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+        thread.join()
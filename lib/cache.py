@@ -0,0 +1,202 @@
+import collections
+import dataclasses
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Optional, Tuple, Iterator
+
+from lib.clients import BaseClient
+
+
+@dataclasses.dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    # entries pushed out of the in-memory LRU, they may still be on disk
+    memory_evictions: int = 0
+    disk_evictions: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def evictions(self) -> int:
+        return self.memory_evictions + self.disk_evictions
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of LLM responses.
+
+    Two tiers: an in-memory LRU of `memory_items` entries and, if `path` is given, an SQLite file
+    limited to `max_disk_bytes` of stored text (least recently used entries are evicted first).
+    Entries older than `ttl` seconds are treated as missing.
+    """
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            memory_items: int = 1024,
+            max_disk_bytes: int = 256 * 1024 * 1024,
+            ttl: Optional[float] = None
+    ) -> None:
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+        self._lock = threading.Lock()
+        self._memory: "collections.OrderedDict[str, Tuple[str, float]]" = collections.OrderedDict()
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_bytes = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(
+            model: str,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        payload = json.dumps(
+            [model, prompt, context or [], user_message, max_tokens, temperature],
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1]):
+                    self._memory.move_to_end(key)
+                    self.stats.memory_hits += 1
+                    return entry[0]
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, created = row
+                    if not self._expired(created):
+                        self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                        self._remember(key, value, created)
+                        self.stats.disk_hits += 1
+                        return value
+                    self._delete_from_disk(key)
+
+            self.stats.misses += 1
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+
+            if self._db is not None:
+                self._delete_from_disk(key)
+                size = len(value.encode("utf-8"))
+                self._db.execute(
+                    "INSERT INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, now, now)
+                )
+                self._disk_bytes += size
+                self._evict_from_disk()
+
+    def _remember(self, key: str, value: str, created: float) -> None:
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+            self.stats.memory_evictions += 1
+
+    def _delete_from_disk(self, key: str) -> None:
+        row = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._disk_bytes -= row[0]
+
+    def _evict_from_disk(self) -> None:
+        while self._disk_bytes > self.max_disk_bytes:
+            row = self._db.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            self._disk_bytes -= row[1]
+            self.stats.disk_evictions += 1
+
+    def call(
+            self,
+            client: BaseClient,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        """
+        `client.call` with caching.
+        """
+        key = self.make_key(client.model_name, prompt, user_message, context, max_tokens, temperature)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        response = client.call(prompt, user_message, context=context, max_tokens=max_tokens, temperature=temperature)
+        self.put(key, response)
+        return response
+
+    def stream(
+            self,
+            client: BaseClient,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> Iterator[str]:
+        """
+        `client.stream` with caching, a cached response comes as a single chunk.
+        The response is stored only if the stream is read to the end.
+        """
+        key = self.make_key(client.model_name, prompt, user_message, context, max_tokens, temperature)
+        cached = self.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        chunks = []
+        for chunk in client.stream(prompt, user_message, context=context, max_tokens=max_tokens, temperature=temperature):
+            chunks.append(chunk)
+            yield chunk
+        self.put(key, "".join(chunks))
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,362 @@
+import array
+import collections
+import os
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple, AbstractSet
+
+from lib import metrics
+from lib.batch import ReviewJob
+from lib.constants import SPECIAL_MARK
+from lib.parser import (
+    NotebookCell, CellType, MergeKind, NotebookLoader, DiffMode,
+    get_filtered_notebook_cells_from_notebook, get_normalized_content, normalize_text, mark_modified_cells,
+    assign_cells_to_tasks
+)
+
+# `marks` value of a task without a stated score
+_NO_MARK = -1
+
+
+def _split_cells(
+        orig_cells: List[NotebookCell],
+        original_content: AbstractSet[str],
+        cells: List[NotebookCell],
+        tasks_count: int,
+        diff_mode: DiffMode
+) -> Tuple[List[NotebookCell], List[bool], List[List[int]], List[Optional[int]]]:
+    """
+    Filtered cells of a notebook, their changed flags, the indices of the cells of each task and the task marks.
+    """
+    with metrics.timer("parse_stage_seconds", stage="diff", mode=diff_mode.name.lower()):
+        if diff_mode == DiffMode.EXACT:
+            # the flags are kept apart, so the cells are not copied to mark them
+            changed = [normalize_text(cell.raw_text) not in original_content for cell in cells]
+        else:
+            cells = mark_modified_cells(orig_cells, cells, original_content, diff_mode)
+            changed = [cell.is_changed for cell in cells]
+
+    with metrics.timer("parse_stage_seconds", stage="split_tasks"):
+        task_indices, marks = assign_cells_to_tasks(cells, tasks_count)
+        tasks = [[] for _ in range(tasks_count)]
+        for i, task_index in enumerate(task_indices):
+            if task_index != -1:
+                tasks[task_index].append(i)
+    return cells, changed, tasks, marks
+
+
+# Original notebook and options shared by the notebooks of a `CellStore.load` worker process
+_worker_state: Optional[tuple] = None
+
+
+def _init_load_worker(
+        orig_cells: List[NotebookCell],
+        original_content: AbstractSet[str],
+        tasks_count: int,
+        loader: NotebookLoader,
+        diff_mode: DiffMode,
+        metrics_enabled: bool = False
+) -> None:
+    global _worker_state
+    _worker_state = (orig_cells, original_content, tasks_count, loader, diff_mode)
+    # a forked worker must not report the metrics of the parent again
+    metrics.set_registry(metrics.MetricsRegistry(enabled=metrics_enabled))
+
+
+def _load_notebook(path: str) -> Tuple[Optional[tuple], Optional[BaseException], Optional[dict]]:
+    """
+    `_split_cells` of a notebook or the error, and the metrics recorded by the worker for it, if enabled.
+    The error is returned, so any error reaches the store.
+    """
+    orig_cells, original_content, tasks_count, loader, diff_mode = _worker_state
+    split, error = None, None
+    try:
+        with metrics.timer("parse_notebook_seconds"):
+            cells = get_filtered_notebook_cells_from_notebook(path, loader)
+            split = _split_cells(orig_cells, original_content, cells, tasks_count, diff_mode)
+    except Exception as e:
+        error = e
+
+    metrics.inc("parsed_notebooks_total", status="ok" if error is None else "error")
+    return split, error, metrics.get_registry().drain() if metrics.is_enabled() else None
+
+
+class CellStore:
+    """
+    Parsed cells of a whole cohort in flat arrays instead of a `NotebookCell` per cell.
+
+    Every distinct cell text is stored once, so the template cells students left as they were
+    are shared by all notebooks. A cell is an index into the texts and a cell type byte, changed flags
+    are a bitmap, the cells of a notebook are kept task by task. Merged cells (see `MergeKind`) and
+    merged task texts are built only when asked for, nothing merged is kept.
+
+    `task_cells` and `task_text` give the same cells and text as `parsing_pipeline` and
+    `merge_task_into_single_string`.
+    """
+
+    def __init__(
+            self,
+            original_notebook_path: str,
+            tasks_count: int,
+            loader: NotebookLoader = NotebookLoader.FAST,
+            diff_mode: DiffMode = DiffMode.EXACT
+    ) -> None:
+        self.tasks_count = tasks_count
+        self.loader = loader
+        self.diff_mode = diff_mode
+        self.paths: List[str] = []
+        # notebooks that couldn't be parsed, path -> error
+        self.errors: Dict[str, BaseException] = {}
+
+        self._texts: List[str] = []
+        self._text_ids: Dict[str, int] = {}
+        self._cell_texts = array.array("I")
+        self._cell_types = bytearray()
+        # bit i % 8 of byte i // 8 is the changed flag of cell i
+        self._changed = bytearray()
+        # cells of task j of notebook n are [_task_starts[n * tasks_count + j], _task_starts[n * tasks_count + j + 1])
+        self._task_starts = array.array("I", [0])
+        self._marks = array.array("i")
+
+        self._original_cells = get_filtered_notebook_cells_from_notebook(original_notebook_path, loader)
+        self._original_content = get_normalized_content(self._original_cells)
+        for cell in self._original_cells:
+            self._intern(cell.raw_text)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @property
+    def cells_count(self) -> int:
+        return len(self._cell_texts)
+
+    def _intern(self, text: str) -> int:
+        text_id = self._text_ids.get(text)
+        if text_id is None:
+            text_id = self._text_ids[text] = len(self._texts)
+            self._texts.append(text)
+        return text_id
+
+    def add(self, path: str) -> Optional[int]:
+        """
+        Parse a notebook into the store, returns its index, None if it couldn't be parsed (see `errors`).
+        """
+        try:
+            with metrics.timer("parse_notebook_seconds"):
+                cells = get_filtered_notebook_cells_from_notebook(path, self.loader)
+                index = self.add_cells(path, cells)
+        except Exception as e:
+            metrics.inc("parsed_notebooks_total", status="error")
+            self.errors[path] = e
+            return None
+        metrics.inc("parsed_notebooks_total", status="ok")
+        return index
+
+    def extend(self, paths: Iterable[str]) -> int:
+        """
+        Returns the number of notebooks parsed successfully.
+        """
+        return sum(self.add(path) is not None for path in paths)
+
+    def load(self, paths: Iterable[str], max_workers: Optional[int] = None) -> Iterator[Tuple[str, Optional[int]]]:
+        """
+        `extend` with the notebooks parsed in worker processes, yields (path, index or None, see `add`)
+        in the order of `paths` as soon as each notebook is stored. Only a few notebooks are parsed ahead
+        of the consumer, so the cells of a cohort don't pile up in the pool.
+        """
+        max_workers = max_workers or os.cpu_count() or 1
+        paths = iter(paths)
+        parsing = collections.deque()
+        executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_load_worker,
+            initargs=(
+                self._original_cells, self._original_content, self.tasks_count, self.loader, self.diff_mode,
+                metrics.is_enabled()
+            )
+        )
+        try:
+            for path in paths:
+                parsing.append((path, executor.submit(_load_notebook, path)))
+                if len(parsing) >= 2 * max_workers:
+                    yield self._store_loaded(*parsing.popleft())
+            while parsing:
+                yield self._store_loaded(*parsing.popleft())
+        finally:
+            # the consumer may stop early, don't parse the rest
+            executor.shutdown(cancel_futures=True)
+
+    def _store_loaded(self, path: str, future: Future) -> Tuple[str, Optional[int]]:
+        try:
+            split, error, worker_metrics = future.result()
+            if worker_metrics is not None:
+                metrics.get_registry().merge(worker_metrics)
+            if error is None:
+                return path, self._store(path, *split)
+        except Exception as e:
+            error = e
+        self.errors[path] = error
+        return path, None
+
+    def add_cells(self, path: str, cells: List[NotebookCell]) -> int:
+        """
+        Store the filtered cells of a notebook (see `get_filtered_notebook_cells_from_notebook`).
+        """
+        return self._store(path, *_split_cells(
+            self._original_cells, self._original_content, cells, self.tasks_count, self.diff_mode
+        ))
+
+    def _store(
+            self,
+            path: str,
+            cells: List[NotebookCell],
+            changed: List[bool],
+            tasks: List[List[int]],
+            marks: List[Optional[int]]
+    ) -> int:
+        for task in tasks:
+            for i in task:
+                self._append_cell(cells[i], changed[i])
+            self._task_starts.append(len(self._cell_texts))
+        self._marks.extend(_NO_MARK if mark is None else mark for mark in marks)
+        self.paths.append(path)
+        return len(self.paths) - 1
+
+    def _append_cell(self, cell: NotebookCell, is_changed: bool) -> None:
+        i = len(self._cell_texts)
+        self._cell_texts.append(self._intern(cell.raw_text))
+        self._cell_types.append(cell.cell_type.value)
+        if i % 8 == 0:
+            self._changed.append(0)
+        if is_changed:
+            self._changed[i >> 3] |= 1 << (i & 7)
+
+    def _is_changed(self, i: int) -> bool:
+        return bool(self._changed[i >> 3] >> (i & 7) & 1)
+
+    def marks(self, notebook: int) -> List[Optional[int]]:
+        marks = self._marks[notebook * self.tasks_count:(notebook + 1) * self.tasks_count]
+        return [None if mark == _NO_MARK else mark for mark in marks]
+
+    def raw_cells(self, notebook: int, task: int) -> List[NotebookCell]:
+        """
+        Cells of a task before merging, as marked by `mark_modified_cells`.
+        """
+        start, end = self._task_range(notebook, task)
+        return [
+            NotebookCell(self._is_changed(i), CellType(self._cell_types[i]), self._texts[self._cell_texts[i]])
+            for i in range(start, end)
+        ]
+
+    def _task_range(self, notebook: int, task: int) -> Tuple[int, int]:
+        if not 0 <= task < self.tasks_count:
+            raise IndexError(f"Task {task} is out of {self.tasks_count} tasks")
+        position = notebook * self.tasks_count + task
+        return self._task_starts[position], self._task_starts[position + 1]
+
+    def _groups(self, notebook: int, task: int, kind: MergeKind) -> Iterator[Tuple[bool, CellType, List[str]]]:
+        """
+        (is_changed, cell type, texts) of the runs of cells merged into one by `kind`.
+        """
+        if kind == MergeKind.BY_CHANGE_AND_CELL_TYPE:
+            by_type = True
+        elif kind == MergeKind.BY_CHANGE:
+            by_type = False
+        else:
+            raise ValueError(f"Unsupported MergeKind, FIX ME!: {kind}")
+
+        start, end = self._task_range(notebook, task)
+        key = None
+        texts = []
+        for i in range(start, end):
+            cell_key = (self._is_changed(i), self._cell_types[i] if by_type else CellType.OTHER.value)
+            if cell_key != key and texts:
+                yield key[0], CellType(key[1]), texts
+                texts = []
+            key = cell_key
+            texts.append(self._texts[self._cell_texts[i]])
+        if texts:
+            yield key[0], CellType(key[1]), texts
+
+    def task_cells(self, notebook: int, task: int, kind: MergeKind) -> List[NotebookCell]:
+        cells = []
+        for is_changed, cell_type, texts in self._groups(notebook, task, kind):
+            text = "\n\n".join(texts)
+            cells.append(NotebookCell(is_changed, cell_type, f"{SPECIAL_MARK}\n{text}" if is_changed else text))
+        return cells
+
+    def tasks(self, notebook: int, kind: MergeKind) -> List[List[NotebookCell]]:
+        return [self.task_cells(notebook, j, kind) for j in range(self.tasks_count)]
+
+    def task_text(self, notebook: int, task: int, kind: MergeKind, delim: str = "\n\n\n") -> str:
+        """
+        `merge_task_into_single_string(task_cells(...))`, joined once without building the merged cells.
+        """
+        pieces = []
+        for is_changed, _, texts in self._groups(notebook, task, kind):
+            if pieces:
+                pieces.append(delim)
+            if is_changed:
+                pieces.append(f"{SPECIAL_MARK}\n")
+            for k, text in enumerate(texts):
+                if k:
+                    pieces.append("\n\n")
+                pieces.append(text)
+        return "".join(pieces)
+
+    def notebook_jobs(self, notebook: int, kind: MergeKind, task_indices: Iterable[int]) -> Iterator[ReviewJob]:
+        marks = self.marks(notebook)
+        with metrics.timer("parse_stage_seconds", stage="merge"):
+            tasks = [(j, self.task_cells(notebook, j, kind)) for j in task_indices]
+        for j, cells in tasks:
+            yield ReviewJob(self.paths[notebook], j, cells, marks[j])
+
+    def _error_jobs(self, path: str, task_indices: Iterable[int]) -> Iterator[ReviewJob]:
+        for j in task_indices:
+            yield ReviewJob(path, j, [], error=self.errors[path])
+
+    def jobs(self, kind: MergeKind, task_indices: Optional[Iterable[int]] = None) -> Iterator[ReviewJob]:
+        """
+        Review jobs of every notebook, the merged cells of a job are built when it is produced.
+        A notebook that couldn't be parsed gets a job with the error for every task, as in `jobs_from_parsed`.
+        """
+        task_indices = list(range(self.tasks_count) if task_indices is None else task_indices)
+        for notebook in range(len(self.paths)):
+            yield from self.notebook_jobs(notebook, kind, task_indices)
+        for path in self.errors:
+            yield from self._error_jobs(path, task_indices)
+
+    def load_jobs(
+            self,
+            paths: Iterable[str],
+            kind: MergeKind,
+            task_indices: Optional[Iterable[int]] = None,
+            max_workers: Optional[int] = None
+    ) -> Iterator[ReviewJob]:
+        """
+        `load` the notebooks and yield the jobs of each one as soon as it is stored.
+        """
+        task_indices = list(range(self.tasks_count) if task_indices is None else task_indices)
+        for path, notebook in self.load(paths, max_workers):
+            if notebook is None:
+                yield from self._error_jobs(path, task_indices)
+            else:
+                yield from self.notebook_jobs(notebook, kind, task_indices)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Sizes of the store, bytes are estimated with `sys.getsizeof`.
+        """
+        text_bytes = sum(sys.getsizeof(text) for text in self._texts)
+        array_bytes = sum(
+            sys.getsizeof(buffer)
+            for buffer in (self._cell_texts, self._cell_types, self._changed, self._task_starts, self._marks)
+        )
+        return {
+            "notebooks": len(self.paths),
+            "cells": self.cells_count,
+            "unique_texts": len(self._texts),
+            "text_bytes": text_bytes,
+            "array_bytes": array_bytes,
+            "index_bytes": sys.getsizeof(self._text_ids) + sys.getsizeof(self._texts),
+        }
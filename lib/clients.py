@@ -1,14 +1,172 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import json
+import threading
 import time
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple, Deque, Callable, TypeVar, Iterator, AsyncIterator
 
 import jwt
+import openai
 import requests
-from openai import OpenAI
+import urllib3
+from openai import OpenAI, AsyncOpenAI
+from requests.adapters import HTTPAdapter
+
+from lib import metrics
+from lib.auth import IamTokenManager, parse_expires_at
+from lib.scheduler import RequestScheduler, ProviderError, is_retryable_status, parse_retry_after
+from lib.tokens import heuristic_token_count, message_text
+
+T = TypeVar("T")
+
+IAM_TOKEN_URL = "https://iam.api.cloud.yandex.net/iam/v1/tokens"
+YANDEX_LLM_URL = "https://llm.api.cloud.yandex.net"
+OPERATION_URL = "https://operation.api.cloud.yandex.net"
+
+
+@dataclasses.dataclass
+class RequestTiming:
+    url: str
+    status: int
+    # time until response headers were parsed (includes connect + TLS for a new connection)
+    headers: float
+    # time spent reading and decoding the body
+    body: float
+    total: float
+    # connections opened by the pool during this request, 0 means a kept-alive connection was reused.
+    # Exact for sequential calls, approximate when requests to the same host overlap.
+    new_connections: int
+
+
+def create_session(pool_size: int = 10) -> requests.Session:
+    """
+    Session with keep-alive connection pooling, up to `pool_size` connections per host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def estimate_tokens(
+        prompt: str,
+        user_message: str,
+        context: Optional[List[Dict[str, str]]] = None,
+        max_tokens: int = 0
+) -> int:
+    """
+    Rough upper bound of tokens a call consumes from the quota, including the completion budget.
+    """
+    tokens = heuristic_token_count(prompt) + heuristic_token_count(user_message)
+    for message in context or []:
+        tokens += heuristic_token_count(message_text(message))
+    return tokens + max_tokens
 
 
 class BaseClient:
-    def __init__(self, api_key: Optional[str]):
+    # Name used to group clients of the same provider, e.g. for concurrency limits
+    provider: str = "base"
+
+    # Key of the message text in the provider's chat format
+    message_key: str = "content"
+
+    def __init__(self, api_key: Optional[str], scheduler: Optional[RequestScheduler] = None):
         self.api_key = api_key
+        self.scheduler = scheduler
+        self._local = threading.local()
+
+    @property
+    def last_usage(self) -> Optional[Dict[str, int]]:
+        """
+        Token usage reported by the provider for the last call made by the current thread:
+        {"input_tokens": ..., "completion_tokens": ...}, None if unknown.
+        """
+        return getattr(self._local, "usage", None)
+
+    @last_usage.setter
+    def last_usage(self, usage: Optional[Dict[str, int]]) -> None:
+        self._local.usage = usage
+        if usage is not None:
+            metrics.inc("llm_tokens_total", usage["input_tokens"], provider=self.provider, kind="input")
+            metrics.inc("llm_tokens_total", usage["completion_tokens"], provider=self.provider, kind="completion")
+
+    @contextlib.contextmanager
+    def _request_metrics(self) -> Iterator[None]:
+        """
+        Latency (with retries, until the stream is opened for streams) and outcome of a provider request.
+        """
+        status = "ok"
+        with metrics.timer("llm_request_seconds", provider=self.provider):
+            try:
+                yield
+            except ProviderError as e:
+                status = str(e.status) if e.status is not None else type(e).__name__
+                raise
+            except Exception as e:
+                status = type(e).__name__
+                raise
+            finally:
+                metrics.inc("llm_requests_total", provider=self.provider, status=status)
+
+    def _execute(self, request: Callable[[], T], estimated_tokens: int = 0) -> T:
+        """
+        Run a single provider request through the scheduler (rate limits, retries), if there is one.
+        """
+        if not metrics.is_enabled():
+            return request() if self.scheduler is None else self.scheduler.execute(request, estimated_tokens)
+
+        attempts = 0
+
+        def attempt() -> T:
+            nonlocal attempts
+            attempts += 1
+            return request()
+
+        with self._request_metrics():
+            try:
+                if self.scheduler is None:
+                    return attempt()
+                return self.scheduler.execute(attempt, estimated_tokens)
+            finally:
+                if attempts > 1:
+                    metrics.inc("llm_retries_total", attempts - 1, provider=self.provider)
+
+    @property
+    def model_name(self) -> str:
+        """
+        Identifies the model answering the calls, e.g. for cache keys.
+        """
+        return type(self).__name__
+
+    def make_message(self, role: str, text: str) -> Dict[str, str]:
+        return {"role": role, self.message_key: text}
+
+    def adapt_messages(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Messages in the provider's format, e.g. a history built for another provider.
+        """
+        return [
+            message if self.message_key in message else self.make_message(message["role"], message_text(message))
+            for message in messages
+        ]
+
+    def build_messages(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+    ) -> List[Dict[str, str]]:
+        messages = [self.make_message("system", prompt)]
+        if context:
+            messages.extend(self.adapt_messages(context))
+        messages.append(self.make_message("user", user_message))
+        return messages
+
+    def close(self) -> None:
+        pass
 
     def call(
             self,
@@ -20,29 +178,107 @@ class BaseClient:
     ) -> str:
         raise NotImplementedError("It's base class, you can't call this method")
 
+    async def acall(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        """
+        Async variant of `call`. By default runs the blocking call in a worker thread.
+        """
+        return await asyncio.to_thread(self.call, prompt, user_message, context, max_tokens, temperature)
+
+    def stream(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> Iterator[str]:
+        """
+        Yields the completion in chunks as they are generated, the chunks joined give the `call` result.
+        `last_usage` is set once the stream is exhausted. Failures after the first chunk are not retried.
+        By default the whole completion is a single chunk.
+        """
+        yield self.call(prompt, user_message, context, max_tokens, temperature)
+
+    async def astream(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> AsyncIterator[str]:
+        """
+        Async variant of `stream`. By default every chunk is read from the blocking stream in a worker thread.
+        """
+        chunks = self.stream(prompt, user_message, context, max_tokens, temperature)
+        end = object()
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, end)
+            if chunk is end:
+                return
+            yield chunk
+
 
 class YandexGPTClient(BaseClient):
+    provider = "yandex"
+    message_key = "text"
+
     def __init__(
             self,
             service_account_id: str,
             key_id: str,
             private_key: str,
             folder: str,
-            model_url: str = "/yandexgpt/latest"
+            model_url: str = "/yandexgpt/latest",
+            llm_url: str = YANDEX_LLM_URL,
+            iam_url: str = IAM_TOKEN_URL,
+            operation_url: str = OPERATION_URL,
+            pool_size: int = 10,
+            timeout: Tuple[float, float] = (5.0, 120.0),
+            timing_history: int = 1000,
+            token_refresh_margin: float = 300.0,
+            scheduler: Optional[RequestScheduler] = None,
     ) -> None:
-        super().__init__(api_key=None)
+        """
+        `pool_size` is the number of kept-alive connections per host, it should be at least the number
+        of concurrent calls (sync or `acall`) made through this client. `timeout` is (connect, read) in seconds.
+        The IAM token is refreshed in the background `token_refresh_margin` seconds before it expires.
+        Completions go through `scheduler`, if given.
+        """
+        super().__init__(api_key=None, scheduler=scheduler)
 
         self.service_account_id = service_account_id
         self.key_id = key_id
         self.private_key = private_key
-        self.token = self._generate_iam_token()
+        self.llm_url = llm_url
+        self.iam_url = iam_url
+        self.operation_url = operation_url
+        self.timeout = timeout
+        self.session = create_session(pool_size)
+        self.timings: Deque[RequestTiming] = collections.deque(maxlen=timing_history)
+        self.tokens = IamTokenManager(self._generate_iam_token, refresh_margin=token_refresh_margin)
         self.model_url = f"gpt://{folder}{model_url}"
 
-    def _generate_iam_token(self) -> str:
+    @property
+    def token(self) -> str:
+        return self.tokens.token
+
+    @property
+    def model_name(self) -> str:
+        return self.model_url
+
+    def _generate_iam_token(self) -> Tuple[str, float]:
         now = int(time.time())
 
         payload = {
-            "aud": "https://iam.api.cloud.yandex.net/iam/v1/tokens",
+            "aud": IAM_TOKEN_URL,
             "iss": self.service_account_id,
             "iat": now,
             "exp": now + 360,
@@ -52,65 +288,342 @@ class YandexGPTClient(BaseClient):
             payload, self.private_key, algorithm="PS256", headers={"kid": self.key_id}
         )
 
-        url = "https://iam.api.cloud.yandex.net/iam/v1/tokens"
+        response = self._check(*self._post(
+            self.iam_url, headers={"Content-Type": "application/json"}, json={"jwt": encoded_token}
+        ))
 
-        response = requests.post(
-            url, headers={"Content-Type": "application/json"}, json={"jwt": encoded_token}
-        ).json()
+        return response["iamToken"], parse_expires_at(response.get("expiresAt"))
 
-        return response["iamToken"]
+    def _pool_counters(self, url: str) -> Tuple[int, int]:
+        """
+        (requests sent, connections opened) over the session pools for the host of `url`.
+        """
+        host = urllib3.util.parse_url(url).host
+        pools = self.session.get_adapter(url).poolmanager.pools
+        requests_sent = connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None and pool.host == host:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        return requests_sent, connections
 
-    def call(
+    def _connections_opened(self, url: str) -> int:
+        return self._pool_counters(url)[1]
+
+    def _endpoint(self, url: str) -> str:
+        if url == self.iam_url:
+            return "iam"
+        return "operation" if "/operations/" in url else "completion"
+
+    def _post(self, url: str, stream: bool = False, **kwargs) -> Tuple[requests.Response, Optional[dict]]:
+        return self._request("POST", url, stream=stream, **kwargs)
+
+    def _request(
             self,
-            prompt: str,
-            user_message: str,
-            context: Optional[List[Dict[str, str]]] = None,
-            max_tokens: int = 500,
-            temperature: float = 0.5,
-    ) -> str:
-        url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+            method: str,
+            url: str,
+            stream: bool = False,
+            **kwargs
+    ) -> Tuple[requests.Response, Optional[dict]]:
+        """
+        Returns the response and its decoded JSON body (None if the body isn't JSON).
+        With `stream` the body of a successful response is left to the caller (and is not timed).
+        """
+        opened_before = self._connections_opened(url)
+        start = time.perf_counter()
 
-        messages = [
-            {
-                "role": "system",
-                "text": prompt,
-            }
-        ]
+        endpoint = self._endpoint(url)
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, stream=stream, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.inc("http_responses_total", provider=self.provider, endpoint=endpoint, status=type(e).__name__)
+            raise ProviderError(f"Request to {url} failed: {e}", retryable=True) from e
 
-        if context:
-            messages.extend(context)
+        headers_time = response.elapsed.total_seconds()
+        result = None
+        if not (stream and response.ok):
+            try:
+                result = response.json()
+            except ValueError:
+                pass
+
+        total = time.perf_counter() - start
+        self.timings.append(RequestTiming(
+            url=url,
+            status=response.status_code,
+            headers=headers_time,
+            body=max(total - headers_time, 0.0),
+            total=total,
+            new_connections=self._connections_opened(url) - opened_before
+        ))
+        metrics.observe("http_request_seconds", total, provider=self.provider, endpoint=endpoint)
+        metrics.inc("http_responses_total", provider=self.provider, endpoint=endpoint, status=response.status_code)
+        return response, result
 
-        messages.append(
-            {
-                "role": "user",
-                "text": user_message,
-            }
+    @staticmethod
+    def _check(response: requests.Response, result: Optional[dict]) -> dict:
+        if response.ok and result is not None:
+            return result
+
+        message = response.text[:500] if result is None else result.get("error", result)
+        raise ProviderError(
+            f"Yandex API returned HTTP {response.status_code}: {message}",
+            status=response.status_code,
+            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+            retryable=is_retryable_status(response.status_code)
         )
 
-        data = {
+    def pool_stats(self) -> Dict[str, int]:
+        """
+        Requests sent and connections opened for the completion endpoint host.
+        """
+        requests_sent, connections = self._pool_counters(self.llm_url)
+        return {"requests": requests_sent, "connections": connections}
+
+    def close(self) -> None:
+        self.tokens.close()
+        self.session.close()
+
+    def _build_request(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]],
+            max_tokens: int,
+            temperature: float,
+            stream: bool = False
+    ) -> dict:
+        return {
             "modelUri": self.model_url,
             "completionOptions": {
+                "stream": stream,
                 "maxTokens": max_tokens,
                 "temperature": temperature,
             },
-            "messages": messages,
+            "messages": self.build_messages(prompt, user_message, context),
         }
 
-        response = requests.post(
-            url,
-            headers={"Authorization": f"Bearer {self.token}"},
-            json=data,
-        ).json()
+    @staticmethod
+    def _usage(result: dict) -> Optional[Dict[str, int]]:
+        usage = result.get("usage")
+        return {
+            "input_tokens": int(usage.get("inputTextTokens", 0)),
+            "completion_tokens": int(usage.get("completionTokens", 0)),
+        } if usage else None
+
+    def _record_usage(self, result: dict) -> None:
+        self.last_usage = self._usage(result)
+
+    def call(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        url = f"{self.llm_url}/foundationModels/v1/completion"
+        data = self._build_request(prompt, user_message, context, max_tokens, temperature)
+
+        response = self._execute(
+            lambda: self._check(*self._authorized_post(url, data)),
+            estimate_tokens(prompt, user_message, context, max_tokens)
+        )
 
+        self._record_usage(response["result"])
         return response["result"]["alternatives"][0]["message"]["text"]
 
+    def stream(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> Iterator[str]:
+        url = f"{self.llm_url}/foundationModels/v1/completion"
+        data = self._build_request(prompt, user_message, context, max_tokens, temperature, stream=True)
+
+        # only opening the stream goes through the scheduler, a broken stream can't be retried transparently
+        response = self._execute(
+            lambda: self._open_stream(url, data),
+            estimate_tokens(prompt, user_message, context, max_tokens)
+        )
+
+        self.last_usage = None
+        received = ""
+        last_result = None
+        with response:
+            try:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if "error" in chunk:
+                        raise ProviderError(f"Yandex API stream failed: {chunk['error']}")
+
+                    result = chunk["result"]
+                    # every chunk holds the whole text generated so far
+                    text = result["alternatives"][0]["message"]["text"]
+                    if len(text) > len(received):
+                        yield text[len(received):]
+                        received = text
+                    last_result = result
+            except (requests.RequestException, ValueError) as e:
+                raise ProviderError(f"Yandex API stream failed: {e}", retryable=True) from e
+
+        # usage is cumulative too, only the last one counts
+        if last_result is not None:
+            self._record_usage(last_result)
+
+    def submit_completion(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        """
+        Deferred variant of `call`: starts a `completionAsync` operation and returns its id,
+        the result is taken with `get_operation` once it is done (see `lib.deferred`).
+        """
+        url = f"{self.llm_url}/foundationModels/v1/completionAsync"
+        data = self._build_request(prompt, user_message, context, max_tokens, temperature)
+
+        operation = self._execute(
+            lambda: self._check(*self._authorized_post(url, data)),
+            estimate_tokens(prompt, user_message, context, max_tokens)
+        )
+        return operation["id"]
+
+    def get_operation(self, operation_id: str) -> dict:
+        """
+        Current state of an operation, the request goes through the scheduler as completions do,
+        so polls count towards the rate limits and are backed off on 429.
+        """
+        url = f"{self.operation_url}/operations/{operation_id}"
+        return self._execute(lambda: self._check(*self._authorized_request("GET", url)))
+
+    def operation_result(self, operation: dict) -> Optional[Tuple[str, Optional[Dict[str, int]]]]:
+        """
+        (text, usage) of a finished completion operation, None if it isn't done yet.
+        """
+        if not operation.get("done"):
+            return None
+        if "error" in operation:
+            error = operation["error"]
+            raise ProviderError(f"Yandex operation {operation.get('id')} failed: {error.get('message', error)}")
+
+        result = operation["response"]
+        return result["alternatives"][0]["message"]["text"], self._usage(result)
+
+    def _authorized_post(self, url: str, data: dict, stream: bool = False) -> Tuple[requests.Response, Optional[dict]]:
+        return self._authorized_request("POST", url, data, stream)
+
+    def _authorized_request(
+            self,
+            method: str,
+            url: str,
+            data: Optional[dict] = None,
+            stream: bool = False
+    ) -> Tuple[requests.Response, Optional[dict]]:
+        token = self.tokens.token
+        response, result = self._request(
+            method, url, stream=stream, headers={"Authorization": f"Bearer {token}"}, json=data
+        )
+
+        if response.status_code == 401:
+            # the token was revoked or expired earlier than announced, retry once with a fresh one
+            token = self.tokens.invalidate(token)
+            response, result = self._request(
+                method, url, stream=stream, headers={"Authorization": f"Bearer {token}"}, json=data
+            )
+
+        return response, result
+
+    def _open_stream(self, url: str, data: dict) -> requests.Response:
+        response, result = self._authorized_post(url, data, stream=True)
+        if not response.ok:
+            self._check(response, result)
+        return response
+
 
 class OpenAIClient(BaseClient):
-    def __init__(self, api_key: str, model: str = "gpt-4o"):
-        super().__init__(api_key=api_key)
+    provider = "openai"
+
+    def __init__(
+            self,
+            api_key: str,
+            model: str = "gpt-4o",
+            base_url: Optional[str] = None,
+            scheduler: Optional[RequestScheduler] = None
+    ):
+        super().__init__(api_key=api_key, scheduler=scheduler)
 
         self.model = model
-        self.client = OpenAI(api_key=self.api_key)
+        # with a scheduler retries are its responsibility
+        max_retries = 0 if scheduler is not None else openai.DEFAULT_MAX_RETRIES
+        self.client = OpenAI(api_key=self.api_key, base_url=base_url, max_retries=max_retries)
+        self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=base_url, max_retries=max_retries)
+
+    @property
+    def model_name(self) -> str:
+        return self.model
+
+    @staticmethod
+    def _provider_error(error: openai.OpenAIError) -> ProviderError:
+        if isinstance(error, openai.APIStatusError):
+            return ProviderError(
+                f"OpenAI API returned HTTP {error.status_code}: {error.message}",
+                status=error.status_code,
+                retry_after=parse_retry_after(error.response.headers.get("retry-after")),
+                retryable=is_retryable_status(error.status_code)
+            )
+        if isinstance(error, openai.APIConnectionError):
+            return ProviderError(f"OpenAI request failed: {error}", retryable=True)
+        return ProviderError(f"OpenAI request failed: {error}")
+
+    def _complete(self, messages: List[Dict[str, str]], max_tokens: int, temperature: float) -> str:
+        try:
+            completion = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+            )
+        except openai.OpenAIError as e:
+            raise self._provider_error(e) from e
+
+        self._record_usage(completion)
+        return completion.choices[0].message.content
+
+    def _record_usage(self, completion) -> None:
+        self.last_usage = {
+            "input_tokens": completion.usage.prompt_tokens,
+            "completion_tokens": completion.usage.completion_tokens,
+        } if completion.usage is not None else None
+
+    def _open_stream(self, messages: List[Dict[str, str]], max_tokens: int, temperature: float):
+        try:
+            return self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True,
+                # the last chunk reports the usage
+                stream_options={"include_usage": True},
+            )
+        except openai.OpenAIError as e:
+            raise self._provider_error(e) from e
+
+    @staticmethod
+    def _chunk_text(chunk) -> Optional[str]:
+        if chunk.choices and chunk.choices[0].delta.content:
+            return chunk.choices[0].delta.content
+        return None
 
     def call(
             self,
@@ -120,28 +633,92 @@ class OpenAIClient(BaseClient):
             max_tokens: int = 500,
             temperature: float = 0.5,
     ) -> str:
-        messages = [
-            {
-                "role": "system",
-                "content": prompt,
-            }
-        ]
+        messages = self.build_messages(prompt, user_message, context)
+        return self._execute(
+            lambda: self._complete(messages, max_tokens, temperature),
+            estimate_tokens(prompt, user_message, context, max_tokens)
+        )
 
-        if context:
-            messages.extend(context)
+    async def acall(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        if self.scheduler is not None:
+            # the scheduler blocks while waiting for quota or backoff, keep it off the event loop
+            return await super().acall(prompt, user_message, context, max_tokens, temperature)
 
-        messages.append(
-            {
-                "role": "user",
-                "content": user_message,
-            }
-        )
+        with self._request_metrics():
+            try:
+                completion = await self.async_client.chat.completions.create(
+                    model=self.model,
+                    messages=self.build_messages(prompt, user_message, context),
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                )
+            except openai.OpenAIError as e:
+                raise self._provider_error(e) from e
 
-        completion = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature,
+        self._record_usage(completion)
+        return completion.choices[0].message.content
+
+    def stream(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> Iterator[str]:
+        messages = self.build_messages(prompt, user_message, context)
+        chunks = self._execute(
+            lambda: self._open_stream(messages, max_tokens, temperature),
+            estimate_tokens(prompt, user_message, context, max_tokens)
         )
 
-        return completion.choices[0].message.content
+        self.last_usage = None
+        try:
+            for chunk in chunks:
+                if chunk.usage is not None:
+                    self._record_usage(chunk)
+                text = self._chunk_text(chunk)
+                if text:
+                    yield text
+        except openai.OpenAIError as e:
+            raise self._provider_error(e) from e
+
+    async def astream(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> AsyncIterator[str]:
+        if self.scheduler is not None:
+            async for text in super().astream(prompt, user_message, context, max_tokens, temperature):
+                yield text
+            return
+
+        self.last_usage = None
+        try:
+            with self._request_metrics():
+                chunks = await self.async_client.chat.completions.create(
+                    model=self.model,
+                    messages=self.build_messages(prompt, user_message, context),
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+            async for chunk in chunks:
+                if chunk.usage is not None:
+                    self._record_usage(chunk)
+                text = self._chunk_text(chunk)
+                if text:
+                    yield text
+        except openai.OpenAIError as e:
+            raise self._provider_error(e) from e
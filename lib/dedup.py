@@ -0,0 +1,215 @@
+import csv
+import dataclasses
+import hashlib
+import random
+import re
+from typing import List, Dict, Optional, Tuple, Set, Hashable, TextIO
+
+from lib.constants import SPECIAL_MARK
+from lib.parser import NotebookCell, normalize_text
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_MASK64 = (1 << 64) - 1
+
+
+def submission_name(key: Hashable) -> str:
+    """
+    "path#task" for a (notebook path, 0-based task index) key.
+    """
+    if isinstance(key, tuple) and len(key) == 2:
+        return f"{key[0]}#{key[1] + 1}"
+    return str(key)
+
+
+def changed_text(cells: List[NotebookCell]) -> str:
+    """
+    Normalized text of the cells changed by the student, the part that differs between submissions.
+    """
+    return "\n".join(
+        normalize_text(cell.raw_text.replace(SPECIAL_MARK, "")) for cell in cells if cell.is_changed
+    )
+
+
+def _hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def shingles(text: str, size: int = 5) -> Set[int]:
+    """
+    Hashes of all runs of `size` consecutive tokens (words and punctuation), case-insensitive.
+    """
+    tokens = _TOKEN_RE.findall(text.lower())
+    if len(tokens) <= size:
+        return {_hash64(" ".join(tokens))} if tokens else set()
+    return {_hash64(" ".join(tokens[i:i + size])) for i in range(len(tokens) - size + 1)}
+
+
+class MinHasher:
+    """
+    One-permutation MinHash: a single pass puts every shingle hash into one of `num_perm` bins by its low bits
+    and keeps the minimum of each bin, empty bins borrow the value of the next non-empty one ("rotation
+    densification"). Like classic MinHash, the share of equal positions of two signatures estimates
+    the Jaccard similarity of the shingle sets, at the cost of one hash function instead of `num_perm`.
+    """
+
+    def __init__(self, num_perm: int = 128, seed: int = 1) -> None:
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self._salt = rng.getrandbits(64)
+        self._multiplier = rng.getrandbits(64) | 1
+
+    def signature(self, hashes: Set[int]) -> Tuple[int, ...]:
+        num_perm, salt, multiplier = self.num_perm, self._salt, self._multiplier
+        empty = 1 << 64
+        bins = [empty] * num_perm
+        for x in hashes:
+            x = ((x ^ salt) * multiplier) & _MASK64
+            position, value = x % num_perm, x // num_perm
+            if value < bins[position]:
+                bins[position] = value
+
+        if len(hashes) >= num_perm and empty not in bins:
+            return tuple(bins)
+
+        filled = [i for i, value in enumerate(bins) if value != empty]
+        if not filled:
+            return tuple(bins)
+        signature = list(bins)
+        for i in range(num_perm):
+            if bins[i] == empty:
+                # the nearest non-empty bin to the right, the distance keeps borrowed values apart from real ones
+                j = next((k for k in filled if k > i), filled[0])
+                distance = (j - i) % num_perm
+                signature[i] = bins[j] + distance * empty
+        return tuple(signature)
+
+    @staticmethod
+    def similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+        return sum(x == y for x, y in zip(first, second)) / len(first)
+
+
+def lsh_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    (bands, rows) such that pairs around `threshold` similarity become candidates. Candidates are verified
+    against the signatures, so the bands aim a bit lower: it only costs comparisons, while aiming higher misses pairs.
+    """
+    target = threshold * 0.9
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if abs((1 / bands) ** (1 / rows) - target) < abs((1 / best[0]) ** (1 / best[1]) - target):
+            best = (bands, rows)
+    return best
+
+
+@dataclasses.dataclass
+class DuplicateGroup:
+    representative: Hashable
+    # including the representative, in the order of addition
+    members: List[Hashable]
+    # estimated similarity of the changed text of every member to the representative's one
+    similarity: Dict[Hashable, float]
+    # hash of the changed text of every member
+    digests: Dict[Hashable, str]
+
+    @property
+    def exact(self) -> bool:
+        """
+        All members changed the notebook identically.
+        """
+        return len(set(self.digests.values())) == 1
+
+
+class DedupIndex:
+    """
+    Groups task submissions by the text the student changed. Exact copies are found by hash, near-duplicates
+    (estimated Jaccard similarity of token shingles at least `threshold`) by MinHash LSH; `threshold=1.0`
+    groups exact copies only.
+
+    Every submission either starts a new group or joins the most similar group representative, so each member
+    is close to its representative, not just to some other member. Keys are usually (notebook path, task index).
+    Only submissions of the same `scope` are compared, e.g. answers to the same task reviewed the same way.
+    """
+
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, shingle_size: int = 5, seed: int = 1) -> None:
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError(f"threshold must be in (0, 1], got {threshold}")
+
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm, seed)
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+
+        # (scope, text digest) -> (representative, similarity to it)
+        self._by_digest: Dict[Tuple[Hashable, str], Tuple[Hashable, float]] = {}
+        # (scope, band) -> keys
+        self._buckets: List[Dict[Tuple[Hashable, Tuple[int, ...]], List[Hashable]]] = [{} for _ in range(self.bands)]
+        self._signatures: Dict[Hashable, Tuple[int, ...]] = {}
+        self._groups: Dict[Hashable, DuplicateGroup] = {}
+        self._representative: Dict[Hashable, Hashable] = {}
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, ...]]:
+        return [signature[i * self.rows:(i + 1) * self.rows] for i in range(self.bands)]
+
+    def _most_similar(self, signature: Tuple[int, ...], scope: Hashable) -> Tuple[Optional[Hashable], float]:
+        candidates = set()
+        for bucket, band in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(bucket.get((scope, band), ()))
+
+        best, best_similarity = None, 0.0
+        for candidate in candidates:
+            similarity = self.hasher.similarity(signature, self._signatures[candidate])
+            if similarity > best_similarity:
+                best, best_similarity = candidate, similarity
+        return best, best_similarity
+
+    def add(self, key: Hashable, cells: List[NotebookCell], scope: Hashable = None) -> Hashable:
+        """
+        Index a submission, returns the key of its group representative (`key` itself for a new group).
+        """
+        text = changed_text(cells)
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+        representative, similarity = self._by_digest.get((scope, digest), (None, 0.0))
+        if representative is None and self.threshold < 1.0 and text:
+            signature = self.hasher.signature(shingles(text, self.shingle_size))
+            representative, similarity = self._most_similar(signature, scope)
+            if similarity < self.threshold:
+                representative = None
+                self._signatures[key] = signature
+                for bucket, band in zip(self._buckets, self._band_keys(signature)):
+                    bucket.setdefault((scope, band), []).append(key)
+
+        if representative is None:
+            representative, similarity = key, 1.0
+            self._groups[key] = DuplicateGroup(key, [], {}, {})
+        self._by_digest.setdefault((scope, digest), (representative, similarity))
+
+        group = self._groups[representative]
+        group.members.append(key)
+        group.similarity[key] = similarity
+        group.digests[key] = digest
+        self._representative[key] = representative
+        return representative
+
+    def representative(self, key: Hashable) -> Hashable:
+        return self._representative[key]
+
+    def groups(self, min_size: int = 2) -> List[DuplicateGroup]:
+        return [group for group in self._groups.values() if len(group.members) >= min_size]
+
+    def write_report(self, file: TextIO, min_size: int = 2) -> int:
+        """
+        CSV with a row per member of every group of at least `min_size` submissions, e.g. for plagiarism checks.
+        Returns the number of groups written.
+        """
+        writer = csv.writer(file)
+        writer.writerow(["group", "representative", "submission", "similarity", "exact"])
+        groups = self.groups(min_size)
+        for number, group in enumerate(groups, start=1):
+            for member in group.members:
+                writer.writerow([
+                    number, submission_name(group.representative), submission_name(member),
+                    f"{group.similarity[member]:.3f}", group.exact
+                ])
+        return len(groups)
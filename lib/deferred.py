@@ -0,0 +1,274 @@
+import asyncio
+import dataclasses
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Optional, NamedTuple, Tuple
+
+from lib import metrics
+from lib.clients import BaseClient, YandexGPTClient
+from lib.scheduler import ProviderError
+
+
+class DeferredCompletion(NamedTuple):
+    text: str
+    # as `BaseClient.last_usage`
+    usage: Optional[Dict[str, int]]
+
+
+@dataclasses.dataclass
+class PollPolicy:
+    """
+    An operation is first polled shortly before the typical completion time seen so far (at least `initial_delay`),
+    then with intervals growing from `initial_delay` `backoff` times up to `max_delay`.
+    A round polls at most `batch_size` due operations, `workers` at a time.
+    An operation that isn't done `timeout` seconds after submission fails.
+    """
+    initial_delay: float = 1.0
+    max_delay: float = 30.0
+    backoff: float = 1.5
+    batch_size: int = 100
+    workers: int = 8
+    timeout: float = 6 * 3600.0
+
+
+@dataclasses.dataclass
+class DeferredStats:
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    polls: int = 0
+
+
+@dataclasses.dataclass
+class _Operation:
+    id: str
+    future: "Future[DeferredCompletion]"
+    submitted_at: float
+    # interval before the next poll after an unfinished one
+    delay: float
+
+
+class DeferredCompletions:
+    """
+    Deferred (`completionAsync`) completions of YandexGPT: `submit` starts an operation and returns a future,
+    a background thread keeps the table of pending operations and polls the due ones in batches,
+    completing each future as soon as its operation is done.
+
+    Submissions and polls go through the client's scheduler (rate limits, backoff on 429),
+    a poll that still fails with a retryable error is repeated later.
+    """
+
+    def __init__(self, client: YandexGPTClient, policy: Optional[PollPolicy] = None) -> None:
+        self.client = client
+        self.policy = policy or PollPolicy()
+        self.stats = DeferredStats()
+
+        self._condition = threading.Condition()
+        self._pending: Dict[str, _Operation] = {}
+        # (time of the next poll, sequence number for ties, operation id)
+        self._schedule: List[Tuple[float, int, str]] = []
+        self._sequence = itertools.count()
+        # exponentially weighted mean time from submission to a finished operation
+        self._typical_duration: Optional[float] = None
+        self._closed = False
+
+        self._executor = ThreadPoolExecutor(max_workers=self.policy.workers, thread_name_prefix="operation-poll")
+        self._thread = threading.Thread(target=self._poll_loop, name="operation-poller", daemon=True)
+        self._thread.start()
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def submit(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> "Future[DeferredCompletion]":
+        """
+        Failures to start the operation are raised here, failures of the operation itself go to the future.
+        The future fails if the completions are closed before the operation is started or while it is.
+        """
+        future: "Future[DeferredCompletion]" = Future()
+        with self._condition:
+            if self._closed:
+                future.set_exception(RuntimeError("Deferred completions are closed"))
+                return future
+
+        operation_id = self.client.submit_completion(prompt, user_message, context, max_tokens, temperature)
+
+        now = time.monotonic()
+        with self._condition:
+            if self._closed:
+                # nobody polls the operation any more, as with the operations pending at `close`
+                future.set_exception(RuntimeError("Deferred completions were closed while the operation started"))
+                return future
+
+            first_delay = self.policy.initial_delay
+            if self._typical_duration is not None:
+                # a bit early: completion is only seen when polled, so polling late would only raise the estimate
+                first_delay = min(max(first_delay, 0.8 * self._typical_duration), self.policy.max_delay)
+
+            self._pending[operation_id] = _Operation(operation_id, future, now, self.policy.initial_delay)
+            heapq.heappush(self._schedule, (now + first_delay, next(self._sequence), operation_id))
+            self.stats.submitted += 1
+            self._condition.notify()
+        return future
+
+    def _poll_loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed:
+                    now = time.monotonic()
+                    if self._schedule and self._schedule[0][0] <= now:
+                        break
+                    self._condition.wait(self._schedule[0][0] - now if self._schedule else None)
+                if self._closed:
+                    return
+
+                due = []
+                while self._schedule and self._schedule[0][0] <= now and len(due) < self.policy.batch_size:
+                    _, _, operation_id = heapq.heappop(self._schedule)
+                    due.append(self._pending[operation_id])
+                self.stats.polls += len(due)
+
+            metrics.inc("deferred_polls_total", len(due))
+            # the round is over when all its polls are, so a slow poll delays the next round only
+            list(self._executor.map(self._poll, due))
+
+    def _poll(self, operation: _Operation) -> None:
+        try:
+            result = self.client.operation_result(self.client.get_operation(operation.id))
+        except ProviderError as e:
+            if e.retryable:
+                self._reschedule(operation)
+            else:
+                self._finish(operation, error=e)
+            return
+        except Exception as e:
+            self._finish(operation, error=e)
+            return
+
+        if result is not None:
+            self._finish(operation, DeferredCompletion(*result))
+        elif time.monotonic() - operation.submitted_at >= self.policy.timeout:
+            self._finish(operation, error=TimeoutError(f"Operation {operation.id} isn't done after timeout"))
+        else:
+            self._reschedule(operation)
+
+    def _reschedule(self, operation: _Operation) -> None:
+        with self._condition:
+            if self._closed:
+                return
+            heapq.heappush(
+                self._schedule, (time.monotonic() + operation.delay, next(self._sequence), operation.id)
+            )
+            operation.delay = min(operation.delay * self.policy.backoff, self.policy.max_delay)
+
+    def _finish(
+            self,
+            operation: _Operation,
+            result: Optional[DeferredCompletion] = None,
+            error: Optional[BaseException] = None
+    ) -> None:
+        duration = time.monotonic() - operation.submitted_at
+        with self._condition:
+            if self._pending.pop(operation.id, None) is None:
+                # failed by `close`
+                return
+            if error is None:
+                self.stats.completed += 1
+                self._typical_duration = duration if self._typical_duration is None else (
+                    0.8 * self._typical_duration + 0.2 * duration
+                )
+            else:
+                self.stats.failed += 1
+
+        metrics.observe("deferred_operation_seconds", duration)
+        metrics.inc("deferred_operations_total", status="done" if error is None else type(error).__name__)
+        if error is None:
+            operation.future.set_result(result)
+        else:
+            operation.future.set_exception(error)
+
+    def close(self) -> None:
+        """
+        Stop polling, futures of unfinished operations fail.
+        """
+        with self._condition:
+            self._closed = True
+            pending, self._pending = list(self._pending.values()), {}
+            self._schedule = []
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown()
+        for operation in pending:
+            operation.future.set_exception(RuntimeError(f"Deferred completions were closed before {operation.id}"))
+
+
+class DeferredClient(BaseClient):
+    """
+    YandexGPT in the deferred mode behind the usual client interface: `call` submits an operation
+    and blocks until the poller delivers its result, so the reviewers work unchanged.
+    Run many reviews at once (e.g. `BatchGrader` with a large `max_concurrency`) to keep many operations in flight.
+    """
+    provider = "yandex-deferred"
+    message_key = "text"
+
+    def __init__(self, client: YandexGPTClient, policy: Optional[PollPolicy] = None) -> None:
+        super().__init__(api_key=None)
+        self.client = client
+        self.completions = DeferredCompletions(client, policy)
+
+    @property
+    def model_name(self) -> str:
+        # the same model answers, so cached responses are shared with the synchronous mode
+        return self.client.model_name
+
+    def submit(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> "Future[DeferredCompletion]":
+        return self.completions.submit(prompt, user_message, context, max_tokens, temperature)
+
+    def call(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        completion = self.submit(prompt, user_message, context, max_tokens, temperature).result()
+        self.last_usage = completion.usage
+        return completion.text
+
+    async def acall(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        """
+        Waits for the operation without holding a thread, only the submission runs in one.
+        """
+        future = await asyncio.to_thread(self.submit, prompt, user_message, context, max_tokens, temperature)
+        completion = await asyncio.wrap_future(future)
+        self.last_usage = completion.usage
+        return completion.text
+
+    def close(self) -> None:
+        self.completions.close()
+        self.client.close()
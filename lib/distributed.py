@@ -0,0 +1,573 @@
+import collections
+import contextlib
+import dataclasses
+import enum
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple
+
+from lib import metrics
+from lib.batch import ReviewJob, JobResult
+from lib.journal import file_hash
+from lib.parser import NotebookCell, MergeKind, NotebookLoader, DiffMode, parsing_pipeline
+from lib.results import ReviewResult
+
+
+class JobStatus(enum.Enum):
+    # waiting for a worker
+    PENDING = 1
+
+    # held by a worker until the lease expires, an expired lease may be taken by another worker
+    LEASED = 2
+
+    DONE = 3
+
+    # failed on every attempt
+    FAILED = 4
+
+
+@dataclasses.dataclass
+class QueuedJob:
+    notebook_path: str
+    task_index: int
+    # name the workers know the reviewer by, e.g. "full"
+    reviewer: str
+    id: Optional[int] = None
+    # leases taken, including the current one
+    attempts: int = 0
+
+
+@dataclasses.dataclass
+class FinishedJob:
+    # position in the stream of finished jobs, see `JobQueue.finished`
+    sequence: int
+    job: QueuedJob
+    result: Optional[ReviewResult] = None
+    # repr of the error of the last attempt, if the job failed
+    error: Optional[str] = None
+    worker: Optional[str] = None
+
+
+class JobQueue:
+    """
+    Queue of (notebook, task, reviewer) jobs shared by a `Coordinator` and `Worker`s on any number of hosts.
+
+    A worker leases jobs for `lease_seconds` and prolongs its leases with heartbeats, a job whose lease
+    expired (the worker died or hung) is leased again by another worker. Finished jobs form a stream
+    the coordinator follows with `finished`.
+    """
+
+    def settings(self) -> Dict[str, object]:
+        """
+        Parsing settings of the jobs, empty until a coordinator sets them.
+        """
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def set_settings(self, settings: Dict[str, object]) -> None:
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def put(self, jobs: Iterable[QueuedJob]) -> int:
+        """
+        Add the jobs the queue doesn't have yet, returns their number.
+        """
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def requeue_failed(self) -> int:
+        """
+        Give failed jobs another `max_attempts`, their failures are removed from the stream.
+        """
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def lease(self, worker: str, count: int, lease_seconds: float) -> List[QueuedJob]:
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def heartbeat(self, worker: str, job_ids: Iterable[int], lease_seconds: float) -> int:
+        """
+        Prolong the leases of `job_ids` the worker still holds, returns their number.
+        """
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def release(self, worker: str) -> int:
+        """
+        Return the jobs leased by a worker that is shutting down to the queue, the attempts are not counted.
+        """
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def complete(self, worker: str, job_id: int, result: ReviewResult) -> bool:
+        """
+        Returns False if the worker no longer holds the job, e.g. its lease expired and was taken over.
+        """
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def fail(self, worker: str, job_id: int, error: str, retry: bool = True) -> bool:
+        """
+        A job failed `max_attempts` times (or with `retry=False`) is finished, otherwise it is leased again.
+        Returns False if the worker no longer holds the job.
+        """
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def finished(self, after: int = 0, limit: int = 1000) -> List[FinishedJob]:
+        """
+        Jobs finished after the `after` position of the stream, in the order they finished.
+        """
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def counts(self) -> Dict[JobStatus, int]:
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def unfinished_count(self) -> int:
+        counts = self.counts()
+        return counts[JobStatus.PENDING] + counts[JobStatus.LEASED]
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    `JobQueue` in an SQLite file: every process opens the file itself and SQLite file locks serialize the updates.
+    Fits workers on one host or a reliable shared disk, leases are compared with the wall clock of the workers,
+    so their clocks must agree to well within `lease_seconds`.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3, timeout: float = 30.0) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY, notebook_path TEXT NOT NULL, task_index INTEGER NOT NULL, "
+                "reviewer TEXT NOT NULL, status INTEGER NOT NULL, worker TEXT, lease_expires REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, UNIQUE (notebook_path, task_index, reviewer))"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS finished ("
+                "sequence INTEGER PRIMARY KEY AUTOINCREMENT, job_id INTEGER NOT NULL, worker TEXT, "
+                "result TEXT, error TEXT)"
+            )
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock at once, so two workers can't lease the same job
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def settings(self) -> Dict[str, object]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM settings WHERE key = 'settings'").fetchone()
+        return json.loads(row[0]) if row is not None else {}
+
+    def set_settings(self, settings: Dict[str, object]) -> None:
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('settings', ?)",
+                (json.dumps(settings, ensure_ascii=False),)
+            )
+
+    def put(self, jobs: Iterable[QueuedJob]) -> int:
+        with self._transaction() as db:
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO jobs (notebook_path, task_index, reviewer, status) VALUES (?, ?, ?, ?)",
+                ((job.notebook_path, job.task_index, job.reviewer, JobStatus.PENDING.value) for job in jobs)
+            )
+            return db.total_changes - before
+
+    def requeue_failed(self) -> int:
+        with self._transaction() as db:
+            db.execute(
+                "DELETE FROM finished WHERE job_id IN (SELECT id FROM jobs WHERE status = ?)",
+                (JobStatus.FAILED.value,)
+            )
+            return db.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, attempts = 0 WHERE status = ?",
+                (JobStatus.PENDING.value, JobStatus.FAILED.value)
+            ).rowcount
+
+    def lease(self, worker: str, count: int, lease_seconds: float) -> List[QueuedJob]:
+        now = time.time()
+        with self._transaction() as db:
+            # a job whose every lease expired is likely to kill or hang any worker
+            exhausted = db.execute(
+                "SELECT id, worker, attempts FROM jobs WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (JobStatus.LEASED.value, now, self.max_attempts)
+            ).fetchall()
+            for job_id, last_worker, attempts in exhausted:
+                self._finish(db, job_id, last_worker, error=f"Lease expired {attempts} times, last by {last_worker}")
+
+            rows = db.execute(
+                "SELECT id, notebook_path, task_index, reviewer, attempts FROM jobs "
+                "WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT ?",
+                (JobStatus.PENDING.value, JobStatus.LEASED.value, now, count)
+            ).fetchall()
+            db.executemany(
+                "UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(JobStatus.LEASED.value, worker, now + lease_seconds, row[0]) for row in rows]
+            )
+        return [QueuedJob(path, task_index, reviewer, job_id, attempts + 1)
+                for job_id, path, task_index, reviewer, attempts in rows]
+
+    def heartbeat(self, worker: str, job_ids: Iterable[int], lease_seconds: float) -> int:
+        lease_expires = time.time() + lease_seconds
+        with self._transaction() as db:
+            return db.executemany(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = ? AND worker = ?",
+                [(lease_expires, job_id, JobStatus.LEASED.value, worker) for job_id in job_ids]
+            ).rowcount
+
+    def release(self, worker: str) -> int:
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, attempts = attempts - 1 "
+                "WHERE status = ? AND worker = ?",
+                (JobStatus.PENDING.value, JobStatus.LEASED.value, worker)
+            ).rowcount
+
+    @staticmethod
+    def _finish(
+            db: sqlite3.Connection,
+            job_id: int,
+            worker: Optional[str],
+            result: Optional[ReviewResult] = None,
+            error: Optional[str] = None
+    ) -> None:
+        status = JobStatus.DONE if error is None else JobStatus.FAILED
+        db.execute(
+            "UPDATE jobs SET status = ?, worker = ?, lease_expires = NULL WHERE id = ?",
+            (status.value, worker, job_id)
+        )
+        db.execute(
+            "INSERT INTO finished (job_id, worker, result, error) VALUES (?, ?, ?, ?)",
+            (job_id, worker, None if result is None else json.dumps(result.to_dict(), ensure_ascii=False), error)
+        )
+
+    def complete(self, worker: str, job_id: int, result: ReviewResult) -> bool:
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT 1 FROM jobs WHERE id = ? AND status = ? AND worker = ?",
+                (job_id, JobStatus.LEASED.value, worker)
+            ).fetchone()
+            if row is None:
+                return False
+            self._finish(db, job_id, worker, result=result)
+            return True
+
+    def fail(self, worker: str, job_id: int, error: str, retry: bool = True) -> bool:
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT attempts FROM jobs WHERE id = ? AND status = ? AND worker = ?",
+                (job_id, JobStatus.LEASED.value, worker)
+            ).fetchone()
+            if row is None:
+                return False
+            if retry and row[0] < self.max_attempts:
+                db.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL WHERE id = ?",
+                    (JobStatus.PENDING.value, job_id)
+                )
+            else:
+                self._finish(db, job_id, worker, error=error)
+            return True
+
+    def finished(self, after: int = 0, limit: int = 1000) -> List[FinishedJob]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT f.sequence, j.id, j.notebook_path, j.task_index, j.reviewer, j.attempts, "
+                "f.result, f.error, f.worker FROM finished f JOIN jobs j ON j.id = f.job_id "
+                "WHERE f.sequence > ? ORDER BY f.sequence LIMIT ?",
+                (after, limit)
+            ).fetchall()
+        return [
+            FinishedJob(
+                sequence, QueuedJob(path, task_index, reviewer, job_id, attempts),
+                None if result is None else ReviewResult.from_dict(json.loads(result)), error, worker
+            )
+            for sequence, job_id, path, task_index, reviewer, attempts, result, error, worker in rows
+        ]
+
+    def last_sequence(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(MAX(sequence), 0) FROM finished").fetchone()[0]
+
+    def counts(self) -> Dict[JobStatus, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in JobStatus}
+        counts.update((JobStatus(status), count) for status, count in rows)
+        return counts
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class Coordinator:
+    """
+    Fills the queue with the (notebook, task) jobs of a cohort and follows their results.
+    Notebooks are parsed by the workers, so the paths of the notebooks and of the original notebook
+    must be valid on every host. A coordinator restarted on the same queue adds only new notebooks,
+    retries failed jobs and streams all results again, the earlier ones marked as resumed.
+    """
+
+    def __init__(
+            self,
+            queue: JobQueue,
+            original_notebook_path: str,
+            kind: MergeKind,
+            tasks_count: int,
+            reviewer: str = "full",
+            task_indices: Optional[Iterable[int]] = None,
+            loader: NotebookLoader = NotebookLoader.FAST,
+            diff_mode: DiffMode = DiffMode.EXACT
+    ) -> None:
+        self.queue = queue
+        self.original_notebook_path = original_notebook_path
+        self.kind = kind
+        self.tasks_count = tasks_count
+        self.reviewer = reviewer
+        self.task_indices = list(range(tasks_count) if task_indices is None else task_indices)
+        self.loader = loader
+        self.diff_mode = diff_mode
+        # results up to this position of the stream were there before `submit`
+        self._resumed_until = 0
+
+    def _settings(self) -> Dict[str, object]:
+        return {
+            "original": self.original_notebook_path,
+            "original_hash": file_hash(self.original_notebook_path),
+            "kind": self.kind.name,
+            "tasks_count": self.tasks_count,
+            "loader": self.loader.name,
+            "diff_mode": self.diff_mode.name,
+        }
+
+    def submit(self, notebook_paths: Iterable[str]) -> int:
+        """
+        Returns the number of new jobs.
+        """
+        settings = self._settings()
+        current = self.queue.settings()
+        if current and current != settings:
+            raise ValueError(f"The queue holds jobs parsed with other settings, use a new queue: {current}")
+        if not current:
+            self.queue.set_settings(settings)
+
+        self.queue.requeue_failed()
+        self._resumed_until = self.queue.last_sequence()
+        # the tasks of a notebook are next to each other, so a worker likely parses it once
+        return self.queue.put(
+            QueuedJob(path, j, self.reviewer) for path in sorted(notebook_paths) for j in self.task_indices
+        )
+
+    def _job_result(self, finished: FinishedJob) -> JobResult:
+        review = finished.result
+        job = ReviewJob(
+            finished.job.notebook_path, finished.job.task_index, [], review.max_score if review else None
+        )
+        resumed = finished.sequence <= self._resumed_until
+        if review is not None:
+            return JobResult(job, review=review, resumed=resumed)
+        return JobResult(job, error=RuntimeError(finished.error), resumed=resumed)
+
+    def iter_results(self, poll_interval: float = 1.0, stop: Optional[threading.Event] = None) -> Iterator[JobResult]:
+        """
+        Yields results in the order the jobs finish until no job is left or `stop` is set.
+        """
+        stop = stop or threading.Event()
+        after = 0
+        while True:
+            # counted first: a job finished after the count is still read below
+            unfinished = self.queue.unfinished_count()
+            batch = self.queue.finished(after)
+            for finished in batch:
+                after = finished.sequence
+                yield self._job_result(finished)
+            if batch:
+                continue
+            if not unfinished or stop.wait(poll_interval):
+                return
+
+
+@dataclasses.dataclass
+class WorkerStats:
+    leased: int = 0
+    completed: int = 0
+    failed: int = 0
+    # finished after the lease was lost, the result was dropped
+    lost: int = 0
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Worker:
+    """
+    Leases jobs from the queue one at a time in each of `concurrency` threads, parses the notebooks
+    and reviews the tasks with `reviewers` (name -> reviewer, see `QueuedJob.reviewer`), which use
+    the clients and credentials of this host. Leases are prolonged every `lease_seconds / 3` seconds,
+    but only for `max_job_seconds` after a job is leased: a review hung for longer loses its lease
+    and the job is leased by another worker.
+
+    Parsed notebooks are kept for the `parsed_cache` most recent paths, as the tasks of a notebook
+    are leased one after another. Failed reviews are retried up to the queue's `max_attempts`,
+    possibly by other workers, notebooks that can't be parsed fail at once.
+    """
+
+    def __init__(
+            self,
+            queue: JobQueue,
+            reviewers: Dict[str, object],
+            concurrency: int = 8,
+            worker_id: Optional[str] = None,
+            lease_seconds: float = 60.0,
+            poll_interval: float = 1.0,
+            parsed_cache: int = 64,
+            max_job_seconds: float = 1800.0
+    ) -> None:
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be positive, got {concurrency}")
+
+        self.queue = queue
+        self.reviewers = reviewers
+        self.concurrency = concurrency
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.parsed_cache = parsed_cache
+        self.max_job_seconds = max_job_seconds
+        self.stats = WorkerStats()
+
+        self._lock = threading.Lock()
+        # job id -> time.monotonic() when it was leased, of the jobs in progress
+        self._in_progress: Dict[int, float] = {}
+        self._settings: Dict[str, object] = {}
+        self._parsed: "collections.OrderedDict[str, Future]" = collections.OrderedDict()
+
+    def _parse(self, path: str) -> Tuple[List[List[NotebookCell]], List[Optional[int]]]:
+        with self._lock:
+            future = self._parsed.get(path)
+            parse = future is None
+            if parse:
+                future = self._parsed[path] = Future()
+                if len(self._parsed) > self.parsed_cache:
+                    self._parsed.popitem(last=False)
+            else:
+                self._parsed.move_to_end(path)
+
+        # other threads wait for the notebook parsed by the first one
+        if parse:
+            settings = self._settings
+            try:
+                future.set_result(parsing_pipeline(
+                    path, settings["original"], MergeKind[settings["kind"]], settings["tasks_count"],
+                    loader=NotebookLoader[settings["loader"]], diff_mode=DiffMode[settings["diff_mode"]]
+                ))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def _record(self, status: str) -> None:
+        with self._lock:
+            setattr(self.stats, status, getattr(self.stats, status) + 1)
+        metrics.inc("distributed_jobs_total", status=status)
+
+    def _process(self, job: QueuedJob) -> None:
+        reviewer = self.reviewers.get(job.reviewer)
+        if reviewer is None:
+            self.queue.fail(self.worker_id, job.id, f"Unsupported reviewer: {job.reviewer}", retry=False)
+            self._record("failed")
+            return
+
+        try:
+            tasks, marks = self._parse(job.notebook_path)
+            cells, maximum_possible_score = tasks[job.task_index], marks[job.task_index]
+        except Exception as e:
+            self.queue.fail(self.worker_id, job.id, repr(e), retry=False)
+            self._record("failed")
+            return
+
+        try:
+            review = reviewer.review(cells, maximum_possible_score)
+        except Exception as e:
+            self.queue.fail(self.worker_id, job.id, repr(e))
+            self._record("failed")
+            return
+
+        self._record("completed" if self.queue.complete(self.worker_id, job.id, review) else "lost")
+
+    def _work(self, stop: threading.Event, wait: bool) -> None:
+        while not stop.is_set():
+            if not self._settings:
+                self._settings = self.queue.settings()
+            jobs = self.queue.lease(self.worker_id, 1, self.lease_seconds) if self._settings else []
+            if not jobs:
+                # leases of other workers may still expire, so the worker stays until every job is finished
+                if not wait and self._settings and not self.queue.unfinished_count():
+                    return
+                stop.wait(self.poll_interval)
+                continue
+
+            self._record("leased")
+            with self._lock:
+                self._in_progress[jobs[0].id] = time.monotonic()
+            try:
+                self._process(jobs[0])
+            finally:
+                with self._lock:
+                    del self._in_progress[jobs[0].id]
+
+    def _heartbeat(self, stop: threading.Event) -> None:
+        while not stop.wait(self.lease_seconds / 3):
+            now = time.monotonic()
+            with self._lock:
+                job_ids = [job_id for job_id, leased_at in self._in_progress.items()
+                           if now - leased_at < self.max_job_seconds]
+            if job_ids:
+                self.queue.heartbeat(self.worker_id, job_ids, self.lease_seconds)
+
+    def run(self, stop: Optional[threading.Event] = None, wait: bool = False) -> WorkerStats:
+        """
+        Work until the queue has no unfinished jobs, or with `wait` until `stop` is set.
+        On interruption the jobs in progress are released to other workers.
+        """
+        stop = stop or threading.Event()
+        done = threading.Event()
+        threads = [
+            threading.Thread(target=self._work, args=(stop, wait), name=f"worker-{i}", daemon=True)
+            for i in range(self.concurrency)
+        ]
+        heartbeat = threading.Thread(target=self._heartbeat, args=(done,), name="worker-heartbeat", daemon=True)
+        for thread in threads:
+            thread.start()
+        heartbeat.start()
+
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            stop.set()
+            self.queue.release(self.worker_id)
+            raise
+        finally:
+            done.set()
+            heartbeat.join()
+        return self.stats
@@ -0,0 +1,235 @@
+import csv
+import enum
+import os
+import threading
+import time
+from typing import List, Dict, Optional, Iterable
+
+from openpyxl import Workbook
+
+from lib import metrics
+from lib.batch import JobResult
+from lib.dedup import submission_name
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS = [
+    "notebook", "task", "score", "max_score", "comments", "error",
+    "latency", "input_tokens", "completion_tokens", "cache_hit", "resumed", "duplicate_of",
+]
+
+
+class ExportFormat(enum.Enum):
+    # openpyxl write-only workbook, written to disk on close
+    XLSX = 1
+
+    CSV = 2
+
+    # requires `pyarrow`, every flush writes a row group
+    PARQUET = 3
+
+
+_EXTENSIONS = {".xlsx": ExportFormat.XLSX, ".csv": ExportFormat.CSV, ".parquet": ExportFormat.PARQUET}
+
+
+def result_row(result: JobResult) -> Dict[str, object]:
+    review = result.review
+    return {
+        "notebook": result.job.notebook_path,
+        # 1-based, as in the notebooks
+        "task": result.job.task_index + 1,
+        "score": review.score if review else None,
+        "max_score": review.max_score if review else result.job.maximum_possible_score,
+        "comments": "\n".join(review.comments) if review else None,
+        "error": None if result.ok else repr(result.error),
+        "latency": review.latency if review else None,
+        "input_tokens": review.input_tokens if review else None,
+        "completion_tokens": review.completion_tokens if review else None,
+        "cache_hit": review.cache_hit if review else None,
+        "resumed": result.resumed,
+        "duplicate_of": None if result.duplicate_of is None else submission_name(result.duplicate_of),
+    }
+
+
+class ResultWriter:
+    """
+    Writes results one by one as they arrive. Buffered rows are flushed every `flush_rows` rows
+    or `flush_interval` seconds, whichever comes first, the interval is kept by a background thread
+    even if no more rows arrive.
+    """
+
+    def __init__(self, path: str, flush_rows: int = 50, flush_interval: float = 30.0) -> None:
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+
+        # the rows are written by the caller and flushed by the timer thread too
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._pending = 0
+        self._flushed_at = time.monotonic()
+
+        self._thread: Optional[threading.Thread] = None
+        # with no interval every write is flushed anyway
+        if flush_interval > 0:
+            self._thread = threading.Thread(target=self._flush_loop, name="export-flush", daemon=True)
+            self._thread.start()
+
+    def write(self, result: JobResult) -> None:
+        with self._lock:
+            with metrics.timer("export_seconds", writer=type(self).__name__, operation="write"):
+                self._write_row(result_row(result))
+            self.rows_written += 1
+            self._pending += 1
+            if self._pending >= self.flush_rows or time.monotonic() - self._flushed_at >= self.flush_interval:
+                self.flush()
+
+    def write_all(self, results: Iterable[JobResult]) -> int:
+        for result in results:
+            self.write(result)
+        return self.rows_written
+
+    def flush(self) -> None:
+        with self._lock:
+            with metrics.timer("export_seconds", writer=type(self).__name__, operation="flush"):
+                self._flush()
+            self._pending = 0
+            self._flushed_at = time.monotonic()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(max(self._flushed_at + self.flush_interval - time.monotonic(), 0.0)):
+            with self._lock:
+                if self._stop.is_set():
+                    return
+                if time.monotonic() - self._flushed_at < self.flush_interval:
+                    # flushed by a write meanwhile
+                    continue
+                if self._pending:
+                    self.flush()
+                else:
+                    self._flushed_at = time.monotonic()
+
+    def _write_row(self, row: Dict[str, object]) -> None:
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def _flush(self) -> None:
+        pass
+
+    def _close(self) -> None:
+        raise NotImplementedError("It's base class, you can't call this method")
+
+    def close(self) -> None:
+        self._stop.set()
+        with self._lock:
+            self._close()
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        # an .xlsx workbook is written here
+        with metrics.timer("export_seconds", writer=type(self).__name__, operation="close"):
+            self.close()
+
+
+class CsvResultWriter(ResultWriter):
+    def __init__(self, path: str, flush_rows: int = 50, flush_interval: float = 30.0) -> None:
+        super().__init__(path, flush_rows, flush_interval)
+        # utf-8-sig, so Excel recognizes the encoding
+        self._file = open(path, "w", encoding="utf-8-sig", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=COLUMNS)
+        self._writer.writeheader()
+
+    def _write_row(self, row: Dict[str, object]) -> None:
+        self._writer.writerow(row)
+
+    def _flush(self) -> None:
+        self._file.flush()
+
+    def _close(self) -> None:
+        self._file.close()
+
+
+class XlsxResultWriter(ResultWriter):
+    """
+    Rows are streamed to a temporary file by openpyxl, the workbook itself can only be saved once, on close.
+    Use a `JobJournal` or a CSV export to keep partial results of a long run.
+    """
+
+    def __init__(self, path: str, flush_rows: int = 50, flush_interval: float = 30.0) -> None:
+        super().__init__(path, flush_rows, flush_interval)
+        self._workbook = Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet("results")
+        self._sheet.append(COLUMNS)
+
+    def _write_row(self, row: Dict[str, object]) -> None:
+        self._sheet.append([row[column] for column in COLUMNS])
+
+    def _close(self) -> None:
+        self._workbook.save(self.path)
+
+
+class ParquetResultWriter(ResultWriter):
+    def __init__(self, path: str, flush_rows: int = 1000, flush_interval: float = 30.0) -> None:
+        if pyarrow is None:
+            raise ImportError("Parquet export requires `pyarrow`")
+
+        super().__init__(path, flush_rows, flush_interval)
+        self._schema = pyarrow.schema([
+            ("notebook", pyarrow.string()),
+            ("task", pyarrow.int32()),
+            ("score", pyarrow.float64()),
+            ("max_score", pyarrow.int32()),
+            ("comments", pyarrow.string()),
+            ("error", pyarrow.string()),
+            ("latency", pyarrow.float64()),
+            ("input_tokens", pyarrow.int64()),
+            ("completion_tokens", pyarrow.int64()),
+            ("cache_hit", pyarrow.bool_()),
+            ("resumed", pyarrow.bool_()),
+            ("duplicate_of", pyarrow.string()),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self._rows: List[Dict[str, object]] = []
+
+    def _write_row(self, row: Dict[str, object]) -> None:
+        self._rows.append(row)
+
+    def _flush(self) -> None:
+        if self._rows:
+            self._writer.write_table(pyarrow.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+    def _close(self) -> None:
+        self._flush()
+        self._writer.close()
+
+
+def create_writer(
+        path: str,
+        export_format: Optional[ExportFormat] = None,
+        flush_rows: int = 50,
+        flush_interval: float = 30.0
+) -> ResultWriter:
+    """
+    The format is taken from the file extension, if not given.
+    """
+    if export_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in _EXTENSIONS:
+            raise ValueError(f"Unknown export format of {path}, expected one of {', '.join(_EXTENSIONS)}")
+        export_format = _EXTENSIONS[extension]
+
+    if export_format == ExportFormat.XLSX:
+        return XlsxResultWriter(path, flush_rows, flush_interval)
+    elif export_format == ExportFormat.CSV:
+        return CsvResultWriter(path, flush_rows, flush_interval)
+    elif export_format == ExportFormat.PARQUET:
+        return ParquetResultWriter(path, flush_rows, flush_interval)
+    else:
+        raise ValueError(f"Unsupported ExportFormat, FIX ME!: {export_format}")
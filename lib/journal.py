@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from lib.results import ReviewResult
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reviewer_name(reviewer) -> str:
+    """
+    Reviewer class and the models it calls, e.g. "FullTaskReviewer:gpt://folder/yandexgpt/latest".
+    """
+    return f"{type(reviewer).__name__}:{','.join(client.model_name for client in reviewer.clients)}"
+
+
+class JobJournal:
+    """
+    Append-only JSONL log of finished review jobs, so an interrupted batch run can be resumed.
+
+    A job is identified by the hash of the notebook file, the task index, the reviewer (see `reviewer_name`),
+    the prompt and the maximum score, the latest record of a job wins. Every record is flushed
+    (and fsync-ed with `sync=True`) before the job is reported, a record cut short by a crash is ignored.
+    """
+
+    def __init__(self, path: str, sync: bool = False) -> None:
+        self.path = path
+        self.sync = sync
+
+        self._lock = threading.Lock()
+        self._hashes: Dict[str, str] = {}
+        self._completed: Dict[str, ReviewResult] = {}
+        self._failed: Dict[str, str] = {}
+        truncated = self._load()
+        self._file = open(path, "a", encoding="utf-8")
+        if truncated:
+            # the next record must not be glued to the broken one
+            self._file.write("\n")
+
+    def _load(self) -> bool:
+        """
+        Read existing records, returns whether the last one is cut short.
+        """
+        if not os.path.exists(self.path):
+            return False
+
+        line = ""
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                key = record["key"]
+                if record["status"] == "done":
+                    self._completed[key] = ReviewResult.from_dict(record["result"])
+                    self._failed.pop(key, None)
+                else:
+                    self._failed[key] = record["error"]
+                    self._completed.pop(key, None)
+        return bool(line) and not line.endswith("\n")
+
+    def notebook_hash(self, path: str) -> str:
+        digest = self._hashes.get(path)
+        if digest is None:
+            digest = self._hashes[path] = file_hash(path)
+        return digest
+
+    def job_key(self, job, reviewer) -> str:
+        payload = json.dumps(
+            [self.notebook_hash(job.notebook_path), job.task_index, reviewer_name(reviewer),
+             job.prompt, job.maximum_possible_score],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def completed(self, key: str) -> Optional[ReviewResult]:
+        return self._completed.get(key)
+
+    @property
+    def done_count(self) -> int:
+        return len(self._completed)
+
+    @property
+    def failed_count(self) -> int:
+        return len(self._failed)
+
+    def record_done(self, key: str, job, result: ReviewResult) -> None:
+        with self._lock:
+            self._append({
+                "key": key, "path": job.notebook_path, "task_index": job.task_index,
+                "status": "done", "result": result.to_dict()
+            })
+            self._completed[key] = result
+            self._failed.pop(key, None)
+
+    def record_failed(self, key: str, job, error: BaseException) -> None:
+        with self._lock:
+            self._append({
+                "key": key, "path": job.notebook_path, "task_index": job.task_index,
+                "status": "failed", "error": repr(error)
+            })
+            self._failed[key] = repr(error)
+
+    def _append(self, record: dict) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,319 @@
+import bisect
+import json
+import threading
+import time
+from typing import List, Dict, Optional, Tuple, Sequence, Union
+
+# Upper bounds of histogram buckets in seconds, from parsing stages to slow completions
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0
+)
+
+# Sorted (label, value) pairs
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """
+    Bucketed distribution of observed values, quantiles are interpolated within a bucket.
+    """
+    __slots__ = ("buckets", "counts", "count", "sum", "min", "max", "_lock")
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        # the last one counts values above all buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.buckets[i - 1] if i > 0 else self.min
+                high = self.buckets[i] if i < len(self.buckets) else self.max
+                low, high = max(low, self.min), min(high, self.max)
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Timer:
+    """
+    Context manager observing the time spent in its block, in seconds.
+    """
+    __slots__ = ("histogram", "start", "elapsed")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.start = 0.0
+        self.elapsed = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed)
+
+
+class _NullMetric:
+    """
+    Stands for any metric of a disabled registry.
+    """
+    __slots__ = ()
+
+    elapsed = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def __enter__(self) -> "_NullMetric":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+NULL_METRIC = _NullMetric()
+
+
+def _labels_key(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    """
+    Named counters and histograms with labels, e.g. `registry.inc("llm_requests_total", provider="yandex")`.
+
+    A disabled registry hands out a shared no-op metric, so instrumented code costs a method call
+    and an attribute check. Metrics are thread-safe, `drain` and `merge` move them between processes.
+    """
+
+    def __init__(self, enabled: bool = True, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], Counter] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def counter(self, name: str, **labels) -> Union[Counter, _NullMetric]:
+        if not self.enabled:
+            return NULL_METRIC
+        key = (name, _labels_key(labels))
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, Counter())
+        return counter
+
+    def histogram(self, name: str, **labels) -> Union[Histogram, _NullMetric]:
+        if not self.enabled:
+            return NULL_METRIC
+        key = (name, _labels_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(self.buckets))
+        return histogram
+
+    def timer(self, name: str, **labels) -> Union[Timer, _NullMetric]:
+        if not self.enabled:
+            return NULL_METRIC
+        return Timer(self.histogram(name, **labels))
+
+    def inc(self, name: str, amount: float = 1.0, **labels) -> None:
+        if self.enabled:
+            self.counter(name, **labels).inc(amount)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if self.enabled:
+            self.histogram(name, **labels).observe(value)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def drain(self) -> dict:
+        """
+        Picklable state of all metrics for `merge`, the registry is reset.
+        """
+        with self._lock:
+            counters, histograms = self._counters, self._histograms
+            self._counters, self._histograms = {}, {}
+        return {
+            "counters": {key: counter.value for key, counter in counters.items()},
+            "histograms": {
+                key: (histogram.counts, histogram.count, histogram.sum, histogram.min, histogram.max)
+                for key, histogram in histograms.items()
+            },
+        }
+
+    def merge(self, state: dict) -> None:
+        if not self.enabled:
+            return
+        for (name, labels), value in state["counters"].items():
+            self.counter(name, **dict(labels)).inc(value)
+        for (name, labels), (counts, count, total, low, high) in state["histograms"].items():
+            histogram = self.histogram(name, **dict(labels))
+            with histogram._lock:
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+                histogram.min = min(histogram.min, low)
+                histogram.max = max(histogram.max, high)
+
+    def snapshot(self) -> Dict[str, List[dict]]:
+        with self._lock:
+            counters, histograms = sorted(self._counters.items()), sorted(self._histograms.items())
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": counter.value} for (name, labels), counter in counters
+            ],
+            "histograms": [
+                {"name": name, "labels": dict(labels), **histogram.summary()}
+                for (name, labels), histogram in histograms
+            ],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Prometheus text exposition format.
+        """
+        with self._lock:
+            counters, histograms = sorted(self._counters.items()), sorted(self._histograms.items())
+
+        lines = []
+        declared = set()
+        for (name, labels), counter in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_format_labels(labels)} {counter.value:g}")
+
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum:g}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        JSON for a .json file, Prometheus text format otherwise (e.g. for the node exporter textfile collector).
+        """
+        text = self.to_json() if path.lower().endswith(".json") else self.to_prometheus()
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(text)
+
+
+# Used by the instrumented code, disabled until `enable` is called
+_registry = MetricsRegistry(enabled=False)
+
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+
+def set_registry(registry: MetricsRegistry) -> MetricsRegistry:
+    """
+    Replace the global registry, returns the previous one.
+    """
+    global _registry
+    previous, _registry = _registry, registry
+    return previous
+
+
+def enable() -> MetricsRegistry:
+    _registry.enabled = True
+    return _registry
+
+
+def disable() -> None:
+    _registry.enabled = False
+
+
+def is_enabled() -> bool:
+    return _registry.enabled
+
+
+def timer(name: str, **labels) -> Union[Timer, _NullMetric]:
+    if not _registry.enabled:
+        return NULL_METRIC
+    return _registry.timer(name, **labels)
+
+
+def inc(name: str, amount: float = 1.0, **labels) -> None:
+    if _registry.enabled:
+        _registry.counter(name, **labels).inc(amount)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    if _registry.enabled:
+        _registry.histogram(name, **labels).observe(value)
@@ -0,0 +1,170 @@
+import itertools
+import random
+import threading
+import time
+from typing import List, Dict, Optional, Callable, Iterator, Sequence, Union
+
+from lib.cache import ResponseCache
+from lib.clients import BaseClient
+from lib.scheduler import ProviderError, RequestScheduler
+from lib.tokens import heuristic_token_count, message_text
+
+# Draws a latency in seconds from the given random generator
+LatencyModel = Callable[[random.Random], float]
+
+# Produces a response for (prompt, user message, context)
+Responder = Callable[[str, str, List[Dict[str, str]]], str]
+
+
+def constant_latency(seconds: float) -> LatencyModel:
+    return lambda rng: seconds
+
+
+def uniform_latency(low: float, high: float) -> LatencyModel:
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal_latency(median: float, sigma: float = 0.5, maximum: Optional[float] = None) -> LatencyModel:
+    """
+    Heavy-tailed latency, like real completions: most calls are close to `median`, some are much slower.
+    """
+    def draw(rng: random.Random) -> float:
+        latency = median * rng.lognormvariate(0.0, sigma)
+        return latency if maximum is None else min(latency, maximum)
+    return draw
+
+
+def echo_responder(prompt: str, user_message: str, context: List[Dict[str, str]]) -> str:
+    return user_message
+
+
+def canned_responder(responses: Sequence[str]) -> Responder:
+    """
+    Cycles through `responses`.
+    """
+    if not responses:
+        raise ValueError("At least one canned response is required")
+
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def respond(prompt: str, user_message: str, context: List[Dict[str, str]]) -> str:
+        with lock:
+            i = next(counter)
+        return responses[i % len(responses)]
+    return respond
+
+
+def replay_responder(
+        cache: ResponseCache,
+        model: str,
+        fallback: Optional[Responder] = None,
+        max_tokens: int = 500,
+        temperature: float = 0.5
+) -> Responder:
+    """
+    Answers with responses recorded in a `ResponseCache` filled by real calls of `model`
+    (see `BaseClient.model_name`), a call that wasn't recorded goes to `fallback` or fails.
+    """
+    def respond(prompt: str, user_message: str, context: List[Dict[str, str]]) -> str:
+        response = cache.get(cache.make_key(model, prompt, user_message, context or None, max_tokens, temperature))
+        if response is not None:
+            return response
+        if fallback is None:
+            raise ProviderError(f"No recorded response of {model} for this request")
+        return fallback(prompt, user_message, context)
+    return respond
+
+
+class MockClient(BaseClient):
+    """
+    In-process LLM stand-in for load tests and benchmarks, no network calls.
+
+    Every call waits for a latency drawn from `latency`, then fails with probability `error_rate`
+    (as a retryable `ProviderError` with one of `error_statuses`) or answers with `responder`.
+    Streamed responses come in `stream_chunk` character chunks. Usage is estimated with `heuristic_token_count`.
+    """
+    provider = "mock"
+
+    def __init__(
+            self,
+            responder: Union[Responder, Sequence[str], None] = None,
+            latency: Optional[LatencyModel] = None,
+            error_rate: float = 0.0,
+            error_statuses: Sequence[int] = (429, 500, 503),
+            stream_chunk: int = 16,
+            model: str = "mock",
+            seed: Optional[int] = None,
+            sleep: Callable[[float], None] = time.sleep,
+            scheduler: Optional[RequestScheduler] = None
+    ) -> None:
+        super().__init__(api_key=None, scheduler=scheduler)
+
+        if responder is None:
+            responder = echo_responder
+        elif not callable(responder):
+            responder = canned_responder(list(responder))
+
+        self.responder = responder
+        self.latency = latency or constant_latency(0.0)
+        self.error_rate = error_rate
+        self.error_statuses = list(error_statuses)
+        self.stream_chunk = stream_chunk
+        self.model = model
+        self.calls = 0
+        self.errors = 0
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sleep = sleep
+
+    @property
+    def model_name(self) -> str:
+        return self.model
+
+    def _complete(self, prompt: str, user_message: str, context: List[Dict[str, str]]) -> str:
+        with self._lock:
+            self.calls += 1
+            latency = max(self.latency(self._rng), 0.0)
+            status = None
+            if self._rng.random() < self.error_rate:
+                self.errors += 1
+                status = self._rng.choice(self.error_statuses)
+
+        self._sleep(latency)
+        if status is not None:
+            raise ProviderError(f"Mock provider returned HTTP {status}", status=status, retryable=True)
+        return self.responder(prompt, user_message, context)
+
+    def call(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> str:
+        messages = self.build_messages(prompt, user_message, context)
+        input_tokens = sum(heuristic_token_count(message_text(message)) for message in messages)
+        response = self._execute(
+            lambda: self._complete(prompt, user_message, messages[1:-1]),
+            input_tokens + max_tokens
+        )
+
+        self.last_usage = {
+            "input_tokens": input_tokens,
+            "completion_tokens": heuristic_token_count(response),
+        }
+        return response
+
+    def stream(
+            self,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            max_tokens: int = 500,
+            temperature: float = 0.5,
+    ) -> Iterator[str]:
+        response = self.call(prompt, user_message, context, max_tokens, temperature)
+        for start in range(0, len(response), self.stream_chunk):
+            yield response[start:start + self.stream_chunk]
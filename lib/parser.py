@@ -1,14 +1,25 @@
+import bisect
+import collections
 import dataclasses
+import difflib
 import enum
 import itertools
+import json
 import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Tuple, Callable, Optional
+from typing import List, Tuple, Callable, Optional, AbstractSet, Iterator, Iterable, FrozenSet
 
 import nbformat
 
+from lib import metrics
 from lib.constants import SPECIAL_MARK
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 class MergeKind(enum.Enum):
     # Merges consecutive cells into one if they are simultaneously changed by the student or simultaneously unchanged
@@ -19,6 +30,15 @@ class MergeKind(enum.Enum):
     BY_CHANGE_AND_CELL_TYPE = 2
 
 
+class DiffMode(enum.Enum):
+    # A cell is unchanged only if its normalized text is equal to some cell of the original
+    EXACT = 1
+
+    # Student cells are aligned to the original ones, changed cells are diffed line by line against
+    # the original cells they replace and split, so only the changed lines are marked
+    LINES = 2
+
+
 class CellType(enum.Enum):
     CODE = 1
     MARKDOWN = 2
@@ -27,97 +47,383 @@ class CellType(enum.Enum):
     OTHER = 3
 
 
-@dataclasses.dataclass
+class NotebookLoader(enum.Enum):
+    # Full nbformat read: schema validation, conversion of older notebook formats
+    NBFORMAT = 1
+
+    # Reads only cell types, sources and attachment markers, without validation; outputs are skipped.
+    # Streams the file with ijson if it is installed. Notebooks older than v4 are read with NBFORMAT
+    FAST = 2
+
+
+# no per-instance __dict__, a cohort holds millions of cells
+@dataclasses.dataclass(slots=True)
 class NotebookCell:
     is_changed: bool
     cell_type: CellType
     raw_text: str
 
 
+def _with_flag(cell: NotebookCell, is_changed: bool) -> NotebookCell:
+    """
+    The cell itself if it already has the flag, a marked copy otherwise.
+    """
+    return cell if cell.is_changed == is_changed else NotebookCell(is_changed, cell.cell_type, cell.raw_text)
+
+
 def get_notebooks_filenames_from_directory(directory: str) -> List[str]:
     path = Path(directory)
     return [str(p) for p in path.glob("*.ipynb")]
 
 
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+# Same result as replacing '[ \t]+' with ' ', but single spaces don't count as matches
+_WHITESPACE_RE = re.compile(r'[ \t]{2,}|\t')
+
+_TASK_HEADER_RE = re.compile(r"##\s*([Зз])адача\s*(\d+)", flags=re.IGNORECASE)
+_TASK_SCORE_RE = re.compile(r"(\d+)\s*([Бб]аллов)")
+
+
 def normalize_text(text: str) -> str:
+    # substring checks are much cheaper than a regex pass, so passes that can't change the text are skipped
     text = text.strip()
-    text = re.sub(r'\r\n', '\n', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = re.sub(r'[ \t]+', ' ', text)
+    if '\r\n' in text:
+        text = text.replace('\r\n', '\n')
+    if '\n\n\n' in text:
+        text = _BLANK_LINES_RE.sub('\n\n', text)
+    if '\t' in text or '  ' in text:
+        text = _WHITESPACE_RE.sub(' ', text)
     return text
 
 
-def get_filtered_notebook_cells_from_notebook(file_path: str) -> List[NotebookCell]:
+def scan_task_header(text: str) -> Optional[Tuple[int, Optional[int]]]:
     """
-    Extract code and markdown cells, filtering those with (attachments | base64 images).
+    Returns (task number, score) if the text contains a task header, score is None if it isn't stated.
     """
-    cells = []
+    if '##' not in text:
+        return None
+
+    header_match = _TASK_HEADER_RE.search(text)
+    if header_match is None:
+        return None
+
+    score_match = _TASK_SCORE_RE.search(text)
+    return int(header_match.group(2)), int(score_match.group(1)) if score_match else None
+
+
+# (cell_type, source, has attachments in metadata)
+RawCell = Tuple[str, str, bool]
+
+
+def _read_raw_cells_nbformat(file_path: str) -> List[RawCell]:
     with open(file_path, 'r', encoding='utf-8') as file:
         notebook = nbformat.read(file, as_version=4)
 
-        for cell in notebook.cells:
-            if cell.cell_type == 'code':
-                cells.append(NotebookCell(False, CellType.CODE, cell.source))
-            elif cell.cell_type == 'markdown':
-                has_attachments = 'attachments' in cell.get('metadata', {})
-                has_base64 = 'base64' in cell.source
+    return [
+        (cell.cell_type, cell.source, 'attachments' in cell.get('metadata', {}))
+        for cell in notebook.cells
+    ]
+
+
+def _join_source(source) -> str:
+    return source if isinstance(source, str) else "".join(source)
+
+
+def _drop_outputs(pairs: List[tuple]) -> dict:
+    # called for every JSON object, releases cell outputs as soon as the cell is decoded
+    obj = dict(pairs)
+    obj.pop('outputs', None)
+    return obj
+
+
+def _read_raw_cells_json(file_path: str) -> Optional[List[RawCell]]:
+    with open(file_path, 'r', encoding='utf-8') as file:
+        notebook = json.load(file, object_pairs_hook=_drop_outputs)
+
+    if notebook.get('nbformat') != 4:
+        return None
+
+    return [
+        (cell.get('cell_type'), _join_source(cell.get('source', "")), 'attachments' in cell.get('metadata', {}))
+        for cell in notebook.get('cells', [])
+    ]
+
+
+def _read_raw_cells_ijson(file_path: str) -> Optional[List[RawCell]]:
+    cells = []
+    version = None
+    cell_type, source, has_attachments = None, [], False
+
+    with open(file_path, 'rb') as file:
+        for prefix, event, value in ijson.parse(file):
+            if prefix.startswith('cells.item.outputs'):
+                continue
+            if prefix == 'cells.item':
+                if event == 'start_map':
+                    cell_type, source, has_attachments = None, [], False
+                elif event == 'end_map':
+                    cells.append((cell_type, "".join(source), has_attachments))
+            elif prefix == 'cells.item.cell_type':
+                cell_type = value
+            elif prefix == 'cells.item.source' or prefix == 'cells.item.source.item':
+                if event == 'string':
+                    source.append(value)
+            elif prefix == 'cells.item.metadata':
+                if event == 'map_key' and value == 'attachments':
+                    has_attachments = True
+            elif prefix == 'nbformat':
+                version = value
+
+    return cells if version == 4 else None
+
+
+def get_filtered_notebook_cells_from_notebook(
+        file_path: str,
+        loader: NotebookLoader = NotebookLoader.NBFORMAT
+) -> List[NotebookCell]:
+    """
+    Extract code and markdown cells, filtering those with (attachments | base64 images).
+    """
+    raw_cells = None
+    if loader == NotebookLoader.FAST:
+        reader = "ijson" if ijson is not None else "json"
+        with metrics.timer("parse_stage_seconds", stage="read", reader=reader):
+            raw_cells = _read_raw_cells_ijson(file_path) if ijson is not None else _read_raw_cells_json(file_path)
+    elif loader != NotebookLoader.NBFORMAT:
+        raise ValueError(f"Unsupported NotebookLoader, FIX ME!: {loader}")
+
+    if raw_cells is None:
+        with metrics.timer("parse_stage_seconds", stage="read", reader="nbformat"):
+            raw_cells = _read_raw_cells_nbformat(file_path)
+
+    with metrics.timer("parse_stage_seconds", stage="filter"):
+        cells = []
+        for cell_type, source, has_attachments in raw_cells:
+            if cell_type == 'code':
+                cells.append(NotebookCell(False, CellType.CODE, source))
+            elif cell_type == 'markdown':
+                has_base64 = 'base64' in source
                 if not has_attachments and not has_base64:
-                    cells.append(NotebookCell(False, CellType.MARKDOWN, cell.source))
+                    cells.append(NotebookCell(False, CellType.MARKDOWN, source))
     return cells
 
 
+def get_normalized_content(cells: List[NotebookCell]) -> FrozenSet[str]:
+    """
+    Normalized texts of the cells, used to detect unchanged cells.
+    """
+    return frozenset(normalize_text(c.raw_text) for c in cells)
+
+
+# Gaps between anchors smaller than this (len(a) * len(b)) are aligned with difflib
+_MAX_DIFFLIB_GAP = 10_000
+
+# A changed cell is diffed line by line against this many original cells on each side of its position
+_REFERENCE_WINDOW = 2
+
+
+def _longest_increasing_pairs(pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Longest subsequence of `pairs` (sorted by second item) increasing in the first item, O(n log n).
+    """
+    tails: List[int] = []
+    tail_indices: List[int] = []
+    previous = [-1] * len(pairs)
+    for k, (i, _) in enumerate(pairs):
+        position = bisect.bisect_left(tails, i)
+        if position == len(tails):
+            tails.append(i)
+            tail_indices.append(k)
+        else:
+            tails[position] = i
+            tail_indices[position] = k
+        previous[k] = tail_indices[position - 1] if position else -1
+
+    result = []
+    k = tail_indices[-1] if tail_indices else -1
+    while k != -1:
+        result.append(pairs[k])
+        k = previous[k]
+    return result[::-1]
+
+
+def _diff_opcodes(a: List[str], b: List[str]) -> List[Tuple[str, int, int, int, int]]:
+    """
+    Patience-style diff: elements unique in both sequences serve as anchors (aligned by LIS),
+    gaps between anchors are trimmed by common prefix/suffix and, if small, aligned with difflib.
+    Near-linear, unlike difflib on long sequences with many scattered changes.
+    Returns difflib-like opcodes, tags are 'equal' and 'replace' (either side of a replace may be empty).
+    """
+    count_a = collections.Counter(a)
+    count_b = collections.Counter(b)
+    position_a = {x: i for i, x in enumerate(a) if count_a[x] == 1}
+    pairs = [(position_a[x], j) for j, x in enumerate(b) if count_b[x] == 1 and x in position_a]
+    anchors = _longest_increasing_pairs(pairs) + [(len(a), len(b))]
+
+    opcodes = []
+
+    def emit(tag: str, i1: int, i2: int, j1: int, j2: int) -> None:
+        if i1 == i2 and j1 == j2:
+            return
+        if opcodes and opcodes[-1][0] == tag and opcodes[-1][2] == i1 and opcodes[-1][4] == j1:
+            opcodes[-1] = (tag, opcodes[-1][1], i2, opcodes[-1][3], j2)
+        else:
+            opcodes.append((tag, i1, i2, j1, j2))
+
+    i = j = 0
+    for anchor_i, anchor_j in anchors:
+        while i < anchor_i and j < anchor_j and a[i] == b[j]:
+            emit('equal', i, i + 1, j, j + 1)
+            i, j = i + 1, j + 1
+        suffix = 0
+        while anchor_i - suffix > i and anchor_j - suffix > j and a[anchor_i - suffix - 1] == b[anchor_j - suffix - 1]:
+            suffix += 1
+
+        gap_i, gap_j = anchor_i - suffix, anchor_j - suffix
+        if (gap_i - i) * (gap_j - j) <= _MAX_DIFFLIB_GAP:
+            matcher = difflib.SequenceMatcher(None, a[i:gap_i], b[j:gap_j], autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                emit('equal' if tag == 'equal' else 'replace', i + i1, i + i2, j + j1, j + j2)
+        else:
+            emit('replace', i, gap_i, j, gap_j)
+
+        emit('equal', gap_i, anchor_i, gap_j, anchor_j)
+        if anchor_i < len(a):
+            emit('equal', anchor_i, anchor_i + 1, anchor_j, anchor_j + 1)
+        i, j = anchor_i + 1, anchor_j + 1
+    return opcodes
+
+
+def _split_by_changed_lines(cell: NotebookCell, reference_lines: List[str]) -> List[NotebookCell]:
+    """
+    Split a changed cell into runs of changed and unchanged lines, compared to `reference_lines`
+    (normalized lines of the original cells the cell replaces). Blank lines join the preceding run.
+    """
+    lines = cell.raw_text.split('\n')
+    normalized = [normalize_text(line) for line in lines]
+
+    is_changed = [True] * len(lines)
+    for tag, _, _, j1, j2 in _diff_opcodes(reference_lines, normalized):
+        if tag == 'equal':
+            for j in range(j1, j2):
+                is_changed[j] = False
+
+    for j in range(1, len(lines)):
+        if not normalized[j]:
+            is_changed[j] = is_changed[j - 1]
+
+    if all(is_changed):
+        return [_with_flag(cell, True)]
+
+    parts = []
+    start = 0
+    for changed, run in itertools.groupby(is_changed):
+        length = len(list(run))
+        text = '\n'.join(lines[start:start + length])
+        start += length
+        if text.strip():
+            parts.append(NotebookCell(changed, cell.cell_type, text))
+    return parts
+
+
+def _mark_modified_cells_by_lines(
+        orig_cells: List[NotebookCell],
+        modified_cells: List[NotebookCell],
+        original_content: AbstractSet[str]
+) -> List[NotebookCell]:
+    orig_texts = [normalize_text(c.raw_text) for c in orig_cells]
+    modified_texts = [normalize_text(c.raw_text) for c in modified_cells]
+
+    marked_cells = []
+    for tag, i1, i2, j1, j2 in _diff_opcodes(orig_texts, modified_texts):
+        if tag == 'equal':
+            marked_cells.extend(_with_flag(c, False) for c in modified_cells[j1:j2])
+            continue
+
+        for k, (cell, normalized) in enumerate(zip(modified_cells[j1:j2], modified_texts[j1:j2])):
+            if normalized in original_content:
+                marked_cells.append(_with_flag(cell, False))
+                continue
+
+            # the original cells around the proportional position of the cell in the replaced block
+            center = i1 + (k * (i2 - i1)) // (j2 - j1)
+            reference = orig_texts[max(i1, center - _REFERENCE_WINDOW):min(i2, center + _REFERENCE_WINDOW + 1)]
+            if not reference:
+                marked_cells.append(_with_flag(cell, True))
+            else:
+                reference_lines = [normalize_text(line) for text in reference for line in text.split('\n')]
+                marked_cells.extend(_split_by_changed_lines(cell, reference_lines))
+    return marked_cells
+
+
 def mark_modified_cells(
         orig_cells: List[NotebookCell],
-        modified_cells: List[NotebookCell]
+        modified_cells: List[NotebookCell],
+        original_content: Optional[AbstractSet[str]] = None,
+        mode: DiffMode = DiffMode.EXACT
 ) -> List[NotebookCell]:
     """
     Mark cells as changed if their normalized content isn't in the original.
-    Creates new NotebookCell instances to avoid mutating inputs.
+    Inputs are not mutated: cells that already have the right flag are reused, the others are copied.
+    `original_content` may be passed to reuse `get_normalized_content(orig_cells)`.
+    With `DiffMode.LINES` partially changed cells are split into changed and unchanged parts.
     """
-    original_content = {normalize_text(c.raw_text) for c in orig_cells}
+    if original_content is None:
+        original_content = get_normalized_content(orig_cells)
+
+    if mode == DiffMode.LINES:
+        return _mark_modified_cells_by_lines(orig_cells, modified_cells, original_content)
+    elif mode != DiffMode.EXACT:
+        raise ValueError(f"Unsupported DiffMode, FIX ME!: {mode}")
+
     marked_cells = []
     for cell in modified_cells:
-        normalized = normalize_text(cell.raw_text)
-        is_changed = normalized not in original_content
-        marked_cells.append(dataclasses.replace(cell, is_changed=is_changed))
+        marked_cells.append(_with_flag(cell, normalize_text(cell.raw_text) not in original_content))
     return marked_cells
 
 
-def parse_and_mark_cells_by_tasks(
+def assign_cells_to_tasks(
         cells: List[NotebookCell],
         expected_task_count: int
-) -> Tuple[List[List[NotebookCell]], List[Optional[int]]]:
+) -> Tuple[List[int], List[Optional[int]]]:
     """
-    Split cells into tasks based on headers. Returns tasks and scores.
+    Task index of every cell based on headers (-1 for cells before the first header) and scores of the tasks.
 
     Raises ValueError if task number exceeds expected count.
     """
-    tasks = [[] for _ in range(expected_task_count)]
+    task_indices = []
     scores: List[Optional[int]] = [None] * expected_task_count
     current_task_index = -1
 
     for cell in cells:
-        header_match = re.search(
-            r"##\s*([Зз])адача\s*(\d+)",
-            cell.raw_text,
-            flags=re.IGNORECASE
-        )
-        if header_match:
-            task_number = int(header_match.group(2))
+        header = scan_task_header(cell.raw_text)
+        if header is not None:
+            task_number, score = header
             if not (1 <= task_number <= expected_task_count):
                 raise ValueError(
                     f"Found task {task_number} but expected {expected_task_count} tasks"
                 )
             current_task_index = task_number - 1
-            tasks[current_task_index].append(cell)
+            if score is not None:
+                scores[current_task_index] = score
+        task_indices.append(current_task_index)
+    return task_indices, scores
 
-            score_match = re.search(r"(\d+)\s*([Бб]аллов)", cell.raw_text)
-            if score_match:
-                scores[current_task_index] = int(score_match.group(1))
-            continue
 
-        if current_task_index != -1:
-            tasks[current_task_index].append(cell)
+def parse_and_mark_cells_by_tasks(
+        cells: List[NotebookCell],
+        expected_task_count: int
+) -> Tuple[List[List[NotebookCell]], List[Optional[int]]]:
+    """
+    Split cells into tasks based on headers. Returns tasks and scores.
+
+    Raises ValueError if task number exceeds expected count.
+    """
+    task_indices, scores = assign_cells_to_tasks(cells, expected_task_count)
+    tasks = [[] for _ in range(expected_task_count)]
+    for cell, task_index in zip(cells, task_indices):
+        if task_index != -1:
+            tasks[task_index].append(cell)
 
     if len(tasks) != expected_task_count:
         raise RuntimeError(
@@ -182,26 +488,126 @@ def merge_task_into_single_string(task: List[NotebookCell], delim: str = "\n\n\n
     return delim.join(map(lambda cell_: cell_.raw_text, task))
 
 
+def _parse_student_cells(
+        orig_cells: List[NotebookCell],
+        student_cells: List[NotebookCell],
+        kind: MergeKind,
+        tasks_count: int,
+        original_content: Optional[AbstractSet[str]] = None,
+        diff_mode: DiffMode = DiffMode.EXACT
+) -> Tuple[List[List[NotebookCell]], List[Optional[int]]]:
+    # normalization of the student's cells happens here
+    with metrics.timer("parse_stage_seconds", stage="diff", mode=diff_mode.name.lower()):
+        marked_cells = mark_modified_cells(orig_cells, student_cells, original_content, diff_mode)
+
+    with metrics.timer("parse_stage_seconds", stage="split_tasks"):
+        tasks, max_marks = parse_and_mark_cells_by_tasks(marked_cells, tasks_count)
+
+    with metrics.timer("parse_stage_seconds", stage="merge"):
+        if kind == MergeKind.BY_CHANGE_AND_CELL_TYPE:
+            combined_tasks = combine_modified_cells_by_type(tasks)
+        elif kind == MergeKind.BY_CHANGE:
+            combined_tasks = combine_modified_cells_by_change(tasks)
+        else:
+            raise ValueError(f"Unsupported MergeKind, FIX ME!: {kind}")
+
+    return combined_tasks, max_marks
+
+
 def parsing_pipeline(
         notebook_path: str,
         original_notebook_path: str,
         kind: MergeKind,
-        tasks_count: int
+        tasks_count: int,
+        loader: NotebookLoader = NotebookLoader.NBFORMAT,
+        diff_mode: DiffMode = DiffMode.EXACT
 ) -> Tuple[List[List[NotebookCell]], List[Optional[int]]]:
     """
     Main pipeline. Returns combined tasks and maximum scores.
     """
-    orig_cells = get_filtered_notebook_cells_from_notebook(original_notebook_path)
-    student_cells = get_filtered_notebook_cells_from_notebook(notebook_path)
-    marked_cells = mark_modified_cells(orig_cells, student_cells)
+    with metrics.timer("parse_notebook_seconds"):
+        orig_cells = get_filtered_notebook_cells_from_notebook(original_notebook_path, loader)
+        student_cells = get_filtered_notebook_cells_from_notebook(notebook_path, loader)
+        return _parse_student_cells(orig_cells, student_cells, kind, tasks_count, diff_mode=diff_mode)
 
-    tasks, max_marks = parse_and_mark_cells_by_tasks(marked_cells, tasks_count)
 
-    if kind == MergeKind.BY_CHANGE_AND_CELL_TYPE:
-        combined_tasks = combine_modified_cells_by_type(tasks)
-    elif kind == MergeKind.BY_CHANGE:
-        combined_tasks = combine_modified_cells_by_change(tasks)
-    else:
-        raise ValueError(f"Unsupported MergeKind, FIX ME!: {kind}")
+@dataclasses.dataclass
+class ParsedNotebook:
+    path: str
+    tasks: List[List[NotebookCell]]
+    marks: List[Optional[int]]
+    # set instead of tasks and marks if the notebook couldn't be parsed
+    error: Optional[BaseException] = None
 
-    return combined_tasks, max_marks
+
+# Original notebook and options shared by the tasks of a `parse_notebooks` worker process
+_worker_state: Optional[tuple] = None
+
+
+def _init_parse_worker(
+        orig_cells: List[NotebookCell],
+        original_content: AbstractSet[str],
+        kind: MergeKind,
+        tasks_count: int,
+        loader: NotebookLoader,
+        diff_mode: DiffMode,
+        metrics_enabled: bool = False
+) -> None:
+    global _worker_state
+    _worker_state = (orig_cells, original_content, kind, tasks_count, loader, diff_mode)
+    # a forked worker must not report the metrics of the parent again
+    metrics.set_registry(metrics.MetricsRegistry(enabled=metrics_enabled))
+
+
+def _parse_notebook_job(notebook_path: str) -> Tuple[ParsedNotebook, Optional[dict]]:
+    """
+    Returns the parsed notebook and the metrics recorded by the worker for it, if enabled.
+    """
+    orig_cells, original_content, kind, tasks_count, loader, diff_mode = _worker_state
+    try:
+        with metrics.timer("parse_notebook_seconds"):
+            student_cells = get_filtered_notebook_cells_from_notebook(notebook_path, loader)
+            tasks, marks = _parse_student_cells(
+                orig_cells, student_cells, kind, tasks_count, original_content, diff_mode
+            )
+        parsed = ParsedNotebook(notebook_path, tasks, marks)
+    except Exception as e:
+        parsed = ParsedNotebook(notebook_path, [], [], error=e)
+
+    metrics.inc("parsed_notebooks_total", status="ok" if parsed.error is None else "error")
+    return parsed, metrics.get_registry().drain() if metrics.is_enabled() else None
+
+
+def parse_notebooks(
+        notebook_paths: Iterable[str],
+        original_notebook_path: str,
+        kind: MergeKind,
+        tasks_count: int,
+        max_workers: Optional[int] = None,
+        loader: NotebookLoader = NotebookLoader.NBFORMAT,
+        diff_mode: DiffMode = DiffMode.EXACT
+) -> Iterator[ParsedNotebook]:
+    """
+    Batch version of `parsing_pipeline`. The original notebook is parsed once and sent to each
+    worker process once, student notebooks are parsed in the pool and yielded in completion order,
+    so they can be consumed before the whole batch is parsed.
+    A notebook that fails to parse is yielded with `error` set.
+    """
+    orig_cells = get_filtered_notebook_cells_from_notebook(original_notebook_path, loader)
+    original_content = get_normalized_content(orig_cells)
+
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_parse_worker,
+        initargs=(orig_cells, original_content, kind, tasks_count, loader, diff_mode, metrics.is_enabled())
+    )
+    try:
+        futures = [executor.submit(_parse_notebook_job, path) for path in notebook_paths]
+        for future in as_completed(futures):
+            parsed, worker_metrics = future.result()
+            if worker_metrics is not None:
+                metrics.get_registry().merge(worker_metrics)
+            yield parsed
+    finally:
+        # the consumer may stop early, don't parse the rest
+        executor.shutdown(cancel_futures=True)
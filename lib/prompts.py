@@ -38,5 +38,13 @@ PROMPTS_GENERATOR = {
         f"Обработайте и финализуйте оценки из {iterations} итераций совместного анализа. "
         f"Учтите всю предыдущую обратную связь и укажите итоговый балл (0-{max_score}).\n"
         "В качестве ответа нужно предоставить: 1) Итоговый балл 2) Список ключевых ошибок 3) краткие комментарии "
-    )
+    ),
+
+    # appended to the prompt when several questions are sent in one request, see `StepByStepTaskReviewer`
+    "batch_suffix": lambda questions: f"""
+
+В сообщении {questions} независимых вопросов, каждый начинается со строки '### Вопрос N'. Оцени каждый отдельно.
+Ответ на каждый вопрос начни со строки '### Вердикт N' (N — номер вопроса), после нее дай вердикт в формате выше.
+Не пропускай вопросы и не объединяй вердикты.
+"""
 }
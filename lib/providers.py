@@ -0,0 +1,117 @@
+import threading
+from typing import List, Dict, Callable, Tuple
+
+from lib.clients import BaseClient, YandexGPTClient, OpenAIClient, YANDEX_LLM_URL
+from lib.deferred import DeferredClient, PollPolicy
+from lib.mock import MockClient, lognormal_latency, constant_latency
+from lib.scheduler import RequestScheduler, RateLimiter, RetryPolicy, CircuitBreaker
+
+# Creates a client from the settings of config.yaml
+ClientFactory = Callable[[Dict[str, object]], BaseClient]
+
+_FACTORIES: Dict[str, ClientFactory] = {}
+
+# (settings prefix, account, scheduler settings) -> scheduler shared by the clients of the account
+_SCHEDULERS: Dict[Tuple[str, str, tuple], RequestScheduler] = {}
+_SCHEDULERS_LOCK = threading.Lock()
+
+
+def register_provider(name: str, factory: ClientFactory) -> None:
+    """
+    Make a provider available to `create_client` (and the CLI) under `name`, replacing a previous registration.
+    """
+    _FACTORIES[name] = factory
+
+
+def available_providers() -> List[str]:
+    return sorted(_FACTORIES)
+
+
+def create_client(name: str, config: Dict[str, object]) -> BaseClient:
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown provider {name!r}, available: {', '.join(available_providers())}")
+    return _FACTORIES[name](config)
+
+
+def _settings(
+        config: Dict[str, object],
+        prefix: str,
+        names: Dict[str, Callable[[object], object]]
+) -> Dict[str, object]:
+    """
+    Keyword arguments from the `<prefix>_<NAME>` settings that are given, converted with `names[name]`.
+    """
+    return {
+        name.lower(): convert(config[f"{prefix}_{name}"])
+        for name, convert in names.items() if config.get(f"{prefix}_{name}") is not None
+    }
+
+
+def provider_scheduler(prefix: str, account: str, config: Dict[str, object]) -> RequestScheduler:
+    """
+    Scheduler of the requests made with one account (quota) of a provider, all clients created for the account
+    with the same settings share it. The settings are `<prefix>_REQUESTS_PER_SECOND`, `<prefix>_TOKENS_PER_MINUTE`
+    (no limits by default), `<prefix>_MAX_ATTEMPTS`, `<prefix>_BASE_DELAY`, `<prefix>_MAX_DELAY`
+    (see `RetryPolicy`), `<prefix>_FAILURE_THRESHOLD` and `<prefix>_RESET_TIMEOUT` (see `CircuitBreaker`).
+    """
+    limits = _settings(config, prefix, {"REQUESTS_PER_SECOND": float, "TOKENS_PER_MINUTE": float})
+    retries = _settings(config, prefix, {"MAX_ATTEMPTS": int, "BASE_DELAY": float, "MAX_DELAY": float})
+    breaker = _settings(config, prefix, {"FAILURE_THRESHOLD": int, "RESET_TIMEOUT": float})
+
+    key = (prefix, account, tuple(sorted({**limits, **retries, **breaker}.items())))
+    with _SCHEDULERS_LOCK:
+        if key not in _SCHEDULERS:
+            _SCHEDULERS[key] = RequestScheduler(
+                rate_limiter=RateLimiter(**limits) if limits else None,
+                retry_policy=RetryPolicy(**retries),
+                circuit_breaker=CircuitBreaker(**breaker),
+            )
+        return _SCHEDULERS[key]
+
+
+def _create_yandex_client(config: Dict[str, object]) -> YandexGPTClient:
+    return YandexGPTClient(
+        config["SERVICE_ACCOUNT_ID"],
+        config["KEY_ID"],
+        config["PRIVATE_KEY"],
+        config["YANDEX_FOLDER_ID"],
+        model_url=config.get("YANDEX_MODEL_URL", "/yandexgpt/latest"),
+        llm_url=config.get("YANDEX_LLM_URL", YANDEX_LLM_URL),
+        scheduler=provider_scheduler("YANDEX", config["YANDEX_FOLDER_ID"], config),
+    )
+
+
+def _create_yandex_deferred_client(config: Dict[str, object]) -> DeferredClient:
+    policy = PollPolicy(
+        initial_delay=float(config.get("YANDEX_POLL_INITIAL_DELAY", 1.0)),
+        max_delay=float(config.get("YANDEX_POLL_MAX_DELAY", 30.0)),
+    )
+    return DeferredClient(_create_yandex_client(config), policy)
+
+
+def _create_openai_client(config: Dict[str, object]) -> OpenAIClient:
+    return OpenAIClient(
+        config["OPENAI_API_KEY"],
+        model=config.get("OPENAI_MODEL", "gpt-4o"),
+        base_url=config.get("OPENAI_BASE_URL"),
+        scheduler=provider_scheduler("OPENAI", f"{config.get('OPENAI_BASE_URL')}:{config['OPENAI_API_KEY']}", config),
+    )
+
+
+def _create_mock_client(config: Dict[str, object]) -> MockClient:
+    """
+    MOCK_LATENCY is the median latency in seconds (lognormal), MOCK_RESPONSES a list of canned responses,
+    the request is echoed without them.
+    """
+    latency = float(config.get("MOCK_LATENCY", 0.0))
+    return MockClient(
+        responder=config.get("MOCK_RESPONSES"),
+        latency=lognormal_latency(latency) if latency > 0 else constant_latency(0.0),
+        error_rate=float(config.get("MOCK_ERROR_RATE", 0.0)),
+    )
+
+
+register_provider("yandex", _create_yandex_client)
+register_provider("yandex-deferred", _create_yandex_deferred_client)
+register_provider("openai", _create_openai_client)
+register_provider("mock", _create_mock_client)
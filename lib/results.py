@@ -0,0 +1,138 @@
+import dataclasses
+import json
+import re
+from typing import List, Dict, Optional, Iterable, Iterator, TextIO
+
+from lib.scoring import SCORE_RE, score_from_match
+
+# "- ", "* ", "1. ", "2) " at the start of a line
+_LIST_MARKER_RE = re.compile(r"^[ \t]*(?:[-*•]|\d+[.)])[ \t]+")
+
+# Section labels of the `advanced_prompt` / `aggregation_prompt` outputs, the text after them is a comment
+_SECTION_LABEL_RE = re.compile(
+    r"^\**[ \t]*(?:Комментари[йи]|Замечани[яе]|Список[ \t]+ключевых[ \t]+ошибок|Ключевые[ \t]+ошибки|"
+    r"Краткие[ \t]+комментарии)[ \t]*\**[ \t]*:?[ \t]*\**[ \t]*",
+    flags=re.IGNORECASE
+)
+
+# "### Вердикт 2" / "### Вопрос 2" headers of batched requests and responses
+_BATCH_HEADER_RE = re.compile(
+    r"^[ \t]*#{1,4}[ \t]*\**[ \t]*(Вердикт|Вопрос)[ \t]*(\d+)\**[ \t]*:?[ \t]*$",
+    flags=re.MULTILINE | re.IGNORECASE
+)
+
+
+@dataclasses.dataclass(slots=True)
+class ReviewResult:
+    # None if the review has no score line
+    score: Optional[float]
+    max_score: Optional[int]
+    comments: List[str]
+    raw_text: str
+    # wall time of the review, seconds
+    latency: float = 0.0
+    # as reported by the providers, summed over the calls, None if unknown
+    input_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    # every call of the review was answered from the cache
+    cache_hit: bool = False
+
+    def __str__(self) -> str:
+        return self.raw_text
+
+    @property
+    def fraction(self) -> Optional[float]:
+        """
+        Score relative to the maximum, None if either is unknown.
+        """
+        if self.score is None or not self.max_score:
+            return None
+        return self.score / self.max_score
+
+    def to_dict(self) -> Dict[str, object]:
+        return {field.name: getattr(self, field.name) for field in dataclasses.fields(self)}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, object]) -> "ReviewResult":
+        return cls(**data)
+
+
+def parse_comments(text: str, skip_line: Optional[int] = None) -> List[str]:
+    """
+    Non-empty lines of a review without list markers and section labels, except the line at `skip_line` offset.
+    """
+    comments = []
+    offset = 0
+    for line in text.split("\n"):
+        line_start, offset = offset, offset + len(line) + 1
+        if skip_line is not None and line_start <= skip_line < offset:
+            continue
+
+        line = _SECTION_LABEL_RE.sub("", _LIST_MARKER_RE.sub("", line, count=1), count=1).strip()
+        if line:
+            comments.append(line)
+    return comments
+
+
+def parse_review(
+        text: str,
+        max_score: Optional[int] = None,
+        latency: float = 0.0,
+        input_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        cache_hit: bool = False
+) -> ReviewResult:
+    """
+    Parse a review in the `advanced_prompt` or `aggregation_prompt` format. `max_score` is used when
+    the review doesn't state it.
+    """
+    match = SCORE_RE.search(text)
+    score = None
+    if match is not None:
+        score, stated_max = score_from_match(match)
+        max_score = stated_max or max_score
+
+    return ReviewResult(
+        score=score,
+        max_score=max_score,
+        comments=parse_comments(text, match.start() if match else None),
+        raw_text=text,
+        latency=latency,
+        input_tokens=input_tokens,
+        completion_tokens=completion_tokens,
+        cache_hit=cache_hit
+    )
+
+
+def split_verdicts(text: str) -> Dict[int, str]:
+    """
+    Verdicts of a batched response by question number, taken from the "### Вердикт N" sections.
+    A question answered twice keeps the first verdict.
+    """
+    verdicts: Dict[int, str] = {}
+    headers = list(_BATCH_HEADER_RE.finditer(text))
+    for header, next_header in zip(headers, headers[1:] + [None]):
+        if header.group(1).lower() != "вердикт":
+            continue
+        body = text[header.end():next_header.start() if next_header else len(text)].strip()
+        if body:
+            verdicts.setdefault(int(header.group(2)), body)
+    return verdicts
+
+
+def dump_jsonl(results: Iterable[ReviewResult], file: TextIO) -> int:
+    """
+    Write results one JSON object per line, returns the number written.
+    """
+    count = 0
+    for result in results:
+        file.write(json.dumps(result.to_dict(), ensure_ascii=False))
+        file.write("\n")
+        count += 1
+    return count
+
+
+def load_jsonl(file: TextIO) -> Iterator[ReviewResult]:
+    for line in file:
+        if line.strip():
+            yield ReviewResult.from_dict(json.loads(line))
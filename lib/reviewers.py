@@ -1,20 +1,254 @@
-from typing import List, Dict, Optional
-
-from lib.clients import BaseClient, YandexGPTClient, OpenAIClient
+import dataclasses
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Callable, NamedTuple, Iterable, Tuple
+
+from lib import metrics
+from lib.cache import ResponseCache
+from lib.clients import BaseClient
 from lib.parser import NotebookCell, merge_task_into_single_string
 from lib.prompts import PROMPTS_GENERATOR
+from lib.results import ReviewResult, parse_review, parse_comments, split_verdicts
+from lib.scoring import Score, IncrementalScoreParser, SCORE_RE, parse_score, score_from_match
+from lib.tokens import TokenBudget, TokenUsage
+
+# Called with the score as soon as it is parsed from a streamed response
+ScoreCallback = Callable[[Score], None]
+
+
+class _Completion(NamedTuple):
+    text: str
+    # reported by the provider, 0 for a cache hit, None if unknown
+    input_tokens: Optional[int]
+    completion_tokens: Optional[int]
+    cache_hit: bool
+
+
+def _total(values: Iterable[Optional[int]]) -> Optional[int]:
+    values = list(values)
+    return None if any(value is None for value in values) else sum(values)
+
+
+def _scores_agree(first: str, second: str) -> bool:
+    first_score, second_score = parse_score(first), parse_score(second)
+    return first_score is not None and second_score is not None and first_score.value == second_score.value
+
+
+class BaseReviewer:
+    # Opt-in response cache, shared by all calls of the reviewer
+    cache: Optional[ResponseCache] = None
+
+    @property
+    def clients(self) -> List[BaseClient]:
+        raise NotImplementedError("It's base class, you can't call this method")
 
+    def _call(
+            self,
+            client: BaseClient,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]] = None,
+            on_score: Optional[ScoreCallback] = None
+    ) -> _Completion:
+        """
+        With `on_score` the response is streamed and the callback gets the score before the rest of the text.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(client.model_name, prompt, user_message, context)
+            cached = self.cache.get(key)
+            if cached is not None:
+                score = parse_score(cached)
+                if on_score is not None and score is not None:
+                    on_score(score)
+                return _Completion(cached, 0, 0, cache_hit=True)
+
+        client.last_usage = None
+        if on_score is None:
+            text = client.call(prompt, user_message, context=context)
+        else:
+            text = self._stream(client, prompt, user_message, context, on_score)
+
+        if key is not None:
+            self.cache.put(key, text)
 
-class StepByStepTaskReviewer:
-    def __init__(self, client: BaseClient) -> None:
+        reported = client.last_usage
+        if reported is None:
+            return _Completion(text, None, None, cache_hit=False)
+        return _Completion(text, reported["input_tokens"], reported["completion_tokens"], cache_hit=False)
+
+    def _review_result(
+            self,
+            text: str,
+            completions: List[_Completion],
+            start: float,
+            maximum_possible_score: Optional[int]
+    ) -> ReviewResult:
+        result = parse_review(
+            text,
+            maximum_possible_score,
+            latency=time.perf_counter() - start,
+            input_tokens=_total(completion.input_tokens for completion in completions),
+            completion_tokens=_total(completion.completion_tokens for completion in completions),
+            cache_hit=bool(completions) and all(completion.cache_hit for completion in completions)
+        )
+
+        reviewer = type(self).__name__
+        metrics.observe("review_seconds", result.latency, reviewer=reviewer)
+        metrics.inc("reviews_total", reviewer=reviewer)
+        metrics.inc("review_completions_total", len(completions), reviewer=reviewer)
+        metrics.inc(
+            "review_cache_hits_total", sum(completion.cache_hit for completion in completions), reviewer=reviewer
+        )
+        return result
+
+    @staticmethod
+    def _stream(
+            client: BaseClient,
+            prompt: str,
+            user_message: str,
+            context: Optional[List[Dict[str, str]]],
+            on_score: ScoreCallback
+    ) -> str:
+        score_parser = IncrementalScoreParser()
+        response = []
+        for chunk in client.stream(prompt, user_message, context=context):
+            response.append(chunk)
+            score = score_parser.feed(chunk)
+            if score is not None:
+                on_score(score)
+
+        score = score_parser.finish()
+        if score is not None:
+            on_score(score)
+        return "".join(response)
+
+
+@dataclasses.dataclass
+class BatchPolicy:
+    """
+    Bounds of a batch of questions sent in one request: at most `max_questions` questions
+    and at most `max_tokens` tokens of their text (a longer question goes alone).
+    """
+    max_questions: int = 5
+    max_tokens: int = 2000
+
+
+def pack_questions(sizes: List[int], policy: BatchPolicy) -> List[List[int]]:
+    """
+    Greedily split questions of the given sizes (in tokens) into consecutive batches within the policy.
+    """
+    batches: List[List[int]] = []
+    batch_tokens = 0
+    for i, size in enumerate(sizes):
+        if batches and len(batches[-1]) < policy.max_questions and batch_tokens + size <= policy.max_tokens:
+            batches[-1].append(i)
+            batch_tokens += size
+        else:
+            batches.append([i])
+            batch_tokens = size
+    return batches
+
+
+class StepByStepTaskReviewer(BaseReviewer):
+    def __init__(
+            self,
+            client: BaseClient,
+            cache: Optional[ResponseCache] = None,
+            budget: Optional[TokenBudget] = None,
+            batching: Optional[BatchPolicy] = None
+    ) -> None:
+        """
+        With a `budget` the context is trimmed so each request fits into it, otherwise it grows with every question.
+        Token usage of the calls of a review is returned by `review_with_usage`.
+
+        With `batching` several questions go in one request and the model answers each in its own
+        "### Вердикт N" section. Questions left without a verdict are asked again one by one.
+        """
         self.client = client
+        self.cache = cache
+        self.budget = budget or TokenBudget(max_tokens=None)
+        self.batching = batching
+
+    @property
+    def clients(self) -> List[BaseClient]:
+        return [self.client]
+
+    def _ask(
+            self,
+            prompt: str,
+            message: str,
+            context: List[Dict[str, str]],
+            completions: List[_Completion],
+            usages: List[TokenUsage]
+    ) -> str:
+        # the message is sent (and counted) apart from the context
+        request_context, usage = self.budget.fit(prompt, context, message)
+
+        call_start = time.perf_counter()
+        completion = self._call(self.client, prompt, message, context=request_context)
+        usage.latency = time.perf_counter() - call_start
+        completions.append(completion)
+        response = completion.text
+
+        usage.completion_tokens = self.budget.count(response)
+        if not completion.cache_hit:
+            usage.reported_input_tokens = completion.input_tokens
+            usage.reported_completion_tokens = completion.completion_tokens
+        usages.append(usage)
+
+        context.append(self.client.make_message("user", message))
+        context.append(self.client.make_message("assistant", response))
+        return response
+
+    def _ask_batched(
+            self,
+            prompt: str,
+            questions: List[str],
+            context: List[Dict[str, str]],
+            completions: List[_Completion],
+            usages: List[TokenUsage]
+    ) -> List[str]:
+        verdicts: List[Optional[str]] = [None] * len(questions)
+
+        for batch in pack_questions([self.budget.count(question) for question in questions], self.batching):
+            if len(batch) == 1:
+                i, = batch
+                verdicts[i] = self._ask(prompt, questions[i], context, completions, usages)
+                continue
+
+            message = "\n\n".join(f"### Вопрос {j + 1}\n{questions[i]}" for j, i in enumerate(batch))
+            batch_prompt = prompt + PROMPTS_GENERATOR["batch_suffix"](len(batch))
+            response = split_verdicts(self._ask(batch_prompt, message, context, completions, usages))
+            for j, i in enumerate(batch):
+                verdicts[i] = response.get(j + 1)
+
+        for i, question in enumerate(questions):
+            if verdicts[i] is None:
+                verdicts[i] = self._ask(prompt, question, context, completions, usages)
+        return verdicts
 
     def review(
             self,
             cells: List[NotebookCell],
             maximum_possible_score: Optional[int] = None,
             prompt: Optional[str] = None
-    ) -> str:
+    ) -> ReviewResult:
+        """
+        The score of the result is the mean score of the answered questions, comments of all verdicts are joined.
+        """
+        return self.review_with_usage(cells, maximum_possible_score, prompt)[0]
+
+    def review_with_usage(
+            self,
+            cells: List[NotebookCell],
+            maximum_possible_score: Optional[int] = None,
+            prompt: Optional[str] = None
+    ) -> Tuple[ReviewResult, List[TokenUsage]]:
+        """
+        `review` and the token usage of each of its calls.
+        """
+        start = time.perf_counter()
 
         if maximum_possible_score is None:
             maximum_possible_score = 10
@@ -23,53 +257,68 @@ class StepByStepTaskReviewer:
             prompt = PROMPTS_GENERATOR["advanced_prompt"](maximum_possible_score)
 
         context: List[Dict[str, str]] = []
+        completions: List[_Completion] = []
+        usages: List[TokenUsage] = []
 
         output: str = ""
-        query_json_field_name: str
-
-        if isinstance(self.client, YandexGPTClient):
-            query_json_field_name = "text"
-        elif isinstance(self.client, OpenAIClient):
-            query_json_field_name = "content"
-        else:
-            raise NotImplementedError("unsupported model, fix me!")
 
-        for i in range(0, (len(cells) // 2) * 2, 2):
-            question_cell, answer_cell = cells[i], cells[i + 1]
+        questions = [
+            f"{cells[i].raw_text} \n {cells[i + 1].raw_text}" for i in range(0, (len(cells) // 2) * 2, 2)
+        ]
 
-            merged_cell = f"{question_cell.raw_text} \n {answer_cell.raw_text}"
-
-            context.append(
-                {
-                    "role": "user",
-                    query_json_field_name: merged_cell
-                }
-            )
+        if self.batching is None:
+            verdicts = [
+                self._ask(prompt, question, context, completions, usages) for question in questions
+            ]
+        else:
+            verdicts = self._ask_batched(prompt, questions, context, completions, usages)
 
-            response = self.client.call(prompt, merged_cell, context=context)
+        for i, verdict in enumerate(verdicts):
+            output += f"\nVerdict for question {i + 1}:\n{verdict}\n"
 
-            context.append(
-                {
-                    "role": "assistant",
-                    query_json_field_name: response
-                }
-            )
+        result = self._review_result(output, completions, start, maximum_possible_score)
 
-            output += f"\nVerdict for question {i // 2 + 1}:\n{response}\n"
+        comments = []
+        scores = []
+        for verdict in verdicts:
+            match = SCORE_RE.search(verdict)
+            if match is not None:
+                scores.append(score_from_match(match).value)
+            comments.extend(parse_comments(verdict, match.start() if match else None))
 
-        return output
+        result.score = sum(scores) / len(scores) if scores else None
+        result.max_score = maximum_possible_score
+        result.comments = comments
+        return result, usages
 
 
-class FullTaskReviewer:
-    def __init__(self, client: BaseClient) -> None:
+class FullTaskReviewer(BaseReviewer):
+    def __init__(
+            self,
+            client: BaseClient,
+            cache: Optional[ResponseCache] = None,
+            on_score: Optional[ScoreCallback] = None
+    ) -> None:
+        """
+        With `on_score` the review is streamed, the callback gets the score as soon as its line is generated,
+        while `review` returns after the whole text. It is called from the thread running `review`.
+        """
         self.client = client
+        self.cache = cache
+        self.on_score = on_score
+
+    @property
+    def clients(self) -> List[BaseClient]:
+        return [self.client]
 
     def review(
             self,
             cells: List[NotebookCell],
             maximum_possible_score: Optional[int] = None,
             prompt: Optional[str] = None
-    ) -> str:
+    ) -> ReviewResult:
+        start = time.perf_counter()
+
         if maximum_possible_score is None:
             maximum_possible_score = 10
 
@@ -77,45 +326,53 @@ class FullTaskReviewer:
             prompt = PROMPTS_GENERATOR["advanced_prompt"](maximum_possible_score)
 
         solved_task = merge_task_into_single_string(cells)
-        return self.client.call(prompt, solved_task)
+        completion = self._call(self.client, prompt, solved_task, on_score=self.on_score)
+        return self._review_result(completion.text, [completion], start, maximum_possible_score)
 
 
-class CollaborativeTaskReviewer:
+class CollaborativeTaskReviewer(BaseReviewer):
     def __init__(
             self,
             primary_client: BaseClient,
             secondary_client: BaseClient,
             iterations: int = 2,
-            final_client: Optional[BaseClient] = None
+            final_client: Optional[BaseClient] = None,
+            cache: Optional[ResponseCache] = None,
+            parallel: bool = False,
+            early_exit: bool = False
     ) -> None:
+        """
+        In `parallel` mode the reviews go in rounds: primary and secondary clients are called concurrently,
+        each with the other's verdict from the previous round as feedback. There are ceil(iterations / 2) rounds,
+        the last one of an odd number of iterations calls only the primary client, so the number of calls
+        is the same as in the sequential mode.
+        With `early_exit` no more reviews are requested once the last two verdicts give the same score.
+        """
         self.primary_client = primary_client
         self.secondary_client = secondary_client
         self.iterations = iterations
         self.final_client = final_client or primary_client
+        self.cache = cache
+        self.parallel = parallel
+        self.early_exit = early_exit
+
+    @property
+    def clients(self) -> List[BaseClient]:
+        return [self.primary_client, self.secondary_client, self.final_client]
 
     def _build_context(self, client: BaseClient, text: str, history: list, feedback: Optional[str] = None) -> list:
-        context_key = 'text' if isinstance(client, YandexGPTClient) else 'content'
         new_entry = f"Feedback: {feedback}\n\n{text}" if feedback else text
-        return history + [{'role': 'user', context_key: new_entry}]
+        return history + [client.make_message('user', new_entry)]
 
     def _format_response(self, client: BaseClient, response: str) -> dict:
-        return {'role': 'assistant', 'text': response} if isinstance(client, YandexGPTClient) else {'role': 'assistant',
-                                                                                                    'content': response}
+        return client.make_message('assistant', response)
 
-    def review(
+    def _review_sequentially(
             self,
-            cells: List[NotebookCell],
-            maximum_possible_score: Optional[int] = None,
-            prompt: Optional[str] = None
-    ) -> str:
-        if not cells:
-            raise ValueError("No cells provided")
-
-        solved_task = merge_task_into_single_string(cells)
-
-        maximum_possible_score = maximum_possible_score or 10
-        prompt = prompt or PROMPTS_GENERATOR["advanced_prompt"](maximum_possible_score)
-
+            prompt: str,
+            solved_task: str
+    ) -> Tuple[List[Dict[str, str]], List[_Completion]]:
+        completions = []
         history = []
         last_feedback = None
 
@@ -123,23 +380,94 @@ class CollaborativeTaskReviewer:
             current_client = self.secondary_client if i % 2 else self.primary_client
             context = self._build_context(current_client, solved_task, history, last_feedback)
 
-            response = current_client.call(
+            completion = self._call(
+                current_client,
                 prompt=prompt,
                 user_message=solved_task,
                 context=context
             )
+            completions.append(completion)
+            response = completion.text
 
             formatted = self._format_response(current_client, response)
             history.append(formatted)
+
+            if self.early_exit and last_feedback is not None and _scores_agree(last_feedback, response):
+                break
             last_feedback = response
 
+        return history, completions
+
+    def _review_in_parallel_rounds(
+            self,
+            prompt: str,
+            solved_task: str
+    ) -> Tuple[List[Dict[str, str]], List[_Completion]]:
+        completions = []
+        history = []
+        primary_feedback = secondary_feedback = None
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for round_number in range((self.iterations + 1) // 2):
+                secondary_future = None
+                if 2 * round_number + 1 < self.iterations:
+                    secondary_context = self._build_context(
+                        self.secondary_client, solved_task, history, secondary_feedback
+                    )
+                    secondary_future = executor.submit(
+                        self._call, self.secondary_client, prompt, solved_task, secondary_context
+                    )
+
+                primary_context = self._build_context(self.primary_client, solved_task, history, primary_feedback)
+                primary_completion = self._call(self.primary_client, prompt, solved_task, primary_context)
+                if secondary_future is None:
+                    completions.append(primary_completion)
+                    history.append(self._format_response(self.primary_client, primary_completion.text))
+                    break
+
+                secondary_completion = secondary_future.result()
+                completions += [primary_completion, secondary_completion]
+                primary_response, secondary_response = primary_completion.text, secondary_completion.text
+
+                history.append(self._format_response(self.primary_client, primary_response))
+                history.append(self._format_response(self.secondary_client, secondary_response))
+
+                if self.early_exit and _scores_agree(primary_response, secondary_response):
+                    break
+                primary_feedback, secondary_feedback = secondary_response, primary_response
+
+        return history, completions
+
+    def review(
+            self,
+            cells: List[NotebookCell],
+            maximum_possible_score: Optional[int] = None,
+            prompt: Optional[str] = None
+    ) -> ReviewResult:
+        start = time.perf_counter()
+
+        if not cells:
+            raise ValueError("No cells provided")
+
+        solved_task = merge_task_into_single_string(cells)
+
+        maximum_possible_score = maximum_possible_score or 10
+        prompt = prompt or PROMPTS_GENERATOR["advanced_prompt"](maximum_possible_score)
+
+        if self.parallel:
+            history, completions = self._review_in_parallel_rounds(prompt, solved_task)
+        else:
+            history, completions = self._review_sequentially(prompt, solved_task)
+
         aggregation_prompt = PROMPTS_GENERATOR["aggregation_prompt"](
             maximum_possible_score,
-            self.iterations
+            len(history)
         )
 
-        return self.final_client.call(
+        final = self._call(
+            self.final_client,
             prompt=aggregation_prompt,
             user_message=solved_task,
             context=history
         )
+        return self._review_result(final.text, completions + [final], start, maximum_possible_score)
@@ -0,0 +1,243 @@
+import dataclasses
+import random
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class ProviderError(Exception):
+    """
+    Failed request to an LLM provider. `retryable` errors (429, 5xx, network) may succeed later,
+    `retry_after` is the delay in seconds requested by the provider, if any.
+    """
+
+    def __init__(
+            self,
+            message: str,
+            status: Optional[int] = None,
+            retry_after: Optional[float] = None,
+            retryable: bool = False
+    ) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+
+class CircuitOpenError(ProviderError):
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message, retry_after=retry_after, retryable=False)
+
+
+def is_retryable_status(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse the Retry-After header, only the delay-seconds form is supported.
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: holds up to `capacity` tokens, refilled at `rate` tokens per second.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        if rate <= 0 or capacity <= 0:
+            raise ValueError(f"rate and capacity must be positive, got {rate} and {capacity}")
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount: float) -> float:
+        """
+        Take `amount` tokens, possibly going into debt. Returns how long the caller has to wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return max(-self._tokens / self.rate, 0.0)
+
+    def acquire(self, amount: float = 1.0) -> None:
+        delay = self._reserve(min(amount, self.capacity))
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """
+    Limits requests per second and (estimated) tokens per minute, either limit may be omitted.
+    """
+
+    def __init__(
+            self,
+            requests_per_second: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+            burst: Optional[float] = None
+    ) -> None:
+        self.requests = None
+        if requests_per_second:
+            self.requests = TokenBucket(requests_per_second, burst or max(requests_per_second, 1.0))
+
+        self.tokens = None
+        if tokens_per_minute:
+            self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+
+    def acquire(self, tokens: int = 0) -> None:
+        if self.requests is not None:
+            self.requests.acquire()
+        if self.tokens is not None and tokens > 0:
+            self.tokens.acquire(tokens)
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    max_attempts: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Full-jitter exponential backoff for the given (0-based) attempt. Retry-After wins if it is longer.
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive retryable failures and rejects calls for `reset_timeout`
+    seconds. After that a single trial call is let through: success closes the circuit, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._trial_in_flight:
+                raise CircuitOpenError("Circuit breaker is open, provider keeps failing", max(remaining, 0.0))
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """
+        The trial call ended without telling anything about the provider health.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+@dataclasses.dataclass
+class SchedulerStats:
+    calls: int = 0
+    attempts: int = 0
+    retries: int = 0
+    failures: int = 0
+    rejected: int = 0
+
+
+class RequestScheduler:
+    """
+    Runs provider requests under a rate limiter, with retries of retryable `ProviderError`s
+    and a circuit breaker. One scheduler is meant to be shared by all clients using the same quota.
+    """
+
+    def __init__(
+            self,
+            rate_limiter: Optional[RateLimiter] = None,
+            retry_policy: Optional[RetryPolicy] = None,
+            circuit_breaker: Optional[CircuitBreaker] = None,
+            sleep: Callable[[float], None] = time.sleep
+    ) -> None:
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.stats = SchedulerStats()
+        self._stats_lock = threading.Lock()
+        self._sleep = sleep
+
+    def _count(self, field: str) -> None:
+        with self._stats_lock:
+            setattr(self.stats, field, getattr(self.stats, field) + 1)
+
+    def execute(self, request: Callable[[], T], estimated_tokens: int = 0) -> T:
+        self._count("calls")
+        attempt = 0
+        while True:
+            try:
+                self.circuit_breaker.before_call()
+            except CircuitOpenError:
+                self._count("rejected")
+                raise
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(estimated_tokens)
+
+            self._count("attempts")
+            try:
+                result = request()
+            except ProviderError as e:
+                if not e.retryable:
+                    # the provider is alive, the request itself is wrong
+                    self.circuit_breaker.record_success()
+                    self._count("failures")
+                    raise
+
+                self.circuit_breaker.record_failure()
+                attempt += 1
+                if attempt >= self.retry_policy.max_attempts or self.circuit_breaker.is_open:
+                    self._count("failures")
+                    raise
+
+                self._count("retries")
+                self._sleep(self.retry_policy.delay(attempt - 1, e.retry_after))
+                continue
+            except Exception:
+                self.circuit_breaker.release_trial()
+                raise
+
+            self.circuit_breaker.record_success()
+            return result
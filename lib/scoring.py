@@ -0,0 +1,70 @@
+import re
+from typing import NamedTuple, Optional
+
+# `advanced_prompt`: "Баллы: 7 из 10", "**Баллы:** [7] из 10", "Баллы: 7.5/10",
+# `aggregation_prompt`: "1) Итоговый балл: 7", "Итоговый балл (0-10): 7 из 10"
+SCORE_RE = re.compile(
+    r"(?:Баллы|Итоговый[ \t]+балл|Итоговая[ \t]+оценка)[ \t]*(?:\([^)\n]{0,20}\))?[ \t]*\**[ \t]*:?[ \t]*\**[ \t]*"
+    r"\[?[ \t]*(\d+(?:[.,]\d+)?)[ \t]*\]?(?:[ \t]*(?:из|/)[ \t]*(\d+))?",
+    flags=re.IGNORECASE
+)
+
+# A score line is never longer than this, older text can be skipped while scanning a stream
+_MAX_SCORE_LINE = 64
+
+
+class Score(NamedTuple):
+    value: float
+    max_score: Optional[int]
+
+
+def score_from_match(match: "re.Match[str]") -> Score:
+    value, max_score = match.groups()
+    return Score(float(value.replace(",", ".")), int(max_score) if max_score else None)
+
+
+def parse_score(text: str) -> Optional[Score]:
+    """
+    The first score of a review ("Баллы: X из N" or "Итоговый балл: X"), None if there is none.
+    """
+    match = SCORE_RE.search(text)
+    return score_from_match(match) if match else None
+
+
+class IncrementalScoreParser:
+    """
+    Finds the score in a review arriving in chunks. `feed` returns it once, as soon as its line is complete,
+    `finish` returns it at the end of the stream if the score line was the last one.
+    """
+
+    def __init__(self) -> None:
+        self.score: Optional[Score] = None
+        self._buffer = ""
+        self._scan_from = 0
+        self._reported = False
+
+    def feed(self, chunk: str) -> Optional[Score]:
+        if self._reported:
+            return None
+
+        self._buffer += chunk
+        match = SCORE_RE.search(self._buffer, self._scan_from)
+        if match is None or "\n" not in self._buffer[match.end():]:
+            # the number (or "из N") may continue in the next chunk
+            self._scan_from = max(0, len(self._buffer) - _MAX_SCORE_LINE) if match is None else match.start()
+            return None
+
+        return self._report(match)
+
+    def finish(self) -> Optional[Score]:
+        if self._reported:
+            return None
+        match = SCORE_RE.search(self._buffer, self._scan_from)
+        return self._report(match) if match else None
+
+    def _report(self, match: "re.Match[str]") -> Score:
+        self.score = score_from_match(match)
+        self._reported = True
+        # the rest of the review is not needed
+        self._buffer = ""
+        return self.score
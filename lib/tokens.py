@@ -0,0 +1,154 @@
+import dataclasses
+import enum
+from typing import List, Dict, Optional, Callable, Tuple
+
+# Returns the number of tokens in a text
+Tokenizer = Callable[[str], int]
+
+# Fixed cost of a message in the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_HEADER = "Краткое содержание предыдущих вопросов и вердиктов:"
+
+
+def heuristic_token_count(text: str) -> int:
+    """
+    Rough token count without a tokenizer: ~3 characters per token for Russian text and code.
+    """
+    return (len(text) + 2) // 3
+
+
+def tiktoken_token_count(encoding_name: str = "cl100k_base") -> Tokenizer:
+    """
+    Exact counter for OpenAI models, requires `tiktoken`.
+    """
+    import tiktoken
+
+    encoding = tiktoken.get_encoding(encoding_name)
+    return lambda text: len(encoding.encode(text))
+
+
+def message_text(message: Dict[str, str]) -> str:
+    return "".join(value for key, value in message.items() if key != "role")
+
+
+def message_text_key(message: Dict[str, str]) -> str:
+    return next(key for key in message if key != "role")
+
+
+class BudgetStrategy(enum.Enum):
+    # Oldest turns are dropped
+    DROP = 1
+
+    # Oldest turns are replaced with one system message holding the first line of each dropped verdict
+    # (with the advanced prompt it is the score). It is a system message, so the kept turns (or the question,
+    # if none are kept) still start with a user message
+    SUMMARIZE = 2
+
+
+@dataclasses.dataclass
+class TokenUsage:
+    prompt_tokens: int
+    context_tokens: int
+    message_tokens: int
+    completion_tokens: int = 0
+    dropped_messages: int = 0
+    latency: float = 0.0
+    # as reported by the provider, None if unknown (or the response came from cache)
+    reported_input_tokens: Optional[int] = None
+    reported_completion_tokens: Optional[int] = None
+
+    @property
+    def input_tokens(self) -> int:
+        return self.prompt_tokens + self.context_tokens + self.message_tokens
+
+
+class TokenBudget:
+    """
+    Keeps a request (prompt + context + user message + completion) under `max_tokens`
+    by removing the oldest context turns. With `max_tokens=None` it only counts tokens.
+    """
+
+    def __init__(
+            self,
+            max_tokens: Optional[int],
+            tokenizer: Tokenizer = heuristic_token_count,
+            strategy: BudgetStrategy = BudgetStrategy.SUMMARIZE,
+            completion_tokens: int = 500
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer
+        self.strategy = strategy
+        self.completion_tokens = completion_tokens
+
+    def count(self, text: str) -> int:
+        return self.tokenizer(text)
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        return self.count(message_text(message)) + MESSAGE_OVERHEAD_TOKENS
+
+    def count_context(self, context: List[Dict[str, str]]) -> int:
+        return sum(self.count_message(message) for message in context)
+
+    def _summarize(self, dropped: List[Dict[str, str]]) -> Optional[Dict[str, str]]:
+        verdicts = [
+            message_text(message).strip().split("\n", 1)[0]
+            for message in dropped if message["role"] == "assistant"
+        ]
+        verdicts = [verdict for verdict in verdicts if verdict]
+        if not verdicts:
+            return None
+
+        lines = "\n".join(f"{i + 1}. {verdict}" for i, verdict in enumerate(verdicts))
+        return {"role": "system", message_text_key(dropped[0]): f"{SUMMARY_HEADER}\n{lines}"}
+
+    def fit(
+            self,
+            prompt: str,
+            context: List[Dict[str, str]],
+            user_message: str
+    ) -> Tuple[List[Dict[str, str]], TokenUsage]:
+        """
+        Returns the context to send and the estimated usage. The newest turns are kept; turns are removed
+        in user/assistant pairs from the start so the conversation stays well-formed.
+        """
+        fixed = self.count(prompt) + self.count(user_message) + 2 * MESSAGE_OVERHEAD_TOKENS + self.completion_tokens
+        available = float("inf") if self.max_tokens is None else self.max_tokens - fixed
+
+        sizes = [self.count_message(message) for message in context]
+        total = sum(sizes)
+        start = 0
+
+        def drop_turn() -> None:
+            nonlocal total, start
+            step = 2 if start + 1 < len(context) and context[start]["role"] == "user" else 1
+            total -= sum(sizes[start:start + step])
+            start += step
+
+        while total > available and start < len(context):
+            drop_turn()
+
+        kept = context[start:]
+        if start and self.strategy == BudgetStrategy.SUMMARIZE:
+            # more turns are dropped to make room for the summary, if needed
+            while True:
+                summary = self._summarize(context[:start])
+                if summary is None:
+                    break
+                summary_size = self.count_message(summary)
+                if total + summary_size <= available:
+                    kept = [summary] + context[start:]
+                    total += summary_size
+                    break
+                if start == len(context):
+                    kept = []
+                    break
+                drop_turn()
+
+        usage = TokenUsage(
+            prompt_tokens=self.count(prompt),
+            context_tokens=total,
+            message_tokens=self.count(user_message),
+            dropped_messages=start
+        )
+        return kept, usage
@@ -0,0 +1,320 @@
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import List, Dict, Optional, Iterable, Iterator, Callable
+
+from lib.batch import BatchGrader, ReviewJob, JobResult
+from lib.cellstore import CellStore
+from lib.journal import file_hash, reviewer_name
+from lib.parser import MergeKind, NotebookLoader, DiffMode, get_notebooks_filenames_from_directory
+from lib.results import ReviewResult
+
+INDEX_VERSION = 1
+
+
+def task_hash(text: str, maximum_possible_score: Optional[int], reviewer: str) -> str:
+    """
+    Identifies what a task review depends on: the merged text sent to the model
+    (see `merge_task_into_single_string`), the maximum score and the reviewer.
+    """
+    payload = json.dumps([text, maximum_possible_score, reviewer], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclasses.dataclass
+class TaskEntry:
+    text_hash: str
+    maximum_possible_score: Optional[int] = None
+    # None until the task is reviewed successfully
+    result: Optional[ReviewResult] = None
+    # repr of the error of the last failed review
+    error: Optional[str] = None
+
+
+@dataclasses.dataclass
+class NotebookEntry:
+    # os.stat of the file when it was hashed, an unchanged pair means unchanged content
+    mtime_ns: int
+    size: int
+    # sha256 of the file
+    digest: str
+    tasks: Dict[int, TaskEntry] = dataclasses.field(default_factory=dict)
+    # repr of the error, if the notebook couldn't be parsed
+    error: Optional[str] = None
+
+
+@dataclasses.dataclass
+class ScanReport:
+    notebooks: int = 0
+    # notebooks with new content, parsed again
+    parsed: int = 0
+    # notebooks with a new mtime or size but the same content
+    touched: int = 0
+    removed: int = 0
+    reviewed: int = 0
+    # tasks of parsed notebooks whose merged text didn't change, their results are kept
+    reused: int = 0
+    failed: int = 0
+    # notebooks with new content that couldn't be parsed
+    unparsed: int = 0
+    seconds: float = 0.0
+    # results of the reviews made by this scan
+    results: List[JobResult] = dataclasses.field(default_factory=list)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.parsed or self.removed or self.reviewed)
+
+
+class WatchIndex:
+    """
+    Path -> file stat and hash -> per-task text hash -> review result, saved as JSON after every scan
+    that changed it. `settings` are the parsing settings the tasks were parsed with (see `IncrementalGrader`).
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self.settings: Dict[str, object] = {}
+        self.notebooks: Dict[str, NotebookEntry] = {}
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf-8") as file:
+            data = json.load(file)
+        if data.get("version") != INDEX_VERSION:
+            return
+
+        self.settings = data["settings"]
+        for path, entry in data["notebooks"].items():
+            tasks = {
+                int(index): TaskEntry(
+                    task["text_hash"], task["maximum_possible_score"],
+                    ReviewResult.from_dict(task["result"]) if task["result"] is not None else None,
+                    task["error"]
+                )
+                for index, task in entry["tasks"].items()
+            }
+            self.notebooks[path] = NotebookEntry(
+                entry["mtime_ns"], entry["size"], entry["digest"], tasks, entry["error"]
+            )
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+
+        data = {
+            "version": INDEX_VERSION,
+            "settings": self.settings,
+            "notebooks": {
+                path: {
+                    "mtime_ns": entry.mtime_ns,
+                    "size": entry.size,
+                    "digest": entry.digest,
+                    "error": entry.error,
+                    "tasks": {
+                        str(index): {
+                            "text_hash": task.text_hash,
+                            "maximum_possible_score": task.maximum_possible_score,
+                            "result": task.result.to_dict() if task.result is not None else None,
+                            "error": task.error,
+                        }
+                        for index, task in entry.tasks.items()
+                    },
+                }
+                for path, entry in self.notebooks.items()
+            },
+        }
+        # a crash while writing must not lose the previous index
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(temporary_path, self.path)
+
+
+class IncrementalGrader:
+    """
+    Grades a directory of submissions again and again, doing only the work changed files require.
+
+    A scan compares the stat of every notebook with the index and hashes only files with a new mtime or size,
+    notebooks with new content are parsed again, and only their tasks with a new merged text
+    (see `task_hash`) are reviewed. Reviews that failed are retried by the next scan.
+    A changed original notebook or parsing settings make every notebook parsed again, reviews are still
+    reused where the merged text of a task is the same.
+    """
+
+    def __init__(
+            self,
+            grader: BatchGrader,
+            original_notebook_path: str,
+            kind: MergeKind,
+            tasks_count: int,
+            index: Optional[WatchIndex] = None,
+            task_indices: Optional[Iterable[int]] = None,
+            loader: NotebookLoader = NotebookLoader.FAST,
+            diff_mode: DiffMode = DiffMode.EXACT,
+            max_workers: Optional[int] = None
+    ) -> None:
+        self.grader = grader
+        self.original_notebook_path = original_notebook_path
+        self.kind = kind
+        self.tasks_count = tasks_count
+        self.index = index or WatchIndex()
+        self.task_indices = list(range(tasks_count) if task_indices is None else task_indices)
+        self.loader = loader
+        self.diff_mode = diff_mode
+        self.max_workers = max_workers
+
+    def _settings(self) -> Dict[str, object]:
+        return {
+            "original": file_hash(self.original_notebook_path),
+            "kind": self.kind.name,
+            "tasks_count": self.tasks_count,
+            "diff_mode": self.diff_mode.name,
+            # notebooks are checked again, so their tasks get reviews of the current reviewer
+            "reviewer": reviewer_name(self.grader.reviewer),
+            "task_indices": sorted(self.task_indices),
+        }
+
+    def _changed_paths(self, paths: List[str], report: ScanReport) -> List[str]:
+        changed = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                entry = self.index.notebooks.get(path)
+                if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                    continue
+                digest = file_hash(path)
+            except OSError:
+                # removed or renamed after the listing, the next scan sees it gone
+                continue
+
+            if entry is not None and entry.digest == digest:
+                entry.mtime_ns, entry.size = stat.st_mtime_ns, stat.st_size
+                report.touched += 1
+                continue
+
+            # the stat is taken before hashing, a file changed meanwhile is hashed again by the next scan
+            entry = self.index.notebooks.setdefault(path, NotebookEntry(0, 0, ""))
+            entry.mtime_ns, entry.size, entry.digest = stat.st_mtime_ns, stat.st_size, digest
+            changed.append(path)
+        return changed
+
+    def _jobs(self, changed: List[str], report: ScanReport) -> Iterator[ReviewJob]:
+        """
+        Updates the index entries of the notebooks right away, the merged cells of the jobs are built
+        from a `CellStore` only when the grader takes them.
+        """
+        reviewer = reviewer_name(self.grader.reviewer)
+        store = CellStore(self.original_notebook_path, self.tasks_count, self.loader, self.diff_mode)
+        reviews = []
+        for path, notebook in store.load(changed, self.max_workers):
+            entry = self.index.notebooks[path]
+            if notebook is None:
+                entry.error, entry.tasks = repr(store.errors[path]), {}
+                report.unparsed += 1
+                continue
+
+            marks = store.marks(notebook)
+            tasks = {}
+            for j in self.task_indices:
+                text_hash = task_hash(store.task_text(notebook, j, self.kind), marks[j], reviewer)
+                previous = entry.tasks.get(j)
+                if previous is not None and previous.text_hash == text_hash and previous.result is not None:
+                    tasks[j] = previous
+                    report.reused += 1
+                    continue
+                tasks[j] = TaskEntry(text_hash, marks[j])
+                reviews.append((notebook, j))
+            entry.error, entry.tasks = None, tasks
+        return (
+            ReviewJob(store.paths[notebook], j, store.task_cells(notebook, j, self.kind), store.marks(notebook)[j])
+            for notebook, j in reviews
+        )
+
+    def _unreviewed_paths(self, skip: List[str]) -> List[str]:
+        """
+        Unchanged notebooks with tasks left without a review, they are parsed again to retry.
+        """
+        skip = set(skip)
+        return [
+            path for path, entry in self.index.notebooks.items()
+            if path not in skip and any(task.result is None for task in entry.tasks.values())
+        ]
+
+    def scan(self, directory: str) -> ScanReport:
+        start = time.perf_counter()
+        report = ScanReport()
+
+        settings = self._settings()
+        if settings != self.index.settings:
+            self.index.settings = settings
+            for entry in self.index.notebooks.values():
+                entry.mtime_ns = entry.size = -1
+                entry.digest = ""
+
+        paths = sorted(get_notebooks_filenames_from_directory(directory))
+        report.notebooks = len(paths)
+        for path in set(self.index.notebooks) - set(paths):
+            del self.index.notebooks[path]
+            report.removed += 1
+
+        changed = self._changed_paths(paths, report)
+        report.parsed = len(changed)
+        retried = self._unreviewed_paths(changed)
+        jobs = self._jobs(changed + retried, report) if changed or retried else []
+
+        for result in self.grader.iter_results(jobs):
+            task = self.index.notebooks[result.job.notebook_path].tasks[result.job.task_index]
+            if result.ok:
+                task.result, task.error = result.review, None
+                report.reviewed += 1
+            else:
+                task.error = repr(result.error)
+                report.failed += 1
+            report.results.append(result)
+
+        if report.changed or report.touched or report.failed or report.unparsed:
+            self.index.save()
+        report.seconds = time.perf_counter() - start
+        return report
+
+    def results(self) -> List[JobResult]:
+        """
+        Current result of every task of every notebook, failed ones with the error of the last attempt.
+        Every task of a notebook that couldn't be parsed fails with the parsing error.
+        """
+        results = []
+        for path, entry in sorted(self.index.notebooks.items()):
+            if entry.error is not None:
+                for j in self.task_indices:
+                    results.append(JobResult(ReviewJob(path, j, []), error=RuntimeError(entry.error)))
+                continue
+            for j, task in sorted(entry.tasks.items()):
+                job = ReviewJob(path, j, [], task.maximum_possible_score)
+                if task.result is not None:
+                    results.append(JobResult(job, review=task.result))
+                else:
+                    results.append(JobResult(job, error=RuntimeError(task.error or "not reviewed yet")))
+        return results
+
+    def watch(
+            self,
+            directory: str,
+            interval: float = 30.0,
+            on_scan: Optional[Callable[[ScanReport], None]] = None,
+            stop: Optional[threading.Event] = None
+    ) -> None:
+        """
+        Scan every `interval` seconds until `stop` is set.
+        """
+        stop = stop or threading.Event()
+        while True:
+            report = self.scan(directory)
+            if on_scan is not None:
+                on_scan(report)
+            if stop.wait(interval):
+                return
@@ -1,2 +1,303 @@
+"""
+Batch grading of homework notebooks.
+
+    python main.py grade --works works --original original.ipynb --tasks 3 --output results.xlsx
+    python main.py watch --works works --original original.ipynb --tasks 3 --output results.csv
+
+Grading on several hosts, the coordinator fills a shared queue and every host runs workers:
+
+    python main.py coordinate --works works --original original.ipynb --tasks 3 --queue queue.sqlite
+    python main.py work --queue queue.sqlite --config config.yaml
+"""
+import argparse
+import sys
+from typing import List, Dict, Optional
+
+import yaml
+
+from lib import metrics
+from lib.batch import BatchGrader
+from lib.cellstore import CellStore
+from lib.clients import BaseClient
+from lib.dedup import DedupIndex
+from lib.distributed import SQLiteJobQueue, Coordinator, Worker
+from lib.export import create_writer
+from lib.journal import JobJournal
+from lib.providers import available_providers, create_client
+from lib.parser import MergeKind, NotebookLoader, DiffMode, get_notebooks_filenames_from_directory
+from lib.reviewers import FullTaskReviewer, StepByStepTaskReviewer, CollaborativeTaskReviewer
+from lib.watch import IncrementalGrader, ScanReport, WatchIndex
+
+REVIEWERS = ["full", "step-by-step", "collaborative"]
+
+
+def load_config(path: str) -> Dict[str, str]:
+    with open(path, encoding="utf-8") as file:
+        return yaml.safe_load(file) or {}
+
+
+def create_reviewer(name: str, clients: List[BaseClient]):
+    if name == "full":
+        return FullTaskReviewer(clients[0])
+    elif name == "step-by-step":
+        return StepByStepTaskReviewer(clients[0])
+    elif name == "collaborative":
+        return CollaborativeTaskReviewer(clients[0], clients[-1], parallel=True)
+    else:
+        raise ValueError(f"Unsupported reviewer, FIX ME!: {name}")
+
+
+def task_indices(args: argparse.Namespace) -> List[int]:
+    return list(range(args.tasks)) if args.grade_tasks is None else [i - 1 for i in args.grade_tasks]
+
+
+def grade(args: argparse.Namespace) -> int:
+    if args.metrics:
+        metrics.enable()
+
+    config = load_config(args.config)
+    clients = [create_client(provider, config) for provider in args.provider]
+    reviewer = create_reviewer(args.reviewer, clients)
+
+    works = get_notebooks_filenames_from_directory(args.works)
+    # the cohort is kept in a compact store, the merged cells of a job are built just before it runs
+    store = CellStore(
+        args.original, args.tasks, loader=NotebookLoader[args.loader.upper()],
+        diff_mode=DiffMode[args.diff_mode.upper()]
+    )
+    jobs = store.load_jobs(works, MergeKind[args.merge_kind.upper()], task_indices=task_indices(args))
+
+    journal = None if args.no_journal else JobJournal(args.journal or f"{args.output}.journal.jsonl")
+    dedup = None if args.dedup is None else DedupIndex(threshold=args.dedup)
+    grader = BatchGrader(
+        reviewer, max_concurrency=args.concurrency, provider_limits=args.provider_limits,
+        journal=journal, dedup=dedup
+    )
+
+    failed = 0
+    try:
+        with create_writer(args.output, flush_rows=args.flush_rows, flush_interval=args.flush_interval) as writer:
+            for result in grader.iter_results(jobs):
+                writer.write(result)
+                failed += not result.ok
+                print(f"[{writer.rows_written}] {result.job.notebook_path}, task {result.job.task_index + 1}: "
+                      f"{result.review.score if result.ok else result.error!r}", file=sys.stderr)
+    finally:
+        if journal is not None:
+            journal.close()
+        for client in clients:
+            client.close()
+        if args.metrics:
+            metrics.get_registry().write(args.metrics)
+
+    print(f"{writer.rows_written} results written to {args.output}, {failed} failed", file=sys.stderr)
+    if dedup is not None and args.dedup_report:
+        with open(args.dedup_report, "w", encoding="utf-8-sig", newline="") as file:
+            groups = dedup.write_report(file)
+        print(f"{groups} groups of duplicate submissions written to {args.dedup_report}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def watch(args: argparse.Namespace) -> int:
+    config = load_config(args.config)
+    clients = [create_client(provider, config) for provider in args.provider]
+    grader = BatchGrader(
+        create_reviewer(args.reviewer, clients), max_concurrency=args.concurrency, provider_limits=args.provider_limits
+    )
+    incremental = IncrementalGrader(
+        grader, args.original, MergeKind[args.merge_kind.upper()], args.tasks,
+        index=WatchIndex(args.index or f"{args.works.rstrip('/')}.index.json"), task_indices=task_indices(args),
+        loader=NotebookLoader[args.loader.upper()], diff_mode=DiffMode[args.diff_mode.upper()]
+    )
+
+    def on_scan(report: ScanReport) -> None:
+        for result in report.results:
+            print(f"{result.job.notebook_path}, task {result.job.task_index + 1}: "
+                  f"{result.review.score if result.ok else result.error!r}", file=sys.stderr)
+        print(f"{report.notebooks} notebooks, {report.parsed} changed, {report.removed} removed, "
+              f"{report.reviewed} tasks reviewed, {report.reused} kept, {report.failed} failed, "
+              f"{report.unparsed} notebooks not parsed "
+              f"in {report.seconds:.2f}s", file=sys.stderr)
+        if args.output and report.changed:
+            # the export is rewritten with all current results
+            with create_writer(args.output) as writer:
+                writer.write_all(incremental.results())
+
+    try:
+        if args.once:
+            report = incremental.scan(args.works)
+            on_scan(report)
+            return 1 if report.failed or report.unparsed else 0
+        incremental.watch(args.works, interval=args.interval, on_scan=on_scan)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for client in clients:
+            client.close()
+    return 0
+
+
+def coordinate(args: argparse.Namespace) -> int:
+    queue = SQLiteJobQueue(args.queue, max_attempts=args.max_attempts)
+    coordinator = Coordinator(
+        queue, args.original, MergeKind[args.merge_kind.upper()], args.tasks, reviewer=args.reviewer,
+        task_indices=task_indices(args), loader=NotebookLoader[args.loader.upper()],
+        diff_mode=DiffMode[args.diff_mode.upper()]
+    )
+
+    failed = 0
+    try:
+        added = coordinator.submit(get_notebooks_filenames_from_directory(args.works))
+        print(f"{added} jobs added to {args.queue}, {queue.unfinished_count()} unfinished", file=sys.stderr)
+        if args.no_wait:
+            return 0
+
+        with create_writer(args.output, flush_rows=args.flush_rows, flush_interval=args.flush_interval) as writer:
+            for result in coordinator.iter_results(poll_interval=args.poll_interval):
+                writer.write(result)
+                failed += not result.ok
+                print(f"[{writer.rows_written}] {result.job.notebook_path}, task {result.job.task_index + 1}: "
+                      f"{result.review.score if result.ok else result.error!r}", file=sys.stderr)
+
+        print(f"{writer.rows_written} results written to {args.output}, {failed} failed", file=sys.stderr)
+        return 1 if failed else 0
+    finally:
+        queue.close()
+
+
+def work(args: argparse.Namespace) -> int:
+    if args.metrics:
+        metrics.enable()
+
+    config = load_config(args.config)
+    clients = [create_client(provider, config) for provider in args.provider]
+    queue = SQLiteJobQueue(args.queue, max_attempts=args.max_attempts)
+    worker = Worker(
+        queue, {name: create_reviewer(name, clients) for name in REVIEWERS}, concurrency=args.concurrency,
+        worker_id=args.worker_id, lease_seconds=args.lease, max_job_seconds=args.max_job_time
+    )
+
+    try:
+        worker.run(wait=args.wait)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+        for client in clients:
+            client.close()
+        if args.metrics:
+            metrics.get_registry().write(args.metrics)
+
+    stats = worker.stats
+    print(f"{worker.worker_id}: {stats.leased} jobs leased, {stats.completed} completed, {stats.failed} failed, "
+          f"{stats.lost} lost", file=sys.stderr)
+    return 0
+
+
+def parse_provider_limits(values: Optional[List[str]]) -> Dict[str, int]:
+    limits = {}
+    for value in values or []:
+        provider, _, limit = value.partition("=")
+        limits[provider] = int(limit)
+    return limits
+
+
+def add_notebook_arguments(command_parser: argparse.ArgumentParser) -> None:
+    command_parser.add_argument("--works", required=True, help="directory with the students' notebooks")
+    command_parser.add_argument("--original", required=True, help="the notebook given to the students")
+    command_parser.add_argument("--tasks", type=int, required=True, help="number of tasks in the notebook")
+    command_parser.add_argument("--grade-tasks", type=int, nargs="+", help="1-based tasks to review, all by default")
+    command_parser.add_argument("--reviewer", choices=REVIEWERS, default="full")
+    command_parser.add_argument("--merge-kind", choices=[kind.name.lower() for kind in MergeKind], default="by_change")
+    command_parser.add_argument("--loader", choices=[loader.name.lower() for loader in NotebookLoader], default="fast")
+    command_parser.add_argument("--diff-mode", choices=[mode.name.lower() for mode in DiffMode], default="exact")
+
+
+def add_client_arguments(command_parser: argparse.ArgumentParser) -> None:
+    command_parser.add_argument("--config", default="config.yaml")
+    command_parser.add_argument(
+        "--provider", choices=available_providers(), nargs="+", default=["yandex"],
+        help="the collaborative reviewer uses the first and the last one"
+    )
+    command_parser.add_argument("--concurrency", type=int, default=8)
+
+
+def add_common_arguments(command_parser: argparse.ArgumentParser) -> None:
+    add_notebook_arguments(command_parser)
+    add_client_arguments(command_parser)
+    command_parser.add_argument(
+        "--provider-limit", dest="provider_limits", action="append", metavar="PROVIDER=N",
+        help="concurrent jobs per provider, e.g. yandex=4"
+    )
+
+
+def build_argument_parser() -> argparse.ArgumentParser:
+    argument_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = argument_parser.add_subparsers(dest="command", required=True)
+
+    grade_parser = commands.add_parser("grade", help="review every notebook of a directory and export the results")
+    add_common_arguments(grade_parser)
+    grade_parser.add_argument("--output", default="results.xlsx", help=".xlsx, .csv or .parquet")
+    grade_parser.add_argument("--journal", help="job journal to resume from, <output>.journal.jsonl by default")
+    grade_parser.add_argument("--no-journal", action="store_true")
+    grade_parser.add_argument(
+        "--dedup", type=float, metavar="THRESHOLD",
+        help="review one submission per group of duplicates with at least this similarity, 1.0 for exact copies"
+    )
+    grade_parser.add_argument("--dedup-report", help="CSV with the groups of duplicate submissions")
+    grade_parser.add_argument("--flush-rows", type=int, default=50)
+    grade_parser.add_argument("--flush-interval", type=float, default=30.0, help="seconds")
+    grade_parser.add_argument(
+        "--metrics", metavar="PATH",
+        help="write timings and counters of the run, JSON for a .json file, Prometheus text format otherwise"
+    )
+    grade_parser.set_defaults(handler=grade)
+
+    watch_parser = commands.add_parser(
+        "watch", help="grade a directory on every change, reviewing only the tasks of changed notebooks"
+    )
+    add_common_arguments(watch_parser)
+    watch_parser.add_argument("--output", help="export rewritten with all results after every scan with changes")
+    watch_parser.add_argument("--index", help="index of the grading state, <works>.index.json by default")
+    watch_parser.add_argument("--interval", type=float, default=30.0, help="seconds between scans")
+    watch_parser.add_argument("--once", action="store_true", help="scan once and exit")
+    watch_parser.set_defaults(handler=watch)
+
+    coordinate_parser = commands.add_parser(
+        "coordinate", help="put the jobs of a directory into a queue shared by workers and export their results"
+    )
+    add_notebook_arguments(coordinate_parser)
+    coordinate_parser.add_argument("--queue", required=True, help="SQLite file of the queue, reachable by the workers")
+    coordinate_parser.add_argument("--output", default="results.xlsx", help=".xlsx, .csv or .parquet")
+    coordinate_parser.add_argument("--no-wait", action="store_true", help="exit once the jobs are queued")
+    coordinate_parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds")
+    coordinate_parser.add_argument("--max-attempts", type=int, default=3, help="attempts of a job before it fails")
+    coordinate_parser.add_argument("--flush-rows", type=int, default=50)
+    coordinate_parser.add_argument("--flush-interval", type=float, default=30.0, help="seconds")
+    coordinate_parser.set_defaults(handler=coordinate)
+
+    work_parser = commands.add_parser("work", help="review jobs from a queue filled by `coordinate`")
+    add_client_arguments(work_parser)
+    work_parser.add_argument("--queue", required=True)
+    work_parser.add_argument("--worker-id", help="hostname:pid:random by default")
+    work_parser.add_argument("--lease", type=float, default=60.0, help="seconds a job stays leased without heartbeats")
+    work_parser.add_argument("--max-attempts", type=int, default=3, help="attempts of a job before it fails")
+    work_parser.add_argument(
+        "--max-job-time", type=float, default=1800.0, help="seconds after which a hung review loses its lease"
+    )
+    work_parser.add_argument("--wait", action="store_true", help="keep waiting for new jobs when the queue is empty")
+    work_parser.add_argument("--metrics", metavar="PATH", help="write timings and counters of the worker")
+    work_parser.set_defaults(handler=work)
+
+    return argument_parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_argument_parser().parse_args(argv)
+    if hasattr(args, "provider_limits"):
+        args.provider_limits = parse_provider_limits(args.provider_limits)
+    return args.handler(args)
+
+
 if __name__ == '__main__':
-    pass
+    sys.exit(main())
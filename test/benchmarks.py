@@ -0,0 +1,684 @@
+"""
+Benchmarks of the parsing stages and of end-to-end grading against a simulated-latency client.
+Run from the test directory:
+
+    python benchmarks.py [--output results.json] [--suites pipeline reviewers]
+"""
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import parser
+from lib.batch import BatchGrader, jobs_from_parsed
+from lib.cellstore import CellStore
+from lib.distributed import SQLiteJobQueue, Coordinator, Worker
+from lib.mock import MockClient, lognormal_latency
+from lib.reviewers import FullTaskReviewer, StepByStepTaskReviewer, CollaborativeTaskReviewer, BatchPolicy
+from lib.scheduler import RequestScheduler, RetryPolicy, CircuitBreaker
+from lib.watch import IncrementalGrader
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "original.ipynb")
+
+
+def legacy_normalize_text(text: str) -> str:
+    """
+    Reference implementation of `parser.normalize_text` before the patterns were precompiled.
+    """
+    text = text.strip()
+    text = re.sub(r'\r\n', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = re.sub(r'[ \t]+', ' ', text)
+    return text
+
+
+def legacy_scan_task_header(text: str) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Reference header and score detection of `parser.parse_and_mark_cells_by_tasks`.
+    """
+    header_match = re.search(r"##\s*([Зз])адача\s*(\d+)", text, flags=re.IGNORECASE)
+    if not header_match:
+        return None
+    score_match = re.search(r"(\d+)\s*([Бб]аллов)", text)
+    return int(header_match.group(2)), int(score_match.group(1)) if score_match else None
+
+
+def measure(func: Callable[[], object], repeat: int = 3) -> Dict[str, float]:
+    """
+    Best wall time over `repeat` runs and peak traced memory of a single run.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds": best, "peak_mib": peak / 2 ** 20}
+
+
+def make_image_output(image_kib: int, rng: random.Random) -> dict:
+    payload = base64.b64encode(rng.randbytes(image_kib * 1024 * 3 // 4)).decode()
+    return {
+        "data": {"image/png": payload, "text/plain": ["<Figure size 640x480 with 1 Axes>"]},
+        "metadata": {},
+        "output_type": "display_data"
+    }
+
+
+def generate_notebook(path: str, repeats: int, images_per_cell: int = 1, image_kib: int = 64, seed: int = 0) -> None:
+    """
+    Write a notebook made of `repeats` copies of the template cells, each followed by
+    a code cell with plot outputs of `image_kib` KiB.
+    """
+    rng = random.Random(seed)
+    with open(TEMPLATE_PATH, encoding="utf-8") as file:
+        template = json.load(file)
+
+    cells = []
+    for i in range(repeats):
+        cells.extend(dict(cell, id=f"{cell.get('id', 'cell')}-{i}") for cell in template["cells"])
+        cells.append({
+            "cell_type": "code",
+            "execution_count": i + 1,
+            "id": f"plot-{i}",
+            "metadata": {},
+            "outputs": [make_image_output(image_kib, rng) for _ in range(images_per_cell)],
+            "source": ["import matplotlib.pyplot as plt\n", f"plt.plot(range({i}))"]
+        })
+
+    notebook = dict(template, cells=cells)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(notebook, file, ensure_ascii=False, indent=1)
+
+
+def load_without_ijson(path: str) -> List[parser.NotebookCell]:
+    """
+    FAST loader using the json fallback.
+    """
+    ijson, parser.ijson = parser.ijson, None
+    try:
+        return parser.get_filtered_notebook_cells_from_notebook(path, parser.NotebookLoader.FAST)
+    finally:
+        parser.ijson = ijson
+
+
+def bench_loaders(directory: str, sizes: List[int]) -> List[Dict[str, object]]:
+    results = []
+    for repeats in sizes:
+        path = os.path.join(directory, f"notebook_{repeats}.ipynb")
+        generate_notebook(path, repeats)
+
+        expected = parser.get_filtered_notebook_cells_from_notebook(path, parser.NotebookLoader.NBFORMAT)
+        loaders = {
+            "nbformat": lambda: parser.get_filtered_notebook_cells_from_notebook(path, parser.NotebookLoader.NBFORMAT),
+            "fast": lambda: parser.get_filtered_notebook_cells_from_notebook(path, parser.NotebookLoader.FAST),
+            "fast-json": lambda: load_without_ijson(path),
+        }
+        for name, load in loaders.items():
+            assert load() == expected, f"{name} loader output differs"
+            results.append(dict(
+                benchmark="loader",
+                loader=name,
+                ijson=name == "fast" and parser.ijson is not None,
+                cells=repeats * 6,
+                file_mib=os.path.getsize(path) / 2 ** 20,
+                **measure(load)
+            ))
+    return results
+
+
+def generate_cell_texts(count: int, seed: int = 0) -> List[str]:
+    """
+    Texts resembling notebook cells: template markdown, task headers, code with indentation and blank lines.
+    """
+    rng = random.Random(seed)
+    with open(TEMPLATE_PATH, encoding="utf-8") as file:
+        template = ["".join(cell["source"]) for cell in json.load(file)["cells"]]
+
+    code = "def f(x):\r\n    return  x ** 2\n\n\n\nfor i in range(10):\n\tprint(f(i))  # comment\n"
+    texts = []
+    for i in range(count):
+        kind = rng.randrange(4)
+        if kind == 0:
+            texts.append(f"## Задача {rng.randint(1, 5)} ({rng.randint(1, 10)} баллов)")
+        elif kind == 1:
+            texts.append(code * rng.randint(1, 5))
+        else:
+            texts.append(rng.choice(template) + "\n" + " ".join(rng.choice(template) for _ in range(3)))
+    return texts
+
+
+def bench_text_scanning(count: int) -> List[Dict[str, object]]:
+    texts = generate_cell_texts(count)
+
+    assert [parser.normalize_text(t) for t in texts] == [legacy_normalize_text(t) for t in texts]
+    assert [parser.scan_task_header(t) for t in texts] == [legacy_scan_task_header(t) for t in texts]
+
+    functions = {
+        ("normalize_text", "legacy"): legacy_normalize_text,
+        ("normalize_text", "compiled"): parser.normalize_text,
+        ("scan_task_header", "legacy"): legacy_scan_task_header,
+        ("scan_task_header", "compiled"): parser.scan_task_header,
+    }
+    results = []
+    for (benchmark, implementation), func in functions.items():
+        timing = measure(lambda: [func(t) for t in texts])
+        results.append(dict(
+            benchmark=benchmark,
+            implementation=implementation,
+            texts=count,
+            seconds=timing["seconds"],
+            texts_per_second=count / timing["seconds"]
+        ))
+    return results
+
+
+def bench_diff_modes(sizes: List[int]) -> List[Dict[str, object]]:
+    """
+    `mark_modified_cells` on template-like notebooks of `size` cells where every fifth cell is edited.
+    """
+    results = []
+    for size in sizes:
+        texts = generate_cell_texts(size)
+        original = [parser.NotebookCell(False, parser.CellType.OTHER, text) for text in texts]
+        student = [
+            parser.NotebookCell(False, parser.CellType.OTHER, text + "\nanswer = 42" if i % 5 == 0 else text)
+            for i, text in enumerate(texts)
+        ]
+        for mode in parser.DiffMode:
+            timing = measure(lambda: parser.mark_modified_cells(original, student, mode=mode), repeat=1)
+            marked = parser.mark_modified_cells(original, student, mode=mode)
+            results.append(dict(
+                benchmark="mark_modified_cells",
+                mode=mode.name,
+                cells=size,
+                seconds=timing["seconds"],
+                changed_chars=sum(len(c.raw_text) for c in marked if c.is_changed)
+            ))
+    return results
+
+
+def generate_assignment(path: str, tasks: int, subtasks: int = 2) -> None:
+    """
+    Write an original notebook of `tasks` tasks with `subtasks` questions each, made of the template cells:
+    a "## Задача N" header, then a question and an empty "Решение:" cell per subtask.
+    """
+    with open(TEMPLATE_PATH, encoding="utf-8") as file:
+        template = json.load(file)
+    header, questions = template["cells"][0], template["cells"][1:]
+
+    cells = []
+    for task in range(1, tasks + 1):
+        source = re.sub(r"\d+", str(task), "".join(header["source"]), count=1)
+        cells.append(dict(header, id=f"task-{task}", source=[source]))
+        for subtask in range(subtasks):
+            question, solution = questions[2 * (subtask % (len(questions) // 2)):][:2]
+            source = re.sub(r"\d+", str(subtask + 1), "".join(question["source"]), count=1)
+            cells.append(dict(question, id=f"question-{task}-{subtask}", source=[source]))
+            cells.append(dict(solution, id=f"solution-{task}-{subtask}"))
+
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(dict(template, cells=cells), file, ensure_ascii=False, indent=1)
+
+
+def generate_code(lines: int, rng: random.Random) -> str:
+    statements = [
+        "sample = np.random.normal({a}, {b}, {n})",
+        "mean = np.mean(sample[:{n}])",
+        "variance = np.var(sample) * {a}",
+        "print(f'{{mean:.{b}f}}', variance)",
+        "for i in range({n}):\n    total += i ** {b}",
+        "plt.hist(sample, bins={n})",
+    ]
+    return "\n".join(
+        rng.choice(statements).format(a=rng.randint(0, 9), b=rng.randint(1, 5), n=rng.randint(10, 100000))
+        for _ in range(lines)
+    )
+
+
+def generate_submission(
+        original_path: str,
+        path: str,
+        seed: int,
+        code_lines: int = 8,
+        images_per_cell: int = 0,
+        image_kib: int = 64,
+        solved_share: float = 0.9
+) -> None:
+    """
+    Write a student's copy of the original notebook: `solved_share` of the "Решение:" cells are answered
+    with some text and followed by a code cell of `code_lines` lines with `images_per_cell` plot outputs.
+    """
+    rng = random.Random(seed)
+    with open(original_path, encoding="utf-8") as file:
+        notebook = json.load(file)
+
+    cells = []
+    for cell in notebook["cells"]:
+        if not "".join(cell["source"]).startswith("Решение") or rng.random() >= solved_share:
+            cells.append(cell)
+            continue
+        answer = f"Решение: ответ {rng.randint(0, 100)}, проверим численно на выборке из {rng.randint(10, 10 ** 6)}."
+        cells.append(dict(cell, source=[answer]))
+        cells.append({
+            "cell_type": "code",
+            "execution_count": len(cells),
+            "id": f"answer-{len(cells)}",
+            "metadata": {},
+            "outputs": [make_image_output(image_kib, rng) for _ in range(images_per_cell)],
+            "source": [generate_code(code_lines, rng)]
+        })
+
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(dict(notebook, cells=cells), file, ensure_ascii=False, indent=1)
+
+
+def generate_cohort(
+        directory: str,
+        notebooks: int,
+        tasks: int,
+        subtasks: int = 2,
+        code_lines: int = 8,
+        images_per_cell: int = 0,
+        image_kib: int = 64
+) -> Tuple[str, List[str]]:
+    """
+    The original notebook and `notebooks` submissions of it, returns their paths.
+    """
+    original_path = os.path.join(directory, "original.ipynb")
+    generate_assignment(original_path, tasks, subtasks)
+
+    paths = []
+    for i in range(notebooks):
+        path = os.path.join(directory, f"student_{i}.ipynb")
+        generate_submission(original_path, path, seed=i, code_lines=code_lines,
+                            images_per_cell=images_per_cell, image_kib=image_kib)
+        paths.append(path)
+    return original_path, paths
+
+
+def bench_pipeline(
+        original_path: str,
+        paths: List[str],
+        tasks: int,
+        workers: Optional[int] = None
+) -> List[Dict[str, object]]:
+    """
+    `parsing_pipeline` notebook by notebook and `parse_notebooks` in a process pool over a generated cohort.
+    Memory of the pool is traced in the main process only.
+    """
+    cohort = dict(
+        notebooks=len(paths),
+        tasks=tasks,
+        cohort_mib=sum(os.path.getsize(path) for path in paths) / 2 ** 20,
+    )
+
+    def sequential() -> list:
+        return [
+            parser.parsing_pipeline(path, original_path, parser.MergeKind.BY_CHANGE, tasks,
+                                    loader=parser.NotebookLoader.FAST)
+            for path in paths
+        ]
+
+    def pool() -> list:
+        return list(parser.parse_notebooks(
+            paths, original_path, parser.MergeKind.BY_CHANGE, tasks,
+            max_workers=workers, loader=parser.NotebookLoader.FAST
+        ))
+
+    parsed = pool()
+    assert all(notebook.error is None and len(notebook.tasks) == tasks for notebook in parsed)
+    by_path = {notebook.path: notebook.tasks for notebook in parsed}
+    assert [by_path[path] for path in paths] == [tasks for tasks, _ in sequential()]
+
+    results = []
+    for name, run, repeat in [("sequential", sequential, 3), ("process-pool", pool, 1)]:
+        timing = measure(run, repeat=repeat)
+        results.append(dict(
+            benchmark="parsing_pipeline",
+            mode=name,
+            **cohort,
+            **timing,
+            notebooks_per_second=len(paths) / timing["seconds"],
+            mib_per_second=cohort["cohort_mib"] / timing["seconds"]
+        ))
+    return results
+
+
+def mock_review(prompt: str, user_message: str, context: List[Dict[str, str]]) -> str:
+    """
+    A review in the format asked by the prompts, with a verdict per question of a batched request.
+    """
+    review = "Баллы: 7 из 10\nКомментарии:\n- решение верное\n- не хватает проверки на выборке"
+    questions = user_message.count("### Вопрос")
+    if not questions:
+        return review
+    return "\n\n".join(f"### Вердикт {i}\n{review}" for i in range(1, questions + 1))
+
+
+def bench_reviewers(
+        original_path: str,
+        paths: List[str],
+        tasks: int,
+        latency: float,
+        concurrency: int,
+        error_rate: float = 0.0
+) -> List[Dict[str, object]]:
+    """
+    End-to-end `BatchGrader` throughput of every reviewer on the parsed cohort. Calls go to a `MockClient`
+    with lognormal latency around `latency` seconds and fail with `error_rate`, failures are retried
+    by a shared `RequestScheduler`.
+    """
+    jobs = list(jobs_from_parsed(parser.parse_notebooks(
+        paths, original_path, parser.MergeKind.BY_CHANGE, tasks, loader=parser.NotebookLoader.FAST
+    )))
+
+    reviewers = {
+        "full": lambda clients: FullTaskReviewer(clients[0]),
+        "step-by-step": lambda clients: StepByStepTaskReviewer(clients[0]),
+        "step-by-step-batched": lambda clients: StepByStepTaskReviewer(clients[0], batching=BatchPolicy()),
+        "collaborative": lambda clients: CollaborativeTaskReviewer(clients[0], clients[1], parallel=True),
+    }
+    results = []
+    for name, create_reviewer in reviewers.items():
+        scheduler = RequestScheduler(
+            retry_policy=RetryPolicy(max_attempts=10, base_delay=latency / 10),
+            circuit_breaker=CircuitBreaker(failure_threshold=10 ** 6)
+        )
+        clients = [
+            MockClient(mock_review, lognormal_latency(latency, maximum=latency * 10), error_rate, seed=seed,
+                       scheduler=scheduler)
+            for seed in range(2)
+        ]
+        grader = BatchGrader(create_reviewer(clients), max_concurrency=concurrency)
+
+        start = time.perf_counter()
+        job_results = grader.run(jobs)
+        seconds = time.perf_counter() - start
+
+        reviews = [result.review for result in job_results if result.ok]
+        calls = sum(client.calls for client in clients)
+        results.append(dict(
+            benchmark="reviewer",
+            reviewer=name,
+            jobs=len(jobs),
+            failed=len(job_results) - len(reviews),
+            concurrency=concurrency,
+            mock_latency=latency,
+            error_rate=error_rate,
+            seconds=seconds,
+            jobs_per_second=len(jobs) / seconds,
+            calls=calls,
+            calls_per_job=calls / len(jobs),
+            retries=scheduler.stats.retries,
+            mean_review_latency=sum(review.latency for review in reviews) / max(len(reviews), 1)
+        ))
+    return results
+
+
+def bench_watch(original_path: str, paths: List[str], tasks: int, edited: int = 5) -> List[Dict[str, object]]:
+    """
+    `IncrementalGrader` scans of a cohort directory: the first one, a rescan without changes
+    and a rescan after `edited` notebooks got a new answer.
+    """
+    directory = os.path.dirname(paths[0])
+    works = os.path.join(directory, "watched")
+    os.makedirs(works, exist_ok=True)
+    watched = []
+    for path in paths:
+        watched.append(os.path.join(works, os.path.basename(path)))
+        with open(path, "rb") as source, open(watched[-1], "wb") as target:
+            target.write(source.read())
+
+    client = MockClient(mock_review)
+    grader = IncrementalGrader(
+        BatchGrader(FullTaskReviewer(client), max_concurrency=32), original_path, parser.MergeKind.BY_CHANGE, tasks
+    )
+
+    results = []
+
+    def scan(name: str) -> None:
+        report = grader.scan(works)
+        results.append(dict(
+            benchmark="watch_scan",
+            scan=name,
+            notebooks=report.notebooks,
+            parsed=report.parsed,
+            reviewed=report.reviewed,
+            seconds=report.seconds
+        ))
+
+    scan("initial")
+    scan("unchanged")
+    for path in watched[:edited]:
+        with open(path, encoding="utf-8") as file:
+            notebook = json.load(file)
+        notebook["cells"].append({"cell_type": "markdown", "id": "edit", "metadata": {}, "source": ["Исправлено"]})
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(notebook, file, ensure_ascii=False)
+    scan("edited")
+    return results
+
+
+def run_distributed_worker(queue_path: str, latency: float, concurrency: int) -> None:
+    queue = SQLiteJobQueue(queue_path)
+    client = MockClient(mock_review, lognormal_latency(latency, maximum=latency * 10))
+    Worker(queue, {"full": FullTaskReviewer(client)}, concurrency=concurrency, poll_interval=0.05).run()
+    queue.close()
+
+
+def bench_distributed(
+        original_path: str,
+        paths: List[str],
+        tasks: int,
+        latency: float,
+        concurrency: int,
+        worker_counts: List[int]
+) -> List[Dict[str, object]]:
+    """
+    Cohort grading through a `SQLiteJobQueue` by 1, 2, ... worker processes of `concurrency` threads,
+    as if every worker was a host with its own quota. Efficiency is the speedup over one worker
+    divided by the number of workers.
+    """
+    directory = os.path.dirname(paths[0])
+    results = []
+    base_seconds = None
+    for workers in worker_counts:
+        queue_path = os.path.join(directory, f"queue_{workers}.sqlite")
+        queue = SQLiteJobQueue(queue_path)
+        coordinator = Coordinator(queue, original_path, parser.MergeKind.BY_CHANGE, tasks)
+        jobs = coordinator.submit(paths)
+
+        start = time.perf_counter()
+        processes = [
+            multiprocessing.Process(target=run_distributed_worker, args=(queue_path, latency, concurrency))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        finished = sum(1 for _ in coordinator.iter_results(poll_interval=0.05))
+        seconds = time.perf_counter() - start
+        for process in processes:
+            process.join()
+        queue.close()
+
+        base_seconds = base_seconds or seconds * worker_counts[0]
+        results.append(dict(
+            benchmark="distributed",
+            workers=workers,
+            concurrency=concurrency,
+            jobs=jobs,
+            finished=finished,
+            mock_latency=latency,
+            seconds=seconds,
+            jobs_per_second=jobs / seconds,
+            efficiency=base_seconds / seconds / workers
+        ))
+    return results
+
+
+def bench_cell_memory(
+        directory: str,
+        notebooks: int,
+        tasks: int,
+        subtasks: int,
+        code_lines: int
+) -> List[Dict[str, object]]:
+    """
+    Memory held by a parsed cohort of `notebooks` generated submissions: the `parsing_pipeline` cells of every
+    notebook kept in lists versus a `CellStore`, and the time to build the merged texts of all tasks from each.
+    """
+    cohort_directory = os.path.join(directory, "memory")
+    os.makedirs(cohort_directory, exist_ok=True)
+    original_path, paths = generate_cohort(cohort_directory, notebooks, tasks, subtasks, code_lines)
+    kind = parser.MergeKind.BY_CHANGE
+
+    def build_lists() -> list:
+        return [
+            parser.parsing_pipeline(path, original_path, kind, tasks, loader=parser.NotebookLoader.FAST)[0]
+            for path in paths
+        ]
+
+    def build_store() -> CellStore:
+        store = CellStore(original_path, tasks)
+        store.extend(paths)
+        return store
+
+    def texts_from_lists(parsed: list) -> int:
+        return sum(len(parser.merge_task_into_single_string(task)) for notebook in parsed for task in notebook)
+
+    def texts_from_store(store: CellStore) -> int:
+        return sum(len(store.task_text(n, j, kind)) for n in range(len(store)) for j in range(tasks))
+
+    results = []
+    for name, build, texts in [("dataclass-lists", build_lists, texts_from_lists),
+                               ("cell-store", build_store, texts_from_store)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        parsed = build()
+        seconds = time.perf_counter() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        characters = texts(parsed)
+        results.append(dict(
+            benchmark="cell_memory",
+            representation=name,
+            notebooks=notebooks,
+            tasks=tasks,
+            parse_seconds=seconds,
+            retained_mib=retained / 2 ** 20,
+            peak_mib=peak / 2 ** 20,
+            bytes_per_notebook=retained / notebooks,
+            merged_text_seconds=time.perf_counter() - start,
+            merged_characters=characters,
+        ))
+        del parsed
+    return results
+
+
+def environment() -> Dict[str, object]:
+    return dict(
+        benchmark="environment",
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        ijson=parser.ijson is not None,
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+
+
+def print_results(results: List[Dict[str, object]]) -> None:
+    for result in results:
+        print(", ".join(f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items()))
+
+
+SUITES = ["loaders", "scanning", "diff", "pipeline", "reviewers", "watch", "distributed", "memory"]
+
+
+def main() -> None:
+    argument_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argument_parser.add_argument("--output", help="write results as JSON to this file")
+    argument_parser.add_argument("--suites", choices=SUITES, nargs="+", default=SUITES)
+    argument_parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100])
+    argument_parser.add_argument("--texts", type=int, default=20000, help="cell texts for the scanning benchmarks")
+    argument_parser.add_argument("--diff-sizes", type=int, nargs="+", default=[1000, 10000])
+    argument_parser.add_argument("--notebooks", type=int, default=200, help="submissions in the generated cohort")
+    argument_parser.add_argument("--tasks", type=int, default=5)
+    argument_parser.add_argument("--subtasks", type=int, default=3, help="questions per task")
+    argument_parser.add_argument("--code-lines", type=int, default=8, help="lines of every answer code cell")
+    argument_parser.add_argument("--images", type=int, default=1, help="plot outputs of every answer code cell")
+    argument_parser.add_argument("--image-kib", type=int, default=64)
+    argument_parser.add_argument("--workers", type=int, help="parsing processes, CPU count by default")
+    argument_parser.add_argument("--latency", type=float, default=0.05, help="median mock completion latency, s")
+    argument_parser.add_argument("--error-rate", type=float, default=0.0, help="share of failed mock completions")
+    argument_parser.add_argument("--concurrency", type=int, default=32)
+    argument_parser.add_argument(
+        "--review-notebooks", type=int, default=20, help="submissions of the cohort graded by the reviewers suite"
+    )
+    argument_parser.add_argument(
+        "--distributed-workers", type=int, nargs="+", default=[1, 2, 4], help="worker processes to compare"
+    )
+    argument_parser.add_argument("--worker-concurrency", type=int, default=4, help="threads of a distributed worker")
+    argument_parser.add_argument(
+        "--memory-notebooks", type=int, default=1000, help="submissions of the cohort of the memory suite"
+    )
+    args = argument_parser.parse_args()
+
+    results = [environment()]
+    with tempfile.TemporaryDirectory() as directory:
+        if "loaders" in args.suites:
+            results += bench_loaders(directory, args.sizes)
+        if {"pipeline", "reviewers", "watch", "distributed"} & set(args.suites):
+            original_path, paths = generate_cohort(
+                directory, max(args.notebooks, args.review_notebooks), args.tasks, args.subtasks,
+                args.code_lines, args.images, args.image_kib
+            )
+            if "pipeline" in args.suites:
+                results += bench_pipeline(original_path, paths[:args.notebooks], args.tasks, args.workers)
+            if "reviewers" in args.suites:
+                results += bench_reviewers(
+                    original_path, paths[:args.review_notebooks], args.tasks,
+                    args.latency, args.concurrency, args.error_rate
+                )
+            if "watch" in args.suites:
+                results += bench_watch(original_path, paths[:args.notebooks], args.tasks)
+            if "distributed" in args.suites:
+                results += bench_distributed(
+                    original_path, paths[:args.review_notebooks], args.tasks,
+                    args.latency, args.worker_concurrency, args.distributed_workers
+                )
+        if "memory" in args.suites:
+            results += bench_cell_memory(
+                directory, args.memory_notebooks, args.tasks, args.subtasks, args.code_lines
+            )
+    if "scanning" in args.suites:
+        results += bench_text_scanning(args.texts)
+    if "diff" in args.suites:
+        results += bench_diff_modes(args.diff_sizes)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
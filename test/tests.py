@@ -1,7 +1,212 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+from typing import Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import openpyxl
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import benchmarks
+import main
 import lib.parser
 from lib import parser
+from lib import export
+from lib import metrics
+from lib.batch import BatchGrader, ReviewJob, JobResult
+from lib.dedup import DedupIndex
+from lib.deferred import DeferredClient, PollPolicy
+from lib.distributed import SQLiteJobQueue, Coordinator, Worker, QueuedJob, JobStatus
+from lib.journal import JobJournal
+from lib.mock import MockClient, replay_responder, uniform_latency, constant_latency
+from lib.providers import available_providers, create_client, provider_scheduler
+from lib.cache import ResponseCache
+from lib.cellstore import CellStore
+from lib.clients import YandexGPTClient
+from lib.results import ReviewResult, parse_review, dump_jsonl, load_jsonl
+from lib.reviewers import FullTaskReviewer, StepByStepTaskReviewer, CollaborativeTaskReviewer, BatchPolicy, pack_questions
+from lib.scoring import Score, IncrementalScoreParser, parse_score
+from lib.tokens import TokenBudget, BudgetStrategy, SUMMARY_HEADER
+from lib.watch import IncrementalGrader, WatchIndex
+from lib.scheduler import (
+    RequestScheduler, RateLimiter, RetryPolicy, CircuitBreaker, ProviderError, CircuitOpenError
+)
+
+
+def generate_private_key() -> str:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode()
+
+
+class FakeYandexServer:
+    """
+    Local stand-in for the IAM and foundation models endpoints.
+    Completions echo the user message after `delay` seconds.
+    Streamed completions come in chunks of `STREAM_CHUNK` characters every `stream_delay` seconds.
+    Deferred completions are done `operation_delay` seconds after submission, operations listed in
+    `failed_operations` finish with an error.
+    """
+
+    STREAM_CHUNK = 8
+
+    def __init__(
+            self,
+            delay: float = 0.0,
+            token_lifetime: float = 3600.0,
+            stream_delay: float = 0.0,
+            operation_delay: float = 0.0
+    ) -> None:
+        self.delay = delay
+        self.operation_delay = operation_delay
+        self.stream_delay = stream_delay
+        self.token_lifetime = token_lifetime
+        self.issued_tokens = 0
+        self.rejected_tokens = set()
+        # statuses returned by the next completion requests instead of a result
+        self.failures: list = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completions = 0
+        # messages of the last completion request
+        self.last_messages: list = []
+        # operation id -> (time it is done, text)
+        self.operations: dict = {}
+        self.failed_operations: set = set()
+        self.operation_polls = 0
+        # statuses returned by the next operation polls instead of the operation
+        self.poll_failures: list = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, avoid delayed ACK stalls on kept-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if self.path.startswith("/iam"):
+                    with server.lock:
+                        server.issued_tokens += 1
+                        token = f"token-{server.issued_tokens}"
+                    expires_at = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time.time() + server.token_lifetime))
+                    self._send({"iamToken": token, "expiresAt": f"{expires_at}.123456789Z"})
+                    return
+
+                if self.headers["Authorization"].split()[-1] in server.rejected_tokens:
+                    self._send({"error": {"httpCode": 401, "message": "Unauthorized"}}, status=401)
+                    return
+
+                with server.lock:
+                    failure = server.failures.pop(0) if server.failures else None
+                if failure is not None:
+                    self._send({"error": {"httpCode": failure}}, status=failure, headers={"Retry-After": "0.01"})
+                    return
+
+                with server.lock:
+                    server.in_flight += 1
+                    server.completions += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                time.sleep(server.delay)
+                with server.lock:
+                    server.in_flight -= 1
+
+                server.last_messages = body["messages"]
+                text = body["messages"][-1]["text"]
+                if self.path.endswith("/completionAsync"):
+                    with server.lock:
+                        operation_id = f"operation-{len(server.operations) + 1}"
+                        server.operations[operation_id] = (time.monotonic() + server.operation_delay, text)
+                    self._send({"id": operation_id, "done": False})
+                    return
+                if body["completionOptions"].get("stream"):
+                    self._send_stream(text)
+                    return
+                self._send({"result": {"alternatives": [{"message": {"role": "assistant", "text": text}}]}})
+
+            def do_GET(self) -> None:
+                operation_id = self.path.rsplit("/", 1)[-1]
+                with server.lock:
+                    server.operation_polls += 1
+                    operation = server.operations.get(operation_id)
+                    failure = server.poll_failures.pop(0) if server.poll_failures else None
+                if failure is not None:
+                    self._send({"error": {"httpCode": failure}}, status=failure, headers={"Retry-After": "0.01"})
+                    return
+                if operation is None:
+                    self._send({"error": {"httpCode": 404, "message": "Not found"}}, status=404)
+                    return
+
+                done_at, text = operation
+                if time.monotonic() < done_at:
+                    self._send({"id": operation_id, "done": False})
+                elif operation_id in server.failed_operations:
+                    self._send({"id": operation_id, "done": True, "error": {"code": 13, "message": "Internal"}})
+                else:
+                    self._send({"id": operation_id, "done": True, "response": {
+                        "alternatives": [{"message": {"role": "assistant", "text": text}}],
+                        "usage": {"inputTextTokens": "3", "completionTokens": "5", "totalTokens": "8"}
+                    }})
+
+            def _send_stream(self, text: str) -> None:
+                lines = []
+                for end in range(server.STREAM_CHUNK, len(text) + server.STREAM_CHUNK, server.STREAM_CHUNK):
+                    lines.append(json.dumps({"result": {
+                        "alternatives": [{"message": {"role": "assistant", "text": text[:end]}}],
+                        "usage": {"inputTextTokens": "3", "completionTokens": str(len(lines) + 1)}
+                    }}).encode() + b"\n")
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(sum(map(len, lines))))
+                self.end_headers()
+                for line in lines:
+                    self.wfile.write(line)
+                    self.wfile.flush()
+                    time.sleep(server.stream_delay)
+
+            def _send(self, payload: dict, status: int = 200, headers: Optional[dict] = None) -> None:
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def client(self, scheduler: Optional[RequestScheduler] = None) -> YandexGPTClient:
+        return YandexGPTClient(
+            "service-account", "key-id", PRIVATE_KEY, "folder",
+            llm_url=self.url, iam_url=f"{self.url}/iam", operation_url=self.url, scheduler=scheduler
+        )
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+PRIVATE_KEY = generate_private_key()
 
 
 class TestParser(unittest.TestCase):
@@ -28,6 +233,1364 @@ class TestParser(unittest.TestCase):
         # there is one tasks, which costs 10 points
         self.assertEqual(marks, [10])
 
+    def test_fast_loader(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "notebook.ipynb")
+            benchmarks.generate_notebook(path, repeats=3, image_kib=4)
+            with open(path, encoding="utf-8") as file:
+                notebook = json.load(file)
+            notebook["cells"].append({
+                "cell_type": "markdown", "id": "attached", "source": ["![image.png](attachment:image.png)"],
+                "metadata": {"attachments": {"image.png": {"image/png": "iVBORw0KGgo="}}}
+            })
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(notebook, file)
+
+            for notebook_path in ["solved.ipynb", "original.ipynb", path]:
+                expected = parser.get_filtered_notebook_cells_from_notebook(notebook_path)
+                self.assertEqual(
+                    parser.get_filtered_notebook_cells_from_notebook(notebook_path, parser.NotebookLoader.FAST),
+                    expected
+                )
+                self.assertEqual(benchmarks.load_without_ijson(notebook_path), expected)
+
+    def test_line_diff_mode(self):
+        markdown, code = parser.CellType.MARKDOWN, parser.CellType.CODE
+        original = [
+            parser.NotebookCell(False, markdown, "## Задача 1 (5 баллов)"),
+            parser.NotebookCell(False, code, "import numpy as np\nx = 1\nprint(x)"),
+            parser.NotebookCell(False, markdown, "Ответ:"),
+        ]
+        student = [
+            parser.NotebookCell(False, markdown, "## Задача 1 (5 баллов)"),
+            parser.NotebookCell(False, code, "import numpy as np\nx = 2\nprint(x)\n\nprint(x ** 2)"),
+            parser.NotebookCell(False, markdown, "Ответ:  4"),
+            parser.NotebookCell(False, markdown, "Новая ячейка"),
+        ]
+
+        marked = parser.mark_modified_cells(original, student, mode=parser.DiffMode.LINES)
+
+        self.assertEqual(
+            [(c.is_changed, c.raw_text) for c in marked],
+            [
+                (False, "## Задача 1 (5 баллов)"),
+                (False, "import numpy as np"),
+                (True, "x = 2"),
+                (False, "print(x)\n"),
+                (True, "print(x ** 2)"),
+                (True, "Ответ:  4"),
+                (True, "Новая ячейка"),
+            ]
+        )
+        self.assertEqual(
+            [c.is_changed for c in parser.mark_modified_cells(original, student)],
+            [False, True, True, True]
+        )
+
+    def test_text_scanning_matches_reference(self):
+        rng = random.Random(0)
+        texts = benchmarks.generate_cell_texts(500)
+        texts += ["".join(rng.choice(" \t\r\na") for _ in range(rng.randint(0, 12))) for _ in range(5000)]
+        texts += ["## ЗАДАЧА 2", "#Задача 1 (5 баллов)", "5 баллов\n## задача 3"]
+
+        for text in texts:
+            self.assertEqual(parser.normalize_text(text), benchmarks.legacy_normalize_text(text))
+            self.assertEqual(parser.scan_task_header(text), benchmarks.legacy_scan_task_header(text))
+
+    def test_parse_notebooks(self):
+        expected = parser.parsing_pipeline("solved.ipynb", "original.ipynb", parser.MergeKind.BY_CHANGE, 1)
+
+        results = {
+            result.path: result
+            for result in parser.parse_notebooks(
+                ["solved.ipynb", "missing.ipynb"], "original.ipynb", parser.MergeKind.BY_CHANGE, 1, max_workers=2
+            )
+        }
+
+        self.assertEqual((results["solved.ipynb"].tasks, results["solved.ipynb"].marks), expected)
+        self.assertIsInstance(results["missing.ipynb"].error, FileNotFoundError)
+
+    def test_generated_cohort(self):
+        with tempfile.TemporaryDirectory() as directory:
+            original_path, paths = benchmarks.generate_cohort(directory, 3, tasks=4, images_per_cell=1, image_kib=4)
+            tasks, marks = parser.parsing_pipeline(paths[0], original_path, parser.MergeKind.BY_CHANGE, 4)
+
+            self.assertEqual(marks, [10] * 4)
+            self.assertTrue(all(any(cell.is_changed for cell in task) for task in tasks))
+
+            results = benchmarks.bench_reviewers(original_path, paths, 4, latency=0.001, concurrency=8)
+            self.assertEqual({result["reviewer"] for result in results},
+                             {"full", "step-by-step", "step-by-step-batched", "collaborative"})
+            self.assertTrue(all(result["jobs"] == 12 and result["failed"] == 0 for result in results))
+
+
+class TestYandexClientSession(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeYandexServer()
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_connection_is_reused(self):
+        for i in range(5):
+            self.assertEqual(self.client.call("prompt", f"message {i}"), f"message {i}")
+
+        completion_timings = [t for t in self.client.timings if t.url.endswith("/completion")]
+        self.assertEqual(len(completion_timings), 5)
+        self.assertEqual([t.new_connections for t in completion_timings[1:]], [0] * 4)
+        # the fake server also serves the IAM token request
+        self.assertEqual(self.client.pool_stats(), {"requests": 6, "connections": 1})
+
+
+class TestIamTokenManager(unittest.TestCase):
+    def test_background_refresh(self):
+        server = FakeYandexServer(token_lifetime=2)
+        client = server.client()
+        try:
+            self.assertEqual(client.token, "token-1")
+            self.assertAlmostEqual(client.tokens.expires_at, time.time() + 2, delta=1.5)
+
+            time.sleep(1.5)
+
+            # refreshed by the background thread, before the old token expired
+            self.assertEqual(client.tokens.refresh_count, 2)
+            self.assertEqual(client.token, "token-2")
+        finally:
+            client.close()
+            server.close()
+
+    def test_retry_on_unauthorized(self):
+        server = FakeYandexServer()
+        client = server.client()
+        try:
+            server.rejected_tokens.add("token-1")
+
+            threads = [threading.Thread(target=client.call, args=("prompt", "message")) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(client.call("prompt", "message"), "message")
+            # concurrent 401s lead to a single refresh
+            self.assertEqual(server.issued_tokens, 2)
+        finally:
+            client.close()
+            server.close()
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeYandexServer()
+        self.client = self.server.client()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.sqlite")
+        self.task = [parser.NotebookCell(True, parser.CellType.CODE, "print(1)")]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.directory.cleanup()
+
+    def test_memory_and_disk_tiers(self):
+        cache = ResponseCache(self.path)
+        reviewer = FullTaskReviewer(self.client, cache=cache)
+
+        self.assertEqual(str(reviewer.review(self.task)), str(reviewer.review(self.task)))
+        self.assertEqual(self.server.completions, 1)
+        self.assertEqual((cache.stats.memory_hits, cache.stats.misses), (1, 1))
+        cache.close()
+
+        cache = ResponseCache(self.path)
+        FullTaskReviewer(self.client, cache=cache).review(self.task)
+        self.assertEqual(self.server.completions, 1)
+        self.assertEqual(cache.stats.disk_hits, 1)
+        cache.close()
+
+    def test_ttl_and_eviction(self):
+        cache = ResponseCache(self.path, memory_items=1, max_disk_bytes=10, ttl=0.2)
+        cache.put("a", "12345")
+        cache.put("b", "12345")
+        cache.put("c", "12345")
+
+        self.assertEqual((cache.stats.memory_evictions, cache.stats.disk_evictions), (2, 1))
+        self.assertEqual(cache.stats.evictions, 3)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), "12345")
+
+        time.sleep(0.3)
+        self.assertIsNone(cache.get("c"))
+        cache.close()
+
+
+class TestRequestScheduler(unittest.TestCase):
+    def test_retries_honour_retry_after(self):
+        delays = []
+        scheduler = RequestScheduler(retry_policy=RetryPolicy(base_delay=0.001), sleep=delays.append)
+        server = FakeYandexServer()
+        client = server.client(scheduler=scheduler)
+        try:
+            server.failures = [429, 503]
+
+            self.assertEqual(client.call("prompt", "message"), "message")
+            self.assertEqual(scheduler.stats.retries, 2)
+            self.assertTrue(all(delay >= 0.01 for delay in delays))
+
+            server.failures = [400]
+            with self.assertRaises(ProviderError) as error:
+                client.call("prompt", "message")
+            self.assertEqual(error.exception.status, 400)
+            self.assertEqual(scheduler.stats.retries, 2)
+        finally:
+            client.close()
+            server.close()
+
+    def test_circuit_breaker(self):
+        scheduler = RequestScheduler(
+            retry_policy=RetryPolicy(max_attempts=10),
+            circuit_breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.1),
+            sleep=lambda _: None
+        )
+        calls = []
+
+        def failing_request():
+            calls.append(1)
+            raise ProviderError("unavailable", status=503, retryable=True)
+
+        with self.assertRaises(ProviderError):
+            scheduler.execute(failing_request)
+        self.assertEqual(len(calls), 3)
+
+        with self.assertRaises(CircuitOpenError):
+            scheduler.execute(failing_request)
+        self.assertEqual(len(calls), 3)
+
+        time.sleep(0.15)
+        self.assertEqual(scheduler.execute(lambda: "ok"), "ok")
+        self.assertFalse(scheduler.circuit_breaker.is_open)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(requests_per_second=20, tokens_per_minute=60000, burst=1)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire(100)
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+
+class TestTokenBudget(unittest.TestCase):
+    def setUp(self):
+        self.context = []
+        for i in range(6):
+            self.context.append({"role": "user", "text": f"question {i} " + "x" * 300})
+            self.context.append({"role": "assistant", "text": f"Баллы: {i} из 10\nкомментарий " + "y" * 300})
+
+    def test_drop_oldest_turns(self):
+        budget = TokenBudget(max_tokens=800, strategy=BudgetStrategy.DROP, completion_tokens=100)
+
+        kept, usage = budget.fit("prompt", self.context, "question")
+
+        self.assertEqual(kept, self.context[-len(kept):])
+        self.assertEqual(len(kept) % 2, 0)
+        self.assertEqual(usage.dropped_messages, len(self.context) - len(kept))
+        self.assertLessEqual(usage.input_tokens + 100, 800)
+
+    def test_summarize_oldest_turns(self):
+        budget = TokenBudget(max_tokens=800, completion_tokens=100)
+
+        kept, usage = budget.fit("prompt", self.context, "question")
+
+        self.assertTrue(kept[0]["text"].startswith(SUMMARY_HEADER))
+        self.assertIn("1. Баллы: 0 из 10", kept[0]["text"])
+        self.assertLessEqual(usage.input_tokens + 100, 800)
+        # the kept turns still alternate, starting with a user message
+        self.assertEqual(kept[0]["role"], "system")
+        self.assertEqual([message["role"] for message in kept[1:]], ["user", "assistant"] * ((len(kept) - 1) // 2))
+
+    def test_summary_without_kept_turns(self):
+        budget = TokenBudget(max_tokens=250, completion_tokens=100)
+
+        kept, usage = budget.fit("prompt", self.context, "question")
+
+        self.assertEqual([message["role"] for message in kept], ["system"])
+        self.assertIn("6. Баллы: 5 из 10", kept[0]["text"])
+        self.assertEqual(usage.dropped_messages, len(self.context))
+
+    def test_step_by_step_reviewer_usage(self):
+        server = FakeYandexServer()
+        client = server.client()
+        try:
+            cells = [parser.NotebookCell(i % 2 == 1, parser.CellType.OTHER, "z" * 600) for i in range(8)]
+            reviewer = StepByStepTaskReviewer(client, budget=TokenBudget(max_tokens=1500, completion_tokens=100))
+
+            _, usages = reviewer.review_with_usage(cells)
+
+            self.assertEqual(len(usages), 4)
+            self.assertTrue(all(u.input_tokens + 100 <= 1500 for u in usages))
+            self.assertGreater(usages[-1].dropped_messages, 0)
+            # the question is sent and counted once
+            roles = [m["role"] for m in server.last_messages]
+            self.assertEqual(roles[-1], "user")
+            self.assertNotIn(("user", "user"), list(zip(roles, roles[1:])))
+            self.assertEqual(usages[0].context_tokens, 0)
+            self.assertEqual(len(reviewer.review_with_usage(cells)[1]), 4)
+        finally:
+            client.close()
+            server.close()
+
+
+class TestBatchedStepByStep(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeYandexServer()
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_questions_are_packed_and_split(self):
+        # the fake server echoes the request, so every answer carries the verdict for its place in the batch
+        cells = []
+        for i in range(5):
+            verdict = f"### Вердикт {i % 2 + 1}\n" if i != 2 else ""
+            cells += [
+                parser.NotebookCell(False, parser.CellType.MARKDOWN, f"Вопрос {i}"),
+                parser.NotebookCell(True, parser.CellType.CODE, f"{verdict}Баллы: {i} из 10\nКомментарий: ответ {i}"),
+            ]
+        reviewer = StepByStepTaskReviewer(self.client, batching=BatchPolicy(max_questions=2))
+
+        result, usages = reviewer.review_with_usage(cells)
+
+        # batches (0, 1), (2, 3), (4), then question 2 again, its verdict is missing
+        self.assertEqual(self.server.completions, 4)
+        self.assertEqual(len(usages), 4)
+        self.assertEqual(result.score, sum(range(5)) / 5)
+        self.assertEqual(result.raw_text.count("Verdict for question"), 5)
+        self.assertEqual([c for c in result.comments if c.startswith("ответ")], [f"ответ {i}" for i in range(5)])
+
+    def test_packing_policy(self):
+        policy = BatchPolicy(max_questions=3, max_tokens=100)
+        self.assertEqual(pack_questions([10, 20, 30, 40, 200, 5], policy), [[0, 1, 2], [3], [4], [5]])
+
+
+class TestCollaborativeTaskReviewer(unittest.TestCase):
+    def setUp(self):
+        self.primary_server, self.secondary_server = FakeYandexServer(delay=0.1), FakeYandexServer(delay=0.1)
+        self.primary, self.secondary = self.primary_server.client(), self.secondary_server.client()
+        # the fake server answers with the task itself, so both reviewers give the same score
+        self.cells = [parser.NotebookCell(True, parser.CellType.OTHER, "Баллы: 5 из 10")]
+
+    def tearDown(self):
+        for client, server in [(self.primary, self.primary_server), (self.secondary, self.secondary_server)]:
+            client.close()
+            server.close()
+
+    def _review(self, **kwargs) -> None:
+        CollaborativeTaskReviewer(self.primary, self.secondary, **kwargs).review(self.cells)
+
+    def test_parallel_rounds(self):
+        self._review(iterations=4)
+        self._review(iterations=4, parallel=True)
+
+        self.assertEqual(self.primary_server.completions, 3 + 3)
+        self.assertEqual(self.secondary_server.completions, 2 + 2)
+        self.assertEqual(max(self.primary_server.max_in_flight, self.secondary_server.max_in_flight), 1)
+
+    def test_parallel_calls_overlap(self):
+        primary_started, secondary_started = threading.Event(), threading.Event()
+        overlapped = []
+
+        def responder(started: threading.Event, other: threading.Event):
+            def respond(prompt: str, user_message: str, context: list) -> str:
+                started.set()
+                # the first calls of both clients wait for each other, which only works if they run concurrently
+                overlapped.append(other.wait(timeout=10))
+                return user_message
+            return respond
+
+        primary = MockClient(responder(primary_started, secondary_started))
+        secondary = MockClient(responder(secondary_started, primary_started))
+        result = CollaborativeTaskReviewer(primary, secondary, iterations=4, parallel=True).review(self.cells)
+
+        self.assertTrue(all(overlapped))
+        self.assertEqual((primary.calls, secondary.calls, result.score), (3, 2, 5))
+
+    def test_odd_iterations(self):
+        for parallel in [False, True]:
+            primary, secondary = MockClient(), MockClient()
+            CollaborativeTaskReviewer(primary, secondary, iterations=3, parallel=parallel).review(self.cells)
+
+            # two reviews and the aggregation by the primary client, one review by the secondary
+            self.assertEqual((primary.calls, secondary.calls), (3, 1))
+
+    def test_early_exit(self):
+        self._review(iterations=4, parallel=True, early_exit=True)
+
+        # one round and the aggregation
+        self.assertEqual(self.primary_server.completions, 2)
+        self.assertEqual(self.secondary_server.completions, 1)
+
+
+class TestMockClient(unittest.TestCase):
+    def test_latency_and_errors(self):
+        scheduler = RequestScheduler(retry_policy=RetryPolicy(max_attempts=10), sleep=lambda _: None)
+        slept = []
+        client = MockClient(
+            latency=uniform_latency(0.1, 0.2), error_rate=0.3, seed=1, sleep=slept.append, scheduler=scheduler
+        )
+
+        for i in range(20):
+            self.assertEqual(client.call("prompt", f"message {i}"), f"message {i}")
+        self.assertGreater(client.errors, 0)
+        self.assertEqual(client.calls, 20 + client.errors)
+        self.assertEqual(scheduler.stats.retries, client.errors)
+        self.assertTrue(all(0.1 <= latency <= 0.2 for latency in slept))
+
+    def test_canned_and_replayed_responses(self):
+        client = MockClient(["Баллы: 1 из 2", "Баллы: 2 из 2"], stream_chunk=4)
+        self.assertEqual(client.call("prompt", "message"), "Баллы: 1 из 2")
+        self.assertEqual("".join(client.stream("prompt", "message")), "Баллы: 2 из 2")
+        self.assertEqual(client.call("prompt", "message"), "Баллы: 1 из 2")
+        self.assertGreater(client.last_usage["completion_tokens"], 0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResponseCache(os.path.join(directory, "cache.sqlite"))
+            cache.put(cache.make_key("recorded", "prompt", "message", None, 500, 0.5), "recorded response")
+            replay = MockClient(replay_responder(cache, "recorded"))
+
+            self.assertEqual(replay.call("prompt", "message"), "recorded response")
+            with self.assertRaises(ProviderError):
+                replay.call("prompt", "another message")
+            cache.close()
+
+    def test_mixed_providers(self):
+        server = FakeYandexServer()
+        yandex = server.client()
+        mock = MockClient(["Баллы: 5 из 10"])
+        try:
+            reviewer = CollaborativeTaskReviewer(yandex, mock, iterations=3)
+            result = reviewer.review([parser.NotebookCell(True, parser.CellType.OTHER, "Баллы: 5 из 10")])
+
+            self.assertEqual(result.score, 5)
+            self.assertEqual(mock.calls, 1)
+            # the history produced with the mock is sent to Yandex in its own message format
+            self.assertGreater(len(server.last_messages), 2)
+            self.assertTrue(all("text" in message and "content" not in message for message in server.last_messages))
+        finally:
+            yandex.close()
+            server.close()
+
+    def test_registry(self):
+        self.assertTrue({"yandex", "openai", "mock"} <= set(available_providers()))
+        client = create_client("mock", {"MOCK_RESPONSES": ["Баллы: 3"]})
+        self.assertEqual(client.call("prompt", "message"), "Баллы: 3")
+        with self.assertRaises(ValueError):
+            create_client("unknown", {})
+
+    def test_clients_share_provider_scheduler(self):
+        config = {"OPENAI_API_KEY": "key", "OPENAI_REQUESTS_PER_SECOND": 5, "OPENAI_MAX_ATTEMPTS": 2}
+        first, second = create_client("openai", config), create_client("openai", config)
+        other = create_client("openai", {**config, "OPENAI_API_KEY": "another key"})
+
+        self.assertIs(first.scheduler, second.scheduler)
+        self.assertIsNot(first.scheduler, other.scheduler)
+        self.assertEqual(first.scheduler.rate_limiter.requests.rate, 5)
+        self.assertEqual(first.scheduler.retry_policy.max_attempts, 2)
+        self.assertIsNone(provider_scheduler("YANDEX", "folder", {}).rate_limiter)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        self.previous = metrics.set_registry(self.registry)
+
+    def tearDown(self):
+        metrics.set_registry(self.previous)
+
+    @staticmethod
+    def _counters(snapshot: dict, name: str) -> dict:
+        return {
+            tuple(sorted(counter["labels"].items())): counter["value"]
+            for counter in snapshot["counters"] if counter["name"] == name
+        }
+
+    def test_histogram_and_export(self):
+        for value in range(1, 101):
+            metrics.observe("latency_seconds", value / 100, stage="read")
+        metrics.inc("requests_total", status="ok")
+        metrics.inc("requests_total", 2, status="ok")
+
+        histogram = self.registry.histogram("latency_seconds", stage="read")
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (100, 0.01, 1.0))
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.5, delta=0.05)
+
+        text = self.registry.to_prometheus()
+        self.assertIn('requests_total{status="ok"} 3', text)
+        self.assertIn('latency_seconds_bucket{stage="read",le="+Inf"} 100', text)
+        self.assertIn('latency_seconds_count{stage="read"} 100', text)
+        self.assertEqual(json.loads(self.registry.to_json())["histograms"][0]["count"], 100)
+
+        other = metrics.MetricsRegistry()
+        other.merge(self.registry.drain())
+        self.assertEqual(other.histogram("latency_seconds", stage="read").count, 100)
+        self.assertEqual(self.registry.snapshot(), {"counters": [], "histograms": []})
+
+    def test_disabled_registry(self):
+        metrics.disable()
+        self.assertIs(metrics.timer("parse_stage_seconds", stage="read"), metrics.NULL_METRIC)
+        with metrics.timer("parse_stage_seconds"):
+            metrics.inc("requests_total")
+        self.assertEqual(self.registry.snapshot(), {"counters": [], "histograms": []})
+
+    def test_instrumented_run(self):
+        list(parser.parse_notebooks(["solved.ipynb"], "original.ipynb", parser.MergeKind.BY_CHANGE, 1, max_workers=1))
+
+        server = FakeYandexServer()
+        client = server.client(scheduler=RequestScheduler(retry_policy=RetryPolicy(base_delay=0.001)))
+        try:
+            server.failures = [503]
+            FullTaskReviewer(client).review([parser.NotebookCell(True, parser.CellType.OTHER, "Баллы: 5 из 10")])
+        finally:
+            client.close()
+            server.close()
+
+        snapshot = self.registry.snapshot()
+        stages = {h["labels"]["stage"] for h in snapshot["histograms"] if h["name"] == "parse_stage_seconds"}
+        self.assertEqual(stages, {"read", "filter", "diff", "split_tasks", "merge"})
+        self.assertEqual(self._counters(snapshot, "parsed_notebooks_total"), {(("status", "ok"),): 1})
+
+        requests = self._counters(snapshot, "llm_requests_total")
+        self.assertEqual(requests, {(("provider", "yandex"), ("status", "ok")): 1})
+        self.assertEqual(self._counters(snapshot, "llm_retries_total"), {(("provider", "yandex"),): 1})
+        responses = self._counters(snapshot, "http_responses_total")
+        self.assertEqual(responses[(("endpoint", "completion"), ("provider", "yandex"), ("status", "503"))], 1)
+        self.assertEqual(responses[(("endpoint", "completion"), ("provider", "yandex"), ("status", "200"))], 1)
+        self.assertEqual(responses[(("endpoint", "iam"), ("provider", "yandex"), ("status", "200"))], 1)
+        review = [h for h in snapshot["histograms"] if h["name"] == "review_seconds"]
+        self.assertEqual((review[0]["labels"], review[0]["count"]), ({"reviewer": "FullTaskReviewer"}, 1))
+
+
+class TestStreaming(unittest.TestCase):
+    TEXT = "Баллы: 7 из 10\nКомментарий: " + "замечание; " * 20
+
+    def setUp(self):
+        self.server = FakeYandexServer(stream_delay=0.02)
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_incremental_score_parser(self):
+        score_parser = IncrementalScoreParser()
+        # the number and "из N" may be split between chunks
+        for chunk in ["Бал", "лы: 1", "0 из 1", "0"]:
+            self.assertIsNone(score_parser.feed(chunk))
+        self.assertEqual(score_parser.feed("\nКомментарий"), Score(10.0, 10))
+        self.assertIsNone(score_parser.feed("Баллы: 3 из 10\n"))
+
+        score_parser = IncrementalScoreParser()
+        self.assertIsNone(score_parser.feed("**Баллы:** 7,5"))
+        self.assertEqual(score_parser.finish(), Score(7.5, None))
+        self.assertIsNone(parse_score("Ошибок не обнаружено"))
+
+    def test_stream_chunks(self):
+        chunks = list(self.client.stream("prompt", self.TEXT))
+
+        self.assertEqual(self.client.last_usage, {"input_tokens": 3, "completion_tokens": len(chunks)})
+        self.assertEqual(len(chunks), -(-len(self.TEXT) // FakeYandexServer.STREAM_CHUNK))
+        self.assertEqual("".join(chunks), self.client.call("prompt", self.TEXT))
+
+        async def collect():
+            return [chunk async for chunk in self.client.astream("prompt", self.TEXT)]
+
+        self.assertEqual(asyncio.run(collect()), chunks)
+
+    def test_score_before_end_of_review(self):
+        scores = []
+        reviewer = FullTaskReviewer(
+            self.client, on_score=lambda score: scores.append((score, time.perf_counter()))
+        )
+
+        start = time.perf_counter()
+        review = reviewer.review([parser.NotebookCell(True, parser.CellType.OTHER, self.TEXT)])
+        total = time.perf_counter() - start
+
+        self.assertEqual(review.raw_text, self.TEXT)
+        self.assertEqual((review.score, review.max_score), (7.0, 10))
+        self.assertEqual([score for score, _ in scores], [Score(7.0, 10)])
+        self.assertLess(scores[0][1] - start, total / 3)
+
+
+class TestDeferredClient(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeYandexServer(operation_delay=0.2)
+        self.client = DeferredClient(self.server.client(), PollPolicy(initial_delay=0.05, max_delay=0.2))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_many_operations(self):
+        futures = [self.client.submit("prompt", f"message {i}") for i in range(50)]
+        completions = [future.result(timeout=10) for future in futures]
+
+        self.assertEqual([c.text for c in completions], [f"message {i}" for i in range(50)])
+        self.assertEqual(completions[0].usage, {"input_tokens": 3, "completion_tokens": 5})
+        stats = self.client.completions.stats
+        self.assertEqual((stats.submitted, stats.completed, stats.failed), (50, 50, 0))
+        self.assertEqual(self.client.completions.pending_count, 0)
+        # a few polls per operation, not one per initial delay
+        self.assertLessEqual(self.server.operation_polls, 50 * 5)
+
+    def test_adaptive_first_poll(self):
+        self.client.call("prompt", "first")
+        polls = self.server.operation_polls
+        for i in range(5):
+            self.client.call("prompt", f"message {i}")
+
+        # once the typical duration is known, operations are first polled shortly before it
+        self.assertLess((self.server.operation_polls - polls) / 5, polls)
+        self.assertLessEqual(self.server.operation_polls - polls, 5 * 3)
+
+    def test_reviewers(self):
+        cells = [parser.NotebookCell(True, parser.CellType.OTHER, "Баллы: 5 из 10")]
+        grader = BatchGrader(FullTaskReviewer(self.client), max_concurrency=20)
+        results = grader.run([ReviewJob(f"{i}.ipynb", 0, cells, 10) for i in range(20)])
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual({result.review.score for result in results}, {5})
+        self.assertEqual({(r.review.input_tokens, r.review.completion_tokens) for r in results}, {(3, 5)})
+
+    def test_failures(self):
+        self.server.failed_operations.add("operation-1")
+        with self.assertRaises(ProviderError):
+            self.client.call("prompt", "message")
+        self.assertEqual(self.client.call("prompt", "message"), "message")
+
+        self.server.operation_delay = 60.0
+        future = self.client.submit("prompt", "message")
+        self.client.completions.close()
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=1)
+        with self.assertRaises(RuntimeError):
+            self.client.submit("prompt", "message").result(timeout=1)
+
+    def test_submit_racing_close(self):
+        completions = self.client.completions
+        submit_completion = completions.client.submit_completion
+
+        def close_meanwhile(*args):
+            operation_id = submit_completion(*args)
+            completions.close()
+            return operation_id
+
+        completions.client.submit_completion = close_meanwhile
+        with self.assertRaises(RuntimeError):
+            completions.submit("prompt", "message").result(timeout=1)
+        self.assertEqual(completions.pending_count, 0)
+
+        with self.assertRaises(RuntimeError):
+            completions.submit("prompt", "message").result(timeout=1)
+        # a closed poller doesn't start operations
+        self.assertEqual(len(self.server.operations), 1)
+
+    def test_polls_are_backed_off(self):
+        delays = []
+        scheduler = RequestScheduler(retry_policy=RetryPolicy(base_delay=0.001), sleep=delays.append)
+        client = DeferredClient(self.server.client(scheduler=scheduler), PollPolicy(initial_delay=0.05))
+        try:
+            self.server.poll_failures = [429, 429]
+
+            self.assertEqual(client.call("prompt", "message"), "message")
+            self.assertEqual(scheduler.stats.retries, 2)
+            self.assertEqual(delays, [0.01, 0.01])
+        finally:
+            client.close()
+
+
+class TestReviewResult(unittest.TestCase):
+    def test_advanced_format(self):
+        result = parse_review(
+            "**Баллы:** 8 из 10\n**Комментарий:**\n- В формуле дисперсии пропущен множитель.\n2) Нет вывода.",
+            latency=1.5
+        )
+
+        self.assertEqual((result.score, result.max_score, result.fraction), (8.0, 10, 0.8))
+        self.assertEqual(result.comments, ["В формуле дисперсии пропущен множитель.", "Нет вывода."])
+        self.assertEqual(str(result), result.raw_text)
+
+    def test_aggregation_format(self):
+        result = parse_review(
+            "1) Итоговый балл: 6\n2) Список ключевых ошибок:\n- неверный критерий\n3) Краткие комментарии: ок",
+            max_score=10
+        )
+
+        self.assertEqual((result.score, result.max_score), (6.0, 10))
+        self.assertEqual(result.comments, ["неверный критерий", "ок"])
+        self.assertIsNone(parse_review("Ошибок не обнаружено").score)
+
+    def test_jsonl_round_trip(self):
+        results = [parse_review(f"Баллы: {i} из 10\nКомментарий: {i}", input_tokens=i) for i in range(3)]
+        buffer = io.StringIO()
+
+        self.assertEqual(dump_jsonl(results, buffer), 3)
+        buffer.seek(0)
+        self.assertEqual(list(load_jsonl(buffer)), results)
+
+    def test_reviewer_result(self):
+        server = FakeYandexServer()
+        client = server.client()
+        reviewer = FullTaskReviewer(client, cache=ResponseCache())
+        cells = [parser.NotebookCell(True, parser.CellType.OTHER, "Баллы: 4 из 5\nКомментарий: нет вывода")]
+        try:
+            first, second = reviewer.review(cells, 5), reviewer.review(cells, 5)
+        finally:
+            client.close()
+            server.close()
+
+        self.assertIsInstance(first, ReviewResult)
+        self.assertEqual((first.score, first.max_score, first.comments), (4.0, 5, ["нет вывода"]))
+        self.assertEqual((first.cache_hit, second.cache_hit), (False, True))
+        self.assertGreater(first.latency, 0)
+
+
+class TestBatchGrader(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeYandexServer(delay=0.05)
+        self.client = self.server.client()
+        self.reviewer = FullTaskReviewer(self.client)
+        self.jobs = [
+            ReviewJob(f"work_{i}.ipynb", 0, [parser.NotebookCell(True, parser.CellType.CODE, f"answer {i}")], 10)
+            for i in range(8)
+        ]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_results_keep_order(self):
+        results = BatchGrader(self.reviewer, max_concurrency=4).run(self.jobs)
+
+        self.assertEqual([r.job for r in results], self.jobs)
+        self.assertEqual([r.review.raw_text for r in results], [f"answer {i}" for i in range(8)])
+        self.assertLessEqual(self.server.max_in_flight, 4)
+        self.assertGreater(self.server.max_in_flight, 1)
+
+    def test_lazy_jobs(self):
+        results = BatchGrader(self.reviewer, max_concurrency=4).run(job for job in self.jobs)
+
+        self.assertEqual([r.review.raw_text for r in results], [f"answer {i}" for i in range(8)])
+
+    def test_lazy_jobs_are_taken_few_ahead(self):
+        client = MockClient(["Баллы: 5 из 10"], latency=constant_latency(0.01))
+        ahead = []
+
+        def jobs():
+            for job in self.jobs * 4:
+                ahead.append(len(ahead) - client.calls)
+                yield job
+
+        results = BatchGrader(FullTaskReviewer(client), max_concurrency=2).run(jobs())
+
+        self.assertEqual(len(results), 32)
+        self.assertLessEqual(max(ahead), 2 * 2)
+
+    def test_provider_limit(self):
+        results = BatchGrader(self.reviewer, max_concurrency=4, provider_limits={"yandex": 1}).run(self.jobs)
+
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(self.server.max_in_flight, 1)
+
+    def test_iter_results(self):
+        results = list(BatchGrader(self.reviewer, max_concurrency=4).iter_results(job for job in self.jobs))
+
+        self.assertEqual(sorted(r.review.raw_text for r in results), sorted(f"answer {i}" for i in range(8)))
+
+    def test_unparsed_notebooks_fail(self):
+        with tempfile.TemporaryDirectory() as directory:
+            works = os.path.join(directory, "works")
+            os.mkdir(works)
+            with open("solved.ipynb", "rb") as source, open(os.path.join(works, "good.ipynb"), "wb") as target:
+                target.write(source.read())
+            with open(os.path.join(works, "bad.ipynb"), "w", encoding="utf-8") as file:
+                file.write("not a notebook")
+            config = os.path.join(directory, "config.yaml")
+            with open(config, "w", encoding="utf-8") as file:
+                file.write("MOCK_RESPONSES: ['Баллы: 5 из 10']\n")
+            output = os.path.join(directory, "results.csv")
+
+            code = main.main([
+                "grade", "--works", works, "--original", "original.ipynb", "--tasks", "1", "--config", config,
+                "--provider", "mock", "--output", output, "--no-journal"
+            ])
+            with open(output, encoding="utf-8-sig") as file:
+                rows = sorted(csv.DictReader(file), key=lambda row: row["notebook"])
+
+        self.assertEqual(code, 1)
+        self.assertEqual([os.path.basename(row["notebook"]) for row in rows], ["bad.ipynb", "good.ipynb"])
+        self.assertTrue(rows[0]["error"])
+        self.assertEqual((rows[1]["score"], rows[1]["error"]), ("5.0", ""))
+
+    def test_grade_metrics(self):
+        previous = metrics.set_registry(metrics.MetricsRegistry())
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                works = os.path.join(directory, "works")
+                os.mkdir(works)
+                for i in range(3):
+                    with open("solved.ipynb", "rb") as source, \
+                            open(os.path.join(works, f"work_{i}.ipynb"), "wb") as target:
+                        target.write(source.read())
+                config = os.path.join(directory, "config.yaml")
+                with open(config, "w", encoding="utf-8") as file:
+                    file.write("MOCK_RESPONSES: ['Баллы: 5 из 10']\n")
+                path = os.path.join(directory, "metrics.json")
+
+                code = main.main([
+                    "grade", "--works", works, "--original", "original.ipynb", "--tasks", "1", "--config", config,
+                    "--provider", "mock", "--output", os.path.join(directory, "results.csv"), "--no-journal",
+                    "--metrics", path
+                ])
+                with open(path, encoding="utf-8") as file:
+                    snapshot = json.load(file)
+        finally:
+            metrics.set_registry(previous)
+
+        self.assertEqual(code, 0)
+        counts = {}
+        for histogram in snapshot["histograms"]:
+            key = (histogram["name"], histogram["labels"].get("stage"))
+            counts[key] = counts.get(key, 0) + histogram["count"]
+        # the original notebook is read once in the parent process
+        for stage in ("read", "filter"):
+            self.assertEqual(counts[("parse_stage_seconds", stage)], 3 + 1)
+        for stage in ("diff", "split_tasks", "merge"):
+            self.assertEqual(counts[("parse_stage_seconds", stage)], 3)
+        self.assertEqual(counts[("parse_notebook_seconds", None)], 3)
+        parsed = {
+            c["labels"]["status"]: c["value"] for c in snapshot["counters"] if c["name"] == "parsed_notebooks_total"
+        }
+        self.assertEqual(parsed, {"ok": 3})
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        job = ReviewJob("work.ipynb", 0, [], 10)
+        self.results = [
+            JobResult(job, review=parse_review("Баллы: 7 из 10\nКомментарий:\n- первое\n- второе", latency=0.5)),
+            JobResult(job, error=ProviderError("HTTP 500", status=500)),
+        ]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_csv_is_flushed_while_writing(self):
+        path = os.path.join(self.directory.name, "results.csv")
+        with export.create_writer(path, flush_rows=1) as writer:
+            writer.write(self.results[0])
+            with open(path, encoding="utf-8-sig") as file:
+                self.assertIn("второе", file.read())
+            writer.write(self.results[1])
+
+        with open(path, encoding="utf-8-sig", newline="") as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual((rows[0]["score"], rows[0]["comments"]), ("7.0", "первое\nвторое"))
+        self.assertEqual((rows[1]["score"], rows[1]["error"]), ("", "ProviderError('HTTP 500')"))
+
+    def test_csv_is_flushed_by_interval_without_more_rows(self):
+        path = os.path.join(self.directory.name, "results.csv")
+        with export.create_writer(path, flush_rows=100, flush_interval=0.05) as writer:
+            writer.write(self.results[0])
+            deadline = time.monotonic() + 10
+            content = ""
+            while "второе" not in content and time.monotonic() < deadline:
+                time.sleep(0.01)
+                with open(path, encoding="utf-8-sig") as file:
+                    content = file.read()
+            self.assertIn("второе", content)
+            self.assertEqual(writer.rows_written, 1)
+
+    def test_xlsx(self):
+        path = os.path.join(self.directory.name, "results.xlsx")
+        with export.create_writer(path) as writer:
+            self.assertEqual(writer.write_all(self.results), 2)
+
+        rows = list(openpyxl.load_workbook(path, read_only=True).active.iter_rows(values_only=True))
+        self.assertEqual(list(rows[0]), export.COLUMNS)
+        self.assertEqual(rows[1][:4], ("work.ipynb", 1, 7.0, 10))
+        self.assertIsNone(rows[2][2])
+
+    @unittest.skipIf(export.pyarrow is None, "pyarrow is not installed")
+    def test_parquet(self):
+        path = os.path.join(self.directory.name, "results.parquet")
+        with export.create_writer(path, flush_rows=1) as writer:
+            writer.write_all(self.results)
+
+        table = export.pyarrow.parquet.read_table(path)
+        self.assertEqual(table.column("score").to_pylist(), [7.0, None])
+
+
+class TestDedupIndex(unittest.TestCase):
+    SOLUTION = (
+        "mean = sample.sum() / len(sample)\n"
+        "variance = ((sample - mean) ** 2).sum() / (len(sample) - 1)\n"
+        "interval = (mean - 1.96 * (variance / len(sample)) ** 0.5, mean + 1.96 * (variance / len(sample)) ** 0.5)\n"
+        "print('Доверительный интервал для среднего:', interval)"
+    )
+
+    @staticmethod
+    def task(answer: str) -> list:
+        return [
+            parser.NotebookCell(False, parser.CellType.MARKDOWN, "Постройте доверительный интервал"),
+            parser.NotebookCell(True, parser.CellType.CODE, f"{lib.parser.SPECIAL_MARK}\n{answer}"),
+        ]
+
+    def test_groups(self):
+        index = DedupIndex(threshold=0.7)
+        submissions = {
+            ("a.ipynb", 0): self.SOLUTION,
+            ("b.ipynb", 0): self.SOLUTION.replace("    ", "\t") + "\n",
+            ("c.ipynb", 0): self.SOLUTION.replace("Доверительный интервал", "Интервал"),
+            ("d.ipynb", 0): "from scipy import stats\nprint(stats.t.interval(0.95, len(x) - 1, x.mean(), stats.sem(x)))",
+        }
+        representatives = [index.add(key, self.task(answer)) for key, answer in submissions.items()]
+
+        self.assertEqual(representatives, [("a.ipynb", 0)] * 3 + [("d.ipynb", 0)])
+        group, = index.groups()
+        self.assertEqual(group.members, [("a.ipynb", 0), ("b.ipynb", 0), ("c.ipynb", 0)])
+        self.assertFalse(group.exact)
+        self.assertLess(group.similarity[("c.ipynb", 0)], 1.0)
+
+        report = io.StringIO()
+        self.assertEqual(index.write_report(report), 1)
+        self.assertEqual(len(report.getvalue().splitlines()), 4)
+
+        exact_index = DedupIndex(threshold=1.0)
+        for key, answer in submissions.items():
+            exact_index.add(key, self.task(answer))
+        self.assertEqual([g.members for g in exact_index.groups()], [[("a.ipynb", 0), ("b.ipynb", 0)]])
+        self.assertTrue(exact_index.groups()[0].exact)
+
+    def test_batch_reviews_each_group_once(self):
+        server = FakeYandexServer(delay=0.05)
+        client = server.client()
+        jobs = [ReviewJob(f"work_{i}.ipynb", 0, self.task(self.SOLUTION if i % 3 else f"x = {i}"), 10) for i in range(9)]
+        try:
+            results = BatchGrader(FullTaskReviewer(client), max_concurrency=4, dedup=DedupIndex()).run(jobs)
+        finally:
+            client.close()
+            server.close()
+
+        self.assertEqual(server.completions, 4)
+        self.assertEqual([r.job for r in results], jobs)
+        duplicate = ("work_1.ipynb", 0)
+        self.assertEqual(
+            [r.duplicate_of for r in results],
+            [None, None, duplicate, None, duplicate, duplicate, None, duplicate, duplicate]
+        )
+        self.assertEqual(results[8].review.raw_text, results[1].review.raw_text)
+
+    def test_only_same_task_is_grouped(self):
+        index = DedupIndex()
+        self.assertEqual(index.add(("a.ipynb", 0), self.task(self.SOLUTION), scope=(0, 10, None)), ("a.ipynb", 0))
+        self.assertEqual(index.add(("b.ipynb", 1), self.task(self.SOLUTION), scope=(1, 10, None)), ("b.ipynb", 1))
+        self.assertEqual(index.add(("c.ipynb", 0), self.task(self.SOLUTION), scope=(0, 5, None)), ("c.ipynb", 0))
+        self.assertEqual(index.add(("d.ipynb", 1), self.task(self.SOLUTION), scope=(1, 10, None)), ("b.ipynb", 1))
+
+        # untouched tasks have the same empty changed text
+        untouched = [parser.NotebookCell(False, parser.CellType.MARKDOWN, "Постройте доверительный интервал")]
+        jobs = [ReviewJob("a.ipynb", 0, untouched, 10), ReviewJob("b.ipynb", 1, untouched, 10)]
+        results = BatchGrader(FullTaskReviewer(MockClient(["Баллы: 0 из 10"])), dedup=DedupIndex()).run(jobs)
+        self.assertEqual([result.duplicate_of for result in results], [None, None])
+
+
+class TestJobJournal(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeYandexServer()
+        self.client = self.server.client()
+        self.reviewer = FullTaskReviewer(self.client)
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.directory.name, "journal.jsonl")
+
+        self.jobs = []
+        for i in range(6):
+            path = os.path.join(self.directory.name, f"work_{i}.ipynb")
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(f"notebook {i}")
+            self.jobs.append(ReviewJob(path, 0, [parser.NotebookCell(True, parser.CellType.CODE, f"answer {i}")], 10))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.directory.cleanup()
+
+    def _run(self) -> list:
+        journal = JobJournal(self.journal_path)
+        try:
+            return BatchGrader(self.reviewer, max_concurrency=3, journal=journal).run(self.jobs)
+        finally:
+            journal.close()
+
+    def test_rerun_skips_completed_jobs(self):
+        self.server.failures = [400]
+        first = self._run()
+        self.assertEqual(sum(not r.ok for r in first), 1)
+        self.assertEqual(self.server.completions, 5)
+
+        # a crash in the middle of writing a record
+        with open(self.journal_path, "a", encoding="utf-8") as file:
+            file.write('{"key": "trunc')
+
+        second = self._run()
+        self.assertTrue(all(r.ok for r in second))
+        self.assertEqual(self.server.completions, 6)
+        self.assertEqual(sum(r.resumed for r in second), 5)
+        self.assertEqual([r.review.raw_text for r in second], [f"answer {i}" for i in range(6)])
+
+        third = self._run()
+        self.assertTrue(all(r.resumed for r in third))
+        self.assertEqual(self.server.completions, 6)
+
+    def test_changed_notebook_is_reviewed_again(self):
+        self._run()
+        with open(self.jobs[0].notebook_path, "a", encoding="utf-8") as file:
+            file.write(" fixed")
+
+        results = self._run()
+        self.assertEqual([r.resumed for r in results], [False] + [True] * 5)
+
 
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestIncrementalGrader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.works = os.path.join(self.directory.name, "works")
+        os.mkdir(self.works)
+        self.original = os.path.join(self.directory.name, "original.ipynb")
+        self.index_path = os.path.join(self.directory.name, "index.json")
+
+        benchmarks.generate_assignment(self.original, tasks=2)
+        for i in range(3):
+            benchmarks.generate_submission(
+                self.original, os.path.join(self.works, f"work_{i}.ipynb"), seed=i, solved_share=1.0
+            )
+        self.client = MockClient(["Баллы: 5 из 10"])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _grader(self) -> IncrementalGrader:
+        return IncrementalGrader(
+            BatchGrader(FullTaskReviewer(self.client)), self.original, parser.MergeKind.BY_CHANGE, 2,
+            index=WatchIndex(self.index_path), max_workers=1
+        )
+
+    def _edit_last_answer(self, path: str) -> None:
+        with open(path, encoding="utf-8") as file:
+            notebook = json.load(file)
+        # the last code cell answers the second task
+        code = [cell for cell in notebook["cells"] if cell["cell_type"] == "code"][-1]
+        code["source"] = ["".join(code["source"]) + "\nprint('fixed')"]
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(notebook, file)
+
+    def test_only_changed_tasks_are_reviewed(self):
+        grader = self._grader()
+        first = grader.scan(self.works)
+        self.assertEqual((first.parsed, first.reviewed, self.client.calls), (3, 6, 6))
+
+        unchanged = grader.scan(self.works)
+        self.assertEqual((unchanged.parsed, unchanged.reviewed, unchanged.changed), (0, 0, False))
+
+        path = os.path.join(self.works, "work_1.ipynb")
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        touched = grader.scan(self.works)
+        self.assertEqual((touched.touched, touched.parsed), (1, 0))
+
+        self._edit_last_answer(path)
+        os.remove(os.path.join(self.works, "work_2.ipynb"))
+        edited = grader.scan(self.works)
+        self.assertEqual((edited.parsed, edited.reused, edited.reviewed, edited.removed), (1, 1, 1, 1))
+        self.assertEqual([(r.job.notebook_path, r.job.task_index) for r in edited.results], [(path, 1)])
+        self.assertEqual(self.client.calls, 7)
+
+        # the state survives a restart
+        results = self._grader().results()
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result.ok and result.review.score == 5 for result in results))
+        restarted = self._grader().scan(self.works)
+        self.assertEqual((restarted.parsed, restarted.reviewed), (0, 0))
+
+    def test_reviewer_and_tasks_change(self):
+        self._grader().scan(self.works)
+
+        step_by_step = IncrementalGrader(
+            BatchGrader(StepByStepTaskReviewer(self.client)), self.original, parser.MergeKind.BY_CHANGE, 2,
+            index=WatchIndex(self.index_path), max_workers=1
+        )
+        switched = step_by_step.scan(self.works)
+        self.assertEqual((switched.parsed, switched.reused, switched.reviewed), (3, 0, 6))
+
+        first_task = IncrementalGrader(
+            BatchGrader(FullTaskReviewer(self.client)), self.original, parser.MergeKind.BY_CHANGE, 2,
+            index=WatchIndex(self.index_path), task_indices=[0], max_workers=1
+        )
+        self.assertEqual(first_task.scan(self.works).reviewed, 3)
+        both_tasks = self._grader().scan(self.works)
+        self.assertEqual((both_tasks.reused, both_tasks.reviewed), (3, 3))
+
+    def test_vanished_notebook_is_skipped(self):
+        os.symlink(os.path.join(self.works, "removed.ipynb"), os.path.join(self.works, "vanished.ipynb"))
+
+        report = self._grader().scan(self.works)
+
+        self.assertEqual((report.notebooks, report.parsed, report.reviewed), (4, 3, 6))
+
+    def test_failed_reviews_are_retried(self):
+        self.client.error_rate = 1.0
+        first = self._grader().scan(self.works)
+        self.assertEqual(first.failed, 6)
+
+        self.client.error_rate = 0.0
+        second = self._grader().scan(self.works)
+        self.assertEqual((second.parsed, second.reviewed, second.failed), (0, 6, 0))
+
+    def test_unparsed_notebooks_fail(self):
+        grader = self._grader()
+        grader.scan(self.works)
+        path = os.path.join(self.works, "work_0.ipynb")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("not a notebook")
+
+        report = grader.scan(self.works)
+        self.assertEqual((report.parsed, report.unparsed, report.reviewed), (1, 1, 0))
+        failed = [result for result in grader.results() if not result.ok]
+        self.assertEqual([(r.job.notebook_path, r.job.task_index) for r in failed], [(path, 0), (path, 1)])
+        self.assertEqual(len(self._grader().results()), 6)
+
+
+class TestDistributed(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.original = os.path.join(self.directory.name, "original.ipynb")
+        self.queue_path = os.path.join(self.directory.name, "queue.sqlite")
+        benchmarks.generate_assignment(self.original, tasks=2)
+        self.paths = []
+        for i in range(12):
+            self.paths.append(os.path.join(self.directory.name, f"work_{i}.ipynb"))
+            benchmarks.generate_submission(self.original, self.paths[-1], seed=i, solved_share=1.0)
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+        self.directory.cleanup()
+
+    def _queue(self) -> SQLiteJobQueue:
+        # every worker opens the queue itself, as on its own host
+        self.queues.append(SQLiteJobQueue(self.queue_path))
+        return self.queues[-1]
+
+    def _coordinator(self) -> Coordinator:
+        return Coordinator(self._queue(), self.original, parser.MergeKind.BY_CHANGE, 2)
+
+    def _run_workers(self, count: int, responder=None, concurrency: int = 2, **kwargs) -> list:
+        workers = []
+        for i in range(count):
+            client = MockClient(responder or ["Баллы: 5 из 10"])
+            workers.append(Worker(
+                self._queue(), {"full": FullTaskReviewer(client)}, concurrency=concurrency,
+                worker_id=f"worker-{i}", poll_interval=0.02, **kwargs
+            ))
+        threads = [threading.Thread(target=worker.run) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return workers
+
+    def test_leases(self):
+        queue = self._queue()
+        jobs = [QueuedJob(path, 0, "full") for path in self.paths[:3]]
+        self.assertEqual(queue.put(jobs), 3)
+        self.assertEqual(queue.put(jobs), 0)
+
+        first = queue.lease("a", 2, lease_seconds=0.2)
+        second = queue.lease("b", 5, lease_seconds=0.2)
+        self.assertEqual(([job.id for job in first], len(second)), ([1, 2], 1))
+        self.assertEqual(queue.lease("c", 5, lease_seconds=0.2), [])
+
+        self.assertEqual(queue.heartbeat("a", [1, 2, 3], lease_seconds=10), 2)
+        time.sleep(0.3)
+        # only the lease without heartbeats expired
+        taken_over = queue.lease("c", 5, lease_seconds=10)
+        self.assertEqual([(job.id, job.attempts) for job in taken_over], [(3, 2)])
+        self.assertFalse(queue.fail("b", 3, "lost"))
+        self.assertFalse(queue.complete("b", 3, ReviewResult(0, 10, [], "stale")))
+
+        result = ReviewResult(5, 10, [], "Баллы: 5 из 10")
+        self.assertTrue(queue.complete("a", 1, result))
+        self.assertFalse(queue.complete("c", 1, result))
+        self.assertTrue(queue.fail("a", 2, "error", retry=False))
+        self.assertEqual(queue.release("c"), 1)
+
+        finished = queue.finished()
+        self.assertEqual([(f.job.id, f.result, f.error) for f in finished], [(1, result, None), (2, None, "error")])
+        self.assertEqual(queue.finished(after=finished[0].sequence)[0].job.id, 2)
+        self.assertEqual(queue.counts()[JobStatus.PENDING], 1)
+        self.assertEqual(queue.unfinished_count(), 1)
+
+    def test_hung_review_loses_lease(self):
+        self.assertEqual(self._coordinator().submit(self.paths[:1]), 2)
+        release = threading.Event()
+
+        def hang(prompt: str, user_message: str, context: list) -> str:
+            release.wait(10)
+            return "Баллы: 1 из 10"
+
+        hung = Worker(
+            self._queue(), {"full": FullTaskReviewer(MockClient(hang))}, concurrency=1, worker_id="hung",
+            lease_seconds=0.15, poll_interval=0.02, max_job_seconds=0.3
+        )
+        thread = threading.Thread(target=hung.run)
+        thread.start()
+        while not hung.stats.leased:
+            time.sleep(0.01)
+
+        workers = self._run_workers(1, lease_seconds=0.15)
+        release.set()
+        thread.join()
+
+        self.assertEqual((workers[0].stats.completed, hung.stats.lost), (2, 1))
+        finished = self._queue().finished()
+        self.assertEqual([(f.worker, f.result.score) for f in finished], [("worker-0", 5), ("worker-0", 5)])
+
+    def test_dead_worker(self):
+        coordinator = self._coordinator()
+        self.assertEqual(coordinator.submit(self.paths), 24)
+        # a worker leased a job and died
+        dead = self._queue().lease("dead", 1, lease_seconds=0.3)
+
+        workers = self._run_workers(2)
+        results = list(coordinator.iter_results(poll_interval=0.02))
+
+        self.assertEqual(len(results), 24)
+        self.assertTrue(all(result.ok and result.review.score == 5 for result in results))
+        self.assertEqual(sum(worker.stats.completed for worker in workers), 24)
+        finished = {f.job.id: f for f in coordinator.queue.finished()}
+        self.assertEqual(finished[dead[0].id].job.attempts, 2)
+
+        # a restarted coordinator streams the same results as resumed
+        restarted = self._coordinator()
+        self.assertEqual(restarted.submit(self.paths), 0)
+        self.assertTrue(all(result.resumed for result in restarted.iter_results(poll_interval=0.02)))
+        with self.assertRaises(ValueError):
+            kind = parser.MergeKind.BY_CHANGE_AND_CELL_TYPE
+            Coordinator(restarted.queue, self.original, kind, 2).submit(self.paths)
+
+    def test_failures(self):
+        coordinator = self._coordinator()
+        coordinator.submit(self.paths[:2])
+        with open(self.paths[0], "w", encoding="utf-8") as file:
+            file.write("not a notebook")
+
+        self._run_workers(1)
+        results = sorted(coordinator.iter_results(poll_interval=0.02), key=lambda r: r.job.notebook_path)
+
+        self.assertEqual([result.ok for result in results], [False, False, True, True])
+        self.assertEqual(results[0].job.task_index + results[1].job.task_index, 1)
+
+    def test_workers_review_concurrently(self):
+        condition = threading.Condition()
+        in_flight = [0, 0]
+
+        def respond(prompt: str, user_message: str, context: list) -> str:
+            with condition:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+                condition.notify_all()
+                # the first reviews wait until every thread of every worker reviews at once
+                condition.wait_for(lambda: in_flight[1] >= 3 * 2, timeout=10)
+                in_flight[0] -= 1
+            return "Баллы: 5 из 10"
+
+        self._coordinator().submit(self.paths)
+        workers = self._run_workers(3, respond, concurrency=2)
+
+        self.assertEqual(in_flight[1], 3 * 2)
+        self.assertEqual(sum(worker.stats.completed for worker in workers), 24)
+        self.assertTrue(all(worker.stats.completed for worker in workers))
+
+class TestCellStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.original, self.paths = benchmarks.generate_cohort(self.directory.name, 6, tasks=3)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_same_as_pipeline(self):
+        for diff_mode in parser.DiffMode:
+            store = CellStore(self.original, 3, diff_mode=diff_mode)
+            self.assertEqual(store.extend(self.paths), 6)
+            for kind in parser.MergeKind:
+                for n, path in enumerate(self.paths):
+                    tasks, marks = parser.parsing_pipeline(
+                        path, self.original, kind, 3, loader=parser.NotebookLoader.FAST, diff_mode=diff_mode
+                    )
+                    self.assertEqual(store.tasks(n, kind), tasks)
+                    self.assertEqual(store.marks(n), marks)
+                    self.assertEqual(
+                        [store.task_text(n, j, kind) for j in range(3)],
+                        [parser.merge_task_into_single_string(task) for task in tasks]
+                    )
+
+    def test_shared_texts_and_jobs(self):
+        store = CellStore(self.original, 3)
+        store.extend(self.paths)
+        broken = os.path.join(self.directory.name, "broken.ipynb")
+        with open(broken, "w", encoding="utf-8") as file:
+            file.write("{")
+        self.assertIsNone(store.add(broken))
+        self.assertIn(broken, store.errors)
+
+        stats = store.stats()
+        self.assertEqual((stats["notebooks"], stats["cells"]), (6, store.cells_count))
+        # unchanged template cells are stored once for the whole cohort
+        original_cells = parser.get_filtered_notebook_cells_from_notebook(self.original, parser.NotebookLoader.FAST)
+        self.assertLess(stats["unique_texts"], stats["cells"] - 5 * len(original_cells) // 2)
+        self.assertTrue(any(cell.is_changed for cell in store.raw_cells(0, 0)))
+
+        jobs = list(store.jobs(parser.MergeKind.BY_CHANGE, task_indices=[1]))
+        self.assertEqual(
+            [(job.notebook_path, job.task_index) for job in jobs], [(path, 1) for path in self.paths + [broken]]
+        )
+        self.assertEqual(jobs[0].cells, store.task_cells(0, 1, parser.MergeKind.BY_CHANGE))
+        self.assertIsNotNone(jobs[-1].error)
+        with self.assertRaises(IndexError):
+            store.task_text(0, 3, parser.MergeKind.BY_CHANGE)
+
+    def test_load_jobs(self):
+        broken = os.path.join(self.directory.name, "broken.ipynb")
+        with open(broken, "w", encoding="utf-8") as file:
+            file.write("{")
+        paths = self.paths[:3] + [broken] + self.paths[3:]
+
+        expected = CellStore(self.original, 3)
+        expected.extend(paths)
+        store = CellStore(self.original, 3)
+        jobs = list(store.load_jobs(paths, parser.MergeKind.BY_CHANGE, max_workers=2))
+
+        self.assertEqual([(job.notebook_path, job.task_index) for job in jobs], [(p, j) for p in paths for j in range(3)])
+        self.assertEqual(
+            [job.cells for job in jobs if job.error is None],
+            [job.cells for job in expected.jobs(parser.MergeKind.BY_CHANGE) if job.error is None]
+        )
+        self.assertEqual([job.task_index for job in jobs if job.error is not None], [0, 1, 2])
+        self.assertEqual((len(store), list(store.errors)), (6, [broken]))
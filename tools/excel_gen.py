@@ -1,36 +1,25 @@
-from openpyxl import Workbook
+import os
+import sys
 
-from lib.parser import *
-from lib.reviewers import FullTaskReviewer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-if __name__ == "__main__":
-
-    wb = Workbook()
-    ws = wb.active
-
-    results = [[]]
-
-    all_works = get_notebooks_filenames_from_directory("works")
+from main import main
 
+if __name__ == "__main__":
     # не сделанная работа
     orig_work_path = "../data/test/Домашнее задание 4 (1).ipynb"
 
-    parsed_notebooks, marks = [], []
-    for path in all_works:
-        p, m = parsing_pipeline(path, orig_work_path, MergeKind.BY_CHANGE, 3)
-        parsed_notebooks.append(p)
-        marks.append(m)
-
-    TASKS = 1
-
-    ws.append(["название файла", "оценка оценки yagpt"])
-
-    reviewer: FullTaskReviewer = FullTaskReviewer(...)
-
-    for i in range(1, len(all_works)):
-        filepath = all_works[i]
-        for (j, task) in enumerate(parsed_notebooks[i][0:TASKS]):
-            ws.cell(row=i + 1, column=1).value = filepath
-
-            answer = reviewer.review(task)
-            ws.cell(row=i + 1, column=3 + j).value = answer
+    # проверяется первое из трех заданий, результаты пишутся по мере готовности,
+    # при перезапуске уже проверенные задания берутся из журнала results.xlsx.journal.jsonl
+    sys.exit(main([
+        "grade",
+        "--works", "works",
+        "--original", orig_work_path,
+        "--tasks", "3",
+        "--grade-tasks", "1",
+        "--output", "results.xlsx",
+        "--concurrency", "16",
+        "--provider-limit", "yandex=8",
+        "--provider-limit", "openai=8",
+        *sys.argv[1:],
+    ]))